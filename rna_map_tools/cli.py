@@ -1,13 +1,66 @@
 import click
+import pandas as pd
 
-from rna_map_tools.logger import  get_logger, setup_applevel_logger
+from rna_map_tools.logger import get_logger, setup_applevel_logger
 from rna_map_tools import run
+from rna_map_tools.daemon import request, serve
+from rna_map_tools.fastq import get_paired_fastqs
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.read_store import ReadStore
+from rna_map_tools.tools.benchmark import benchmark_runmulti, write_report
+from rna_map_tools.tools.census import barcode_census
+from rna_map_tools.tools.plan import load_coefficients, plan_run
 
 log = get_logger("CLI")
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--log-file",
+    default=None,
+    help="also log to this file, replaces the log file a command writes",
+)
+@click.option(
+    "--json-log", is_flag=True, help="write the log file as json lines"
+)
+@click.option(
+    "--log-queue",
+    is_flag=True,
+    help="log from a background thread so logging never blocks",
+)
+@click.option(
+    "--rate-limit",
+    type=int,
+    default=None,
+    help="show each repeated warning at most this many times",
+)
+@click.option(
+    "--artifact-dir",
+    default=None,
+    help="write program output and other large messages to files here",
+)
+@click.pass_context
+def cli(ctx, log_file, json_log, log_queue, rate_limit, artifact_dir):
+    ctx.obj = {
+        "log_file": log_file,
+        "json_lines": json_log,
+        "use_queue": log_queue,
+        "rate_limit": rate_limit,
+        "artifact_dir": artifact_dir,
+    }
+
+
+def setup_logger(file_name=None):
+    """
+    sets up the app logger with the logging options given to the cli
+    :param file_name: the log file of the command
+    :return: the app logger
+    """
+    ctx = click.get_current_context(silent=True)
+    options = {}
+    if ctx is not None and ctx.find_root().obj is not None:
+        options = dict(ctx.find_root().obj)
+    log_file = options.pop("log_file", None)
+    return setup_applevel_logger(file_name=log_file or file_name, **options)
 
 
 @cli.command(help="download a run using bs commandline tool")
@@ -19,15 +72,44 @@ def cli():
     help="root directory of where data should be downloaded will default to "
     "$BASESPACE",
 )
-def download(run_name, download_dir):
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="content addressed cache of downloads, runs already in it are not "
+    "downloaded again",
+)
+@click.option(
+    "--cache-max-size-gb",
+    default=None,
+    type=float,
+    help="least recently used files are removed from the cache above this",
+)
+@click.option(
+    "--bs-command",
+    default=None,
+    help="basespace commandline tool to use instead of bs",
+)
+def download(
+    run_name, download_dir, cache_dir, cache_max_size_gb, bs_command
+):
     """
     a wrapper around the bs commandline tool to download a sequencing run
     :param run_name:
     :param download_dir:
+    :param cache_dir:
+    :param cache_max_size_gb:
+    :param bs_command:
     :return:
     """
-    setup_applevel_logger()
-    return run.download(run_name, download_dir)
+    setup_logger()
+    params = get_default_params()["download"]
+    if cache_dir is not None:
+        params["cache_dir"] = cache_dir
+    if cache_max_size_gb is not None:
+        params["cache_max_size_gb"] = cache_max_size_gb
+    if bs_command is not None:
+        params["bs_command"] = bs_command
+    return run.download(run_name, download_dir, params)
 
 
 @cli.command()
@@ -37,7 +119,7 @@ def demultiplex(csv, debug):
     """
     demultiplexes paired fastq files given 3' end barcodes
     """
-    setup_applevel_logger(file_name="demultiplex.log")
+    setup_logger(file_name="demultiplex.log")
     #return run.demultiplex(csv, debug)
 
 
@@ -47,17 +129,228 @@ def demultiplex(csv, debug):
 @click.argument("seq_path")
 @click.option("--hide-dreem-output", is_flag=True)
 def runmulti(csv, data_dir, hide_dreem_output, seq_path):
-    log = setup_applevel_logger(file_name="run_multi.log")
+    log = setup_logger(file_name="run_multi.log")
     log.info("creating processed/ all dreem runs will go here")
     log.info("creating analysis/ all finalized analysis will go here")
     #return run.runmulti(csv, data_dir, seq_path, hide_dreem_output)
 
 
+@cli.command()
+@click.argument("csv")
+@click.argument("fastq_dir")
+@click.option(
+    "-n", "--num-reads", default=10000, help="number of reads to sample"
+)
+@click.option("--max-workers", type=int, default=None)
+@click.option("--max-memory-gb", type=float, default=None)
+@click.option(
+    "--scratch-dir",
+    default=None,
+    help="directory the run will be written to, used to check free space",
+)
+@click.option(
+    "--coefficients-file",
+    default=None,
+    help="yaml file of benchmark coefficients to use instead of the defaults",
+)
+@click.option(
+    "--intermediate-codec",
+    default="none",
+    help="codec the demultiplexed fastqs are kept in",
+)
+def plan(
+    csv,
+    fastq_dir,
+    num_reads,
+    max_workers,
+    max_memory_gb,
+    scratch_dir,
+    coefficients_file,
+    intermediate_codec,
+):
+    """
+    estimates time, scratch disk and memory of a run without processing it
+    """
+    setup_logger()
+    coefficients = None
+    if coefficients_file is not None:
+        coefficients = load_coefficients(coefficients_file)
+    job_plan = plan_run(
+        pd.read_csv(csv),
+        get_paired_fastqs(fastq_dir),
+        num_reads=num_reads,
+        max_workers=max_workers,
+        max_memory_gb=max_memory_gb,
+        scratch_dir=scratch_dir,
+        coefficients=coefficients,
+        intermediate_codec=intermediate_codec,
+    )
+    job_plan.log()
+
+
+@cli.command()
+@click.argument("csv")
+@click.argument("fastq_dir")
+@click.option(
+    "-n",
+    "--num-reads",
+    type=int,
+    default=None,
+    help="only scan the first N reads, scans everything by default",
+)
+@click.option("-p", "--num-workers", default=1)
+@click.option(
+    "--max-distance",
+    default=2,
+    help="most mismatches for a read to count as a near match",
+)
+@click.option(
+    "--barcode-read", type=click.Choice(["read_1", "read_2"]), default="read_1"
+)
+@click.option("--barcode-start", default=0)
+@click.option("-o", "--output", default="census.csv")
+def census(
+    csv,
+    fastq_dir,
+    num_reads,
+    num_workers,
+    max_distance,
+    barcode_read,
+    barcode_start,
+    output,
+):
+    """
+    counts reads per barcode without writing any demultiplexed output
+    """
+    setup_logger()
+    result = barcode_census(
+        pd.read_csv(csv),
+        get_paired_fastqs(fastq_dir),
+        max_reads=num_reads,
+        num_workers=num_workers,
+        max_distance=max_distance,
+        barcode_read=barcode_read,
+        barcode_start=barcode_start,
+    )
+    result.log()
+    result.counts.to_csv(output, index=False)
+
+
+@cli.command()
+@click.option(
+    "--sizes",
+    default="10,100,1000,10000",
+    help="comma separated number of rows of each synthetic sample sheet",
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    help="seconds each stubbed rna_map call takes",
+)
+@click.option("--num-codes", default=10)
+@click.option("--repeats", default=1)
+@click.option(
+    "--work-dir",
+    default=None,
+    help="directory synthetic runs are created in, defaults to a temp dir",
+)
+@click.option("-o", "--output", default="benchmark.json")
+def benchmark(sizes, latency, num_codes, repeats, work_dir, output):
+    """
+    measures runmulti orchestration overhead with a stubbed rna_map
+    """
+    setup_logger()
+    report = benchmark_runmulti(
+        [int(s) for s in sizes.split(",")],
+        latency=latency,
+        num_codes=num_codes,
+        repeats=repeats,
+        work_dir=work_dir,
+    )
+    write_report(report, output)
+
+
+@cli.command()
+@click.argument("store")
+@click.argument("output_dir")
+@click.option(
+    "-b",
+    "--barcode",
+    "barcodes",
+    multiple=True,
+    help="barcode sequence to export, exports all barcodes by default",
+)
+def export_store(store, output_dir, barcodes):
+    """
+    recreates the BARCODE/ directories of a demultiplexed read store
+    """
+    setup_logger()
+    with ReadStore(store) as read_store:
+        read_store.export_all(output_dir, list(barcodes) or None)
+
+
+@cli.group()
+def daemon():
+    """
+    a warm worker daemon that export-store, plan and census are forwarded to
+    while it is running
+    """
+    pass
+
+
+@daemon.command(name="start")
+@click.option(
+    "--socket",
+    "socket_path",
+    default=None,
+    help="path of the unix socket, defaults to $RNA_MAP_TOOLS_SOCKET or "
+    "~/.rna_map_tools/daemon.sock",
+)
+@click.option("-p", "--num-workers", type=int, default=None)
+@click.option(
+    "--max-jobs-per-worker",
+    default=100,
+    help="jobs a worker process runs before it is replaced",
+)
+def daemon_start(socket_path, num_workers, max_jobs_per_worker):
+    """
+    runs the daemon in the foreground until it is stopped
+    """
+    setup_logger()
+    serve(socket_path, num_workers, max_jobs_per_worker)
+
+
+@daemon.command(name="stop")
+@click.option("--socket", "socket_path", default=None)
+def daemon_stop(socket_path):
+    """
+    stops the daemon once running jobs are finished
+    """
+    setup_logger()
+    if request({"type": "shutdown"}, socket_path) is None:
+        log.info("no daemon is running")
+
+
+@daemon.command(name="status")
+@click.option("--socket", "socket_path", default=None)
+def daemon_status(socket_path):
+    setup_logger()
+    responses = request({"type": "status"}, socket_path)
+    if responses is None:
+        log.info("no daemon is running")
+        return
+    status = responses[0]
+    log.info(
+        f"daemon {status['pid']} has {status['workers']} workers and "
+        f"{status['running']} running jobs"
+    )
+
+
 @cli.command()
 @click.argument("json_file")
 @click.argument("yml_file")
 def parsedata(json_file, yml_file):
-    setup_applevel_logger()
+    setup_logger()
     #return run.parsedata(json_file, yml_file)
 
 
@@ -71,7 +364,7 @@ def replot(pickle_file):
 @cli.command()
 @click.argument("csv")
 def analysis(csv):
-    setup_applevel_logger()
+    setup_logger()
     #return run.analysis(csv)
 
 
@@ -0,0 +1,232 @@
+"""
+handles compression of intermediate files. Supports uncompressed, gzip at
+the default and fast levels and zstd/lz4 if zstandard and lz4 are installed
+"""
+import io
+import os
+import gzip
+import shutil
+from typing import List
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("COMPRESSION")
+
+CODECS = ["none", "gzip", "gzip-fast", "zstd", "lz4"]
+
+CODEC_EXTENSIONS = {
+    "none": "",
+    "gzip": ".gz",
+    "gzip-fast": ".gz",
+    "zstd": ".zst",
+    "lz4": ".lz4",
+}
+
+COMPRESSED_EXTENSIONS = [".gz", ".zst", ".lz4"]
+
+# the first bytes of each compressed format
+MAGIC_NUMBERS = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+    b"\x04\x22\x4d\x18": "lz4",
+}
+
+GZIP_LEVELS = {"gzip": 9, "gzip-fast": 1}
+ZSTD_LEVEL = 1
+LZ4_LEVEL = 0
+
+
+def available_codecs() -> List[str]:
+    """
+    get the codecs that can be used in the current environment
+    :return: list of codec names
+    """
+    codecs = ["none", "gzip", "gzip-fast"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    return codecs
+
+
+def check_codec(codec: str) -> None:
+    """
+    checks that a codec is known and its library is installed
+    :param codec: name of the codec
+    :return: None
+    """
+    if codec not in CODECS:
+        raise ValueError(f"unknown codec {codec} must be one of {CODECS}")
+    if codec not in available_codecs():
+        raise ValueError(
+            f"codec {codec} is not available please install "
+            f"{'zstandard' if codec == 'zstd' else 'lz4'}"
+        )
+
+
+def is_compressed_path(path: str) -> bool:
+    """
+    checks if a path has the extension of a compressed file
+    :param path: path to the file
+    :return: True if the extension is a known compressed extension
+    """
+    return any(str(path).endswith(ext) for ext in COMPRESSED_EXTENSIONS)
+
+
+def strip_extension(path: str) -> str:
+    """
+    removes the compression extension from a path if it has one
+    :param path: path to the file
+    :return: the path without the compression extension
+    """
+    path = str(path)
+    for ext in COMPRESSED_EXTENSIONS:
+        if path.endswith(ext):
+            return path[: -len(ext)]
+    return path
+
+
+def detect_codec(path: str) -> str:
+    """
+    detects the codec of a file from its first bytes
+    :param path: path to the file
+    :return: name of the codec, gzip is returned for any gzip level
+    """
+    with open(path, "rb") as f:
+        start = f.read(4)
+    for magic, codec in MAGIC_NUMBERS.items():
+        if start.startswith(magic):
+            return codec
+    return "none"
+
+
+def open_file(path: str, mode: str = "rb", codec: str = None):
+    """
+    opens a possibly compressed file. When reading the codec is detected
+    automatically
+    :param path: path to the file
+    :param mode: any mode accepted by open ("rb", "rt", "wb", "wt", "ab" ...)
+    :param codec: the codec to write with, ignored when reading
+    :return: a file object
+    """
+    if "r" in mode:
+        codec = detect_codec(path)
+    elif codec is None:
+        codec = "none"
+    check_codec(codec)
+    if codec == "none":
+        if "t" in mode:
+            return open(path, mode.replace("t", ""), encoding="utf8")
+        return open(path, mode)
+    if codec in GZIP_LEVELS:
+        if "r" in mode:
+            return gzip.open(path, mode)
+        return gzip.open(path, mode, compresslevel=GZIP_LEVELS[codec])
+    if codec == "zstd":
+        if "r" in mode:
+            return zstandard.open(path, mode)
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return zstandard.open(path, mode, cctx=cctx)
+    return lz4.frame.open(path, mode, compression_level=LZ4_LEVEL)
+
+
+class _NonClosingWriter(io.RawIOBase):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._fileobj.write(b)
+
+
+def open_stream(fileobj, mode: str, codec: str):
+    """
+    compresses or decompresses through an already open binary file object,
+    used for blocks stored inside a larger file. Closing the returned stream
+    does not close fileobj
+    :param fileobj: a binary file object
+    :param mode: "rb" or "wb"
+    :param codec: the codec of the stream
+    :return: a binary file object
+    """
+    check_codec(codec)
+    if codec == "none":
+        if "r" in mode:
+            return io.BufferedReader(fileobj)
+        return _NonClosingWriter(fileobj)
+    if codec in GZIP_LEVELS:
+        if "r" in mode:
+            return gzip.GzipFile(fileobj=fileobj, mode="rb")
+        return gzip.GzipFile(
+            fileobj=fileobj, mode="wb", compresslevel=GZIP_LEVELS[codec]
+        )
+    if codec == "zstd":
+        if "r" in mode:
+            return zstandard.ZstdDecompressor().stream_reader(
+                fileobj, closefd=False
+            )
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return cctx.stream_writer(fileobj, closefd=False)
+    return lz4.frame.LZ4FrameFile(
+        fileobj, mode[0], compression_level=LZ4_LEVEL
+    )
+
+
+def compress_file(path: str, codec: str, remove: bool = True) -> str:
+    """
+    compresses a file with the given codec
+    :param path: path to the uncompressed file
+    :param codec: name of the codec
+    :param remove: remove the original file after compressing it
+    :return: path to the compressed file
+    """
+    if codec == "none":
+        return path
+    check_codec(codec)
+    compressed_path = path + CODEC_EXTENSIONS[codec]
+    with open(path, "rb") as f_in:
+        with open_file(compressed_path, "wb", codec) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    if remove:
+        os.remove(path)
+    return compressed_path
+
+
+def decompress_file(path: str, dest_path: str) -> None:
+    """
+    decompresses a file of any supported codec in a single streaming pass
+    :param path: path to the compressed file
+    :param dest_path: path to write the uncompressed file to
+    :return: None
+    """
+    with open_file(path, "rb") as f_in:
+        with open(dest_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+
+def compress_files(directory: str, codec: str) -> None:
+    """
+    compresses every uncompressed file in a directory
+    :param directory: directory to walk
+    :param codec: name of the codec
+    :return: None
+    """
+    if codec == "none":
+        return
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if is_compressed_path(file):
+                continue
+            compress_file(os.path.join(root, file), codec)
@@ -0,0 +1,466 @@
+"""
+an optional long lived local daemon that keeps the cli, pandas, rna_map and
+the parameter schema warm between invocations. Jobs are
+sent over a unix domain socket as one json line with the cli arguments,
+working directory and environment of the caller and run in a process pool.
+What the command writes to sys.stdout and sys.stderr in python, including
+its log, is streamed back. Programs it starts with os.system or subprocess
+write to the terminal of the daemon instead, which is why download, whose
+progress comes from the bs tool, is not forwarded. When no daemon is running
+the cli runs in the calling process as before.
+
+protocol, one json object per line:
+--client: {"type": "job", "args": [...], "cwd": ..., "env": {...}}
+          {"type": "status"} or {"type": "shutdown"}
+--daemon: {"type": "output", "text": ...} any number of times then
+          {"type": "exit", "code": ...}
+
+this module only imports the standard library at the top so forwarding a
+job does not pay for the imports the daemon keeps warm
+"""
+import os
+import sys
+import json
+import queue
+import socket
+import threading
+import traceback
+import socketserver
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("DAEMON")
+
+# commands that are forwarded to a running daemon
+DAEMON_COMMANDS = ["export-store", "plan", "census"]
+# options of the cli group that take a value, the command follows them
+GROUP_VALUE_OPTIONS = ["--log-file", "--rate-limit", "--artifact-dir"]
+# set to run every command in the calling process
+NO_DAEMON_ENV = "RNA_MAP_TOOLS_NO_DAEMON"
+SOCKET_ENV = "RNA_MAP_TOOLS_SOCKET"
+
+
+def get_socket_path() -> str:
+    """
+    :return: $RNA_MAP_TOOLS_SOCKET or ~/.rna_map_tools/daemon.sock
+    """
+    path = os.getenv(SOCKET_ENV)
+    if path is None:
+        path = os.path.join(
+            os.path.expanduser("~"), ".rna_map_tools", "daemon.sock"
+        )
+    return path
+
+
+def _send(sock: socket.socket, data: Dict) -> None:
+    sock.sendall(json.dumps(data).encode() + b"\n")
+
+
+def _connect(socket_path: str) -> Optional[socket.socket]:
+    """
+    :return: a socket connected to the daemon, None if none is running
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # left behind by a daemon that did not shut down cleanly
+        sock.close()
+        return None
+    return sock
+
+
+def request(data: Dict, socket_path: str = None) -> Optional[List[Dict]]:
+    """
+    sends a status or shutdown request
+    :param data: the request
+    :param socket_path: defaults to get_socket_path()
+    :return: the responses, None if no daemon is running
+    """
+    sock = _connect(socket_path or get_socket_path())
+    if sock is None:
+        return None
+    with sock, sock.makefile("rb") as f:
+        _send(sock, data)
+        return [json.loads(line) for line in f]
+
+
+def forward(
+    args: List[str], socket_path: str = None, out=None
+) -> Optional[int]:
+    """
+    runs a cli command in the daemon and streams its output
+    :param args: cli arguments, without the program name
+    :param socket_path: defaults to get_socket_path()
+    :param out: where output is written, defaults to sys.stdout
+    :return: exit code of the command, None if no daemon is running
+    """
+    sock = _connect(socket_path or get_socket_path())
+    if sock is None:
+        return None
+    out = out or sys.stdout
+    with sock, sock.makefile("rb") as f:
+        _send(
+            sock,
+            {
+                "type": "job",
+                "args": list(args),
+                "cwd": os.getcwd(),
+                "env": dict(os.environ),
+            },
+        )
+        for line in f:
+            msg = json.loads(line)
+            if msg["type"] == "output":
+                out.write(msg["text"])
+                out.flush()
+            elif msg["type"] == "exit":
+                return msg["code"]
+    sys.stderr.write("lost connection to the rna_map_tools daemon\n")
+    return 1
+
+
+def get_command(args: List[str]) -> Optional[str]:
+    """
+    :param args: cli arguments, without the program name
+    :return: the command after any options of the cli group
+    """
+    i = 0
+    while i < len(args):
+        if not args[i].startswith("-"):
+            return args[i]
+        i += 2 if args[i] in GROUP_VALUE_OPTIONS else 1
+    return None
+
+
+def main() -> None:
+    """
+    entry point of the rna-map-tools command. Forwards the commands in
+    DAEMON_COMMANDS to a running daemon and runs everything else in process
+    """
+    args = sys.argv[1:]
+    if (
+        get_command(args) in DAEMON_COMMANDS
+        and os.getenv(NO_DAEMON_ENV) is None
+    ):
+        code = forward(args)
+        if code is not None:
+            sys.exit(code)
+    from rna_map_tools.cli import cli
+
+    cli()
+
+
+# worker ######################################################################
+
+
+class _QueueStream:
+    """
+    stands in for stdout/stderr in a worker, text is sent to the daemon
+    tagged with the id of the job that is running
+    """
+
+    def __init__(self, results):
+        self._results = results
+        self.job_id = None
+
+    def send(self, msg: Dict) -> None:
+        self._results.put((self.job_id, msg))
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            # click writes bytes to streams it cannot find a buffer for
+            text = text.decode("utf8", "replace")
+        if text and self.job_id is not None:
+            self.send({"type": "output", "text": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+_stream = None
+
+
+def _init_worker(results) -> None:
+    """
+    routes output to the daemon and does the imports and loading every job
+    would otherwise repeat
+    """
+    global _stream
+    _stream = _QueueStream(results)
+    sys.stdout = _stream
+    sys.stderr = _stream
+    # importing the cli imports pandas and rna_map
+    from rna_map_tools.cli import cli  # noqa: F401
+    from rna_map_tools.parameters import get_default_params
+
+    get_default_params()
+
+
+def _exit_code(e: SystemExit) -> int:
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code)
+    return 1
+
+
+def _run_job(job_id: int, args: List[str], cwd: str, env: Dict) -> None:
+    """
+    runs one cli command in the working directory and environment of the
+    caller, both are restored afterwards
+    """
+    import click
+
+    from rna_map_tools.cli import cli
+    from rna_map_tools.logger import stop_queue_logging
+
+    _stream.job_id = job_id
+    old_cwd = os.getcwd()
+    old_env = dict(os.environ)
+    try:
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(cwd)
+        cli.main(args=args, prog_name="rna-map-tools", standalone_mode=False)
+        code = 0
+    except click.exceptions.Exit as e:
+        code = e.exit_code
+    except click.ClickException as e:
+        e.show(file=_stream)
+        code = e.exit_code
+    except click.exceptions.Abort:
+        code = 1
+    except SystemExit as e:
+        code = _exit_code(e)
+    except Exception:
+        traceback.print_exc(file=_stream)
+        code = 1
+    finally:
+        stop_queue_logging()
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_env)
+    # sent from the worker so it always arrives after the job's output
+    _stream.send({"type": "exit", "code": code})
+    _stream.job_id = None
+
+
+# daemon ######################################################################
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        msg = json.loads(line)
+        if msg["type"] == "status":
+            self._write(self.server.daemon.status())
+        elif msg["type"] == "shutdown":
+            self._write({"type": "shutdown"})
+            threading.Thread(target=self.server.shutdown).start()
+        elif msg["type"] == "job":
+            for response in self.server.daemon.submit(msg):
+                self._write(response)
+        else:
+            self._write({"type": "error", "text": f"unknown request {msg}"})
+
+    def _write(self, data):
+        try:
+            _send(self.connection, data)
+        except OSError:
+            # the client went away, the job keeps running
+            pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """
+    a process pool of warm workers serving jobs over a unix socket. A worker
+    that dies, by a crash, the oom killer or os._exit, breaks the pool: its
+    jobs and any other running jobs exit with code 1 and a new pool is
+    started
+    :param socket_path: path of the unix socket
+    :param num_workers: number of worker processes, defaults to the cpu count
+    :param max_jobs_per_worker: workers are replaced after this many jobs so
+    state leaked by a job does not build up
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        num_workers: int = None,
+        max_jobs_per_worker: int = 100,
+    ):
+        if _connect(socket_path) is not None:
+            raise RuntimeError(f"a daemon is already running on {socket_path}")
+        self.socket_path = socket_path
+        self.num_workers = num_workers or os.cpu_count()
+        self.max_jobs_per_worker = max_jobs_per_worker
+        # replacing workers after max_jobs_per_worker needs spawn
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._executor = self._new_executor()
+        self._jobs = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            self.num_workers,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self._results,),
+            max_tasks_per_child=self.max_jobs_per_worker,
+        )
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> None:
+        """
+        starts a new pool if broken is still the current one
+        """
+        with self._lock:
+            if self._executor is not broken:
+                return
+            log.warning("a worker died, starting new workers")
+            self._executor = self._new_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, job_id: int, msg: Dict):
+        """
+        :return: the pool the job was submitted to and its future
+        """
+        args = (job_id, msg["args"], msg["cwd"], msg["env"])
+        with self._lock:
+            executor = self._executor
+        try:
+            return executor, executor.submit(_run_job, *args)
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+        with self._lock:
+            executor = self._executor
+        return executor, executor.submit(_run_job, *args)
+
+    def _dispatch(self) -> None:
+        """
+        hands messages from the workers to the connection of their job
+        """
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            job_id, msg = item
+            with self._lock:
+                job_queue = self._jobs.get(job_id)
+            if job_queue is not None:
+                job_queue.put(msg)
+
+    def submit(self, msg: Dict):
+        """
+        runs a job in the pool
+        :param msg: a job request
+        :return: iterator of the messages of the job, ends with its exit
+        """
+        job_queue = queue.Queue()
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = job_queue
+        log.info(f"job {job_id}: {' '.join(msg['args'])} in {msg['cwd']}")
+
+        executor, future = self._submit(job_id, msg)
+
+        def on_done(future):
+            e = future.exception()
+            if e is None:
+                # the worker sent the exit code itself
+                return
+            # the worker died before it could report the exit code
+            text = "".join(traceback.format_exception(type(e), e, None))
+            job_queue.put({"type": "output", "text": text})
+            job_queue.put({"type": "exit", "code": 1})
+            if isinstance(e, BrokenProcessPool):
+                self._replace_executor(executor)
+
+        future.add_done_callback(on_done)
+        try:
+            while True:
+                response = job_queue.get()
+                yield response
+                if response["type"] == "exit":
+                    log.info(f"job {job_id}: exit code {response['code']}")
+                    return
+        finally:
+            with self._lock:
+                del self._jobs[job_id]
+
+    def status(self) -> Dict:
+        with self._lock:
+            running = len(self._jobs)
+        return {
+            "type": "status",
+            "pid": os.getpid(),
+            "workers": self.num_workers,
+            "running": running,
+        }
+
+    def serve_forever(self) -> None:
+        """
+        serves jobs until a shutdown request is received
+        """
+        os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = _Server(self.socket_path, _Handler)
+        server.daemon = self
+        log.info(
+            f"serving on {self.socket_path} with {self.num_workers} workers"
+        )
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+            self.close()
+            log.info("daemon stopped")
+
+    def close(self) -> None:
+        with self._lock:
+            executor = self._executor
+        executor.shutdown(wait=True)
+        self._results.put(None)
+        self._dispatcher.join()
+
+
+def serve(
+    socket_path: str = None,
+    num_workers: int = None,
+    max_jobs_per_worker: int = 100,
+) -> None:
+    """
+    starts a daemon and serves until it is stopped
+    :param socket_path: defaults to get_socket_path()
+    :param num_workers: number of worker processes, defaults to the cpu count
+    :param max_jobs_per_worker: jobs a worker runs before it is replaced
+    :return: None
+    """
+    daemon = Daemon(
+        socket_path or get_socket_path(), num_workers, max_jobs_per_worker
+    )
+    daemon.serve_forever()
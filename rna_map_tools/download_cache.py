@@ -0,0 +1,233 @@
+"""
+content addressed cache for basespace downloads. Files are stored once by
+their sha256 and each downloaded run/project has a manifest of the files it
+contained. Repeat downloads are hardlinked (or reflinked) out of the cache
+instead of being fetched again.
+
+cache layout:
+--CACHE_PATH/
+  |--objects/ab/abcdef...  file contents named by sha256, mtime is last use
+  |--manifests/RUN.json   relative path, sha256 and size of each file
+
+objects are read only. Runs are hardlinked to them so a run file shares its
+inode with the cache and editing it in place would corrupt the cache.
+"""
+import os
+import json
+import stat
+import time
+import shutil
+import hashlib
+from typing import Optional
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("DOWNLOAD-CACHE")
+
+# linux ioctl to share the blocks of one file with another (btrfs/xfs)
+FICLONE = 0x40049409
+
+
+def file_checksum(path: str) -> str:
+    """
+    computes the sha256 of a file
+    :param path: path to the file
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _reflink(src: str, dest: str) -> bool:
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        return False
+    try:
+        with open(src, "rb") as f_src, open(dest, "wb") as f_dest:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+    return True
+
+
+def link_or_copy(src: str, dest: str) -> str:
+    """
+    hardlinks src to dest, falls back to a reflink and then a copy when src
+    and dest are on different filesystems
+    :param src: existing file
+    :param dest: path to create
+    :return: how the file was created, link, reflink or copy
+    """
+    try:
+        os.link(src, dest)
+        return "link"
+    except OSError:
+        pass
+    if _reflink(src, dest):
+        return "reflink"
+    shutil.copy2(src, dest)
+    return "copy"
+
+
+class DownloadCache:
+    """
+    a local cache of downloaded runs
+    """
+
+    def __init__(self, path: str, max_size_gb: float = None):
+        self.path = os.path.abspath(path)
+        self.max_size_gb = max_size_gb
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.path, "manifests"), exist_ok=True)
+
+    def _object_path(self, checksum: str) -> str:
+        return os.path.join(self.path, "objects", checksum[:2], checksum)
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.path, "manifests", f"{key}.json")
+
+    def get_manifest(self, key: str) -> Optional[dict]:
+        """
+        :param key: name of the run/project
+        :return: the manifest of the run or None if it is not cached
+        """
+        path = self._manifest_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf8") as f:
+            return json.load(f)
+
+    def has(self, key: str) -> bool:
+        """
+        checks that a run and all of its files are in the cache
+        :param key: name of the run/project
+        :return: True if the run can be restored from the cache
+        """
+        manifest = self.get_manifest(key)
+        if manifest is None or len(manifest.get("files", [])) == 0:
+            return False
+        for f in manifest["files"]:
+            obj_path = self._object_path(f["sha256"])
+            if not os.path.exists(obj_path):
+                return False
+            if os.path.getsize(obj_path) != f["size"]:
+                return False
+        return True
+
+    def store(self, key: str, directory: str) -> dict:
+        """
+        adds every file in a downloaded directory to the cache
+        :param key: name of the run/project
+        :param directory: directory the run was downloaded into
+        :return: the manifest of the run
+        """
+        if not any(len(fnames) > 0 for _, _, fnames in os.walk(directory)):
+            raise ValueError(f"{directory} has no files to add to the cache")
+        files = []
+        for root, _, fnames in os.walk(directory):
+            for fname in sorted(fnames):
+                path = os.path.join(root, fname)
+                checksum = file_checksum(path)
+                obj_path = self._object_path(checksum)
+                if not os.path.exists(obj_path):
+                    os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+                    tmp_path = f"{obj_path}.{os.getpid()}.tmp"
+                    link_or_copy(path, tmp_path)
+                    mode = os.stat(tmp_path).st_mode
+                    os.chmod(
+                        tmp_path,
+                        mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH),
+                    )
+                    os.replace(tmp_path, obj_path)
+                files.append(
+                    {
+                        "path": os.path.relpath(path, directory),
+                        "sha256": checksum,
+                        "size": os.path.getsize(path),
+                    }
+                )
+        manifest = {"key": key, "created": time.time(), "files": files}
+        tmp_path = f"{self._manifest_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path(key))
+        log.info(f"stored {len(files)} files for {key} in {self.path}")
+        return manifest
+
+    def materialize(self, key: str, directory: str) -> None:
+        """
+        recreates a cached run in a directory
+        :param key: name of the run/project
+        :param directory: directory to recreate the run in
+        :return: None
+        """
+        manifest = self.get_manifest(key)
+        if manifest is None:
+            raise ValueError(f"{key} is not in the download cache")
+        methods = {}
+        for f in manifest["files"]:
+            obj_path = self._object_path(f["sha256"])
+            dest = os.path.join(directory, f["path"])
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            method = link_or_copy(obj_path, dest)
+            methods[method] = methods.get(method, 0) + 1
+            # mtime of objects records when they were last used, in a shared
+            # cache only the owner of an object can update it
+            try:
+                os.utime(obj_path)
+            except PermissionError:
+                log.debug(f"cannot update last use of {obj_path} not owner")
+        log.info(f"restored {key} from the download cache {methods}")
+
+    def size(self) -> int:
+        """
+        :return: total size of all cached objects in bytes
+        """
+        total = 0
+        for root, _, fnames in os.walk(os.path.join(self.path, "objects")):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in fnames)
+        return total
+
+    def evict(self, max_size_gb: float = None) -> int:
+        """
+        removes the least recently used objects until the cache is under
+        max_size_gb and drops manifests that are no longer complete
+        :param max_size_gb: defaults to the size given to the constructor
+        :return: number of objects removed
+        """
+        if max_size_gb is None:
+            max_size_gb = self.max_size_gb
+        if max_size_gb is None:
+            return 0
+        objects = []
+        for root, _, fnames in os.walk(os.path.join(self.path, "objects")):
+            for fname in fnames:
+                st = os.stat(os.path.join(root, fname))
+                objects.append((st.st_mtime, st.st_size, os.path.join(root, fname)))
+        total = sum(o[1] for o in objects)
+        max_size = max_size_gb * 1e9
+        count = 0
+        for _, obj_size, path in sorted(objects):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except PermissionError:
+                log.warning(f"cannot evict {path} from a shared cache")
+                continue
+            total -= obj_size
+            count += 1
+        if count == 0:
+            return 0
+        for fname in os.listdir(os.path.join(self.path, "manifests")):
+            key = fname[:-5]
+            if fname.endswith(".json") and not self.has(key):
+                os.remove(self._manifest_path(key))
+        log.info(f"evicted {count} files from the download cache")
+        return count
@@ -1,6 +1,22 @@
 import os
 import glob
+import shutil
 from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from rna_map_tools.compression import (
+    CODEC_EXTENSIONS,
+    check_codec,
+    detect_codec,
+    is_compressed_path,
+    open_file,
+)
+from rna_map_tools.mmap_fastq import MappedFastq
+
+# a directory is rewritten into DIR.new, the old pair is kept in DIR.old
+# until the rewrite is committed
+REWRITE_NEW = ".new"
+REWRITE_OLD = ".old"
 
 
 @dataclass(frozen=True, order=True)
@@ -27,9 +43,13 @@ class FastqFile:
         """
         Check if the file is compressed
         """
-        if self.path.endswith(".gz"):
-            return True
-        return False
+        return is_compressed_path(self.path)
+
+    def codec(self):
+        """
+        Get the codec the file is compressed with detected from its contents
+        """
+        return detect_codec(self.path)
 
     def is_r1(self):
         """
@@ -85,3 +105,157 @@ def get_paired_fastqs(dir_path: str) -> PairedFastqFiles:
     if len(f1_paths) > 1 or len(f2_paths) > 1:
         raise ValueError(f"Found more than one fastq file in {dir_path}")
     return PairedFastqFiles(FastqFile(f1_paths[0]), FastqFile(f2_paths[0]))
+
+
+def validate_fastq_file(path: str, full: bool = False) -> bool:
+    """
+    Check that the first record of a fastq file is valid, works for any
+    supported compression codec
+    :path: path to fastq file
+    :full: check every record of uncompressed files using a memory map
+    :return: True if the first record is valid
+    """
+    if full and not is_compressed_path(path):
+        with MappedFastq(path) as mfq:
+            return mfq.validate()
+    try:
+        with open_file(path, "rt") as f:
+            lines = [f.readline().rstrip("\n") for _ in range(4)]
+    except (OSError, EOFError):
+        return False
+    return is_valid_record(lines)
+
+
+def is_valid_record(lines) -> bool:
+    """
+    Check the four lines of a fastq record
+    :lines: the lines of the record without newlines
+    :return: True if the record is valid
+    """
+    if not lines[0].startswith("@"):
+        return False
+    if not lines[2].startswith("+"):
+        return False
+    if len(lines[1]) == 0 or len(lines[1]) != len(lines[3]):
+        return False
+    return True
+
+
+def read_fastq_pairs(path_1: str, path_2: str) -> Iterator[Tuple]:
+    """
+    streams the records of a pair of fastqs together
+    :path_1: path to the read 1 fastq, any supported codec
+    :path_2: path to the read 2 fastq, any supported codec
+    :return: iterator of (read 1, read 2) records, each record is a tuple of
+    its four lines without newlines
+    """
+    with open_file(path_1, "rb") as f_1, open_file(path_2, "rb") as f_2:
+        while True:
+            records = []
+            for f in [f_1, f_2]:
+                lines = [f.readline() for _ in range(4)]
+                if not lines[0]:
+                    records.append(None)
+                    continue
+                records.append(tuple(l.rstrip(b"\r\n") for l in lines))
+            if records[0] is None or records[1] is None:
+                if records[0] is not records[1]:
+                    raise ValueError(
+                        f"{path_1} and {path_2} have a different number of "
+                        f"records"
+                    )
+                return
+            yield records[0], records[1]
+
+
+def write_fastq_pairs(
+    pairs: Iterable[Tuple], path_1: str, path_2: str, codec: str = "none"
+) -> int:
+    """
+    writes pairs of records from read_fastq_pairs
+    :pairs: iterable of (read 1, read 2) records
+    :path_1: path to write read 1 to
+    :path_2: path to write read 2 to
+    :codec: codec to compress the fastqs with
+    :return: number of pairs written
+    """
+    count = 0
+    with open_file(path_1, "wb", codec) as f_1, open_file(
+        path_2, "wb", codec
+    ) as f_2:
+        for record_1, record_2 in pairs:
+            f_1.write(b"\n".join(record_1) + b"\n")
+            f_2.write(b"\n".join(record_2) + b"\n")
+            count += 1
+    return count
+
+
+def get_read_fastq(directory: str, read: str) -> str:
+    """
+    :directory: directory with a test_S1_L001_R{1,2}_001.fastq pair, any
+    supported codec
+    :read: R1 or R2
+    :return: path to the fastq of the read, temporary files are ignored
+    """
+    fnames = [
+        f
+        for f in os.listdir(directory)
+        if f.startswith(f"test_S1_L001_{read}_001.fastq")
+        and not f.endswith(".tmp")
+    ]
+    if len(fnames) != 1:
+        raise ValueError(f"expected one {read} fastq in {directory}")
+    return os.path.join(directory, fnames[0])
+
+
+def recover_fastq_dir(directory: str) -> None:
+    """
+    undoes a rewrite of directory that was not committed, the pair it was
+    rewritten from is put back
+    :directory: directory given to rewrite_fastq_dir
+    :return: None
+    """
+    shutil.rmtree(directory + REWRITE_NEW, ignore_errors=True)
+    old = directory + REWRITE_OLD
+    if os.path.isdir(old):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(old, directory)
+
+
+def rewrite_fastq_dir(
+    directory: str,
+    codec: str,
+    transform: Callable[[Iterator], Iterable],
+    commit: Optional[Callable[[], None]] = None,
+) -> int:
+    """
+    rewrites the test_S1_L001_R{1,2}_001.fastq pair of a directory in a
+    single streaming pass. The new pair is written to DIR.new and swapped in
+    by renaming, the old pair is only removed once commit returned. If the
+    process dies before then the next call starts again from the old pair
+    :directory: directory with the pair, any supported codec
+    :codec: codec to write the new pair with
+    :transform: takes and returns an iterable of (read 1, read 2) records
+    :commit: called once the new pair is in place, records that it is done
+    :return: number of pairs written
+    """
+    check_codec(codec)
+    recover_fastq_dir(directory)
+    paths_in = [get_read_fastq(directory, read) for read in ["R1", "R2"]]
+    new_dir = directory + REWRITE_NEW
+    os.makedirs(new_dir)
+    paths_out = [
+        os.path.join(
+            new_dir, f"test_S1_L001_{read}_001.fastq{CODEC_EXTENSIONS[codec]}"
+        )
+        for read in ["R1", "R2"]
+    ]
+    count = write_fastq_pairs(
+        transform(read_fastq_pairs(*paths_in)), *paths_out, codec
+    )
+    os.rename(directory, directory + REWRITE_OLD)
+    os.rename(new_dir, directory)
+    if commit is not None:
+        commit()
+    shutil.rmtree(directory + REWRITE_OLD)
+    return count
@@ -2,41 +2,250 @@
 logging module for rna_map_tools
 """
 
-import logging
+import os
 import sys
+import json
+import atexit
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 
 # logging #####################################################################
 
 APP_LOGGER_NAME = "RNA-MAP-TOOLS"
 
+# messages longer than this are written to their own file when an artifact
+# directory is set
+MAX_MESSAGE_LENGTH = 2000
+# number of times a repeated warning is shown before it is suppressed
+RATE_LIMIT = 5
+
+_listener = None
+_log_queue = None
+_queue_logger_name = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    formats each record as a single json line
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "artifact_path", None):
+            data["artifact"] = record.artifact_path
+        return json.dumps(data)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    drops repeats of the same warning after limit occurrences. Records are
+    grouped by their rate_key extra, or by their unformatted message
+    """
+
+    def __init__(self, limit=RATE_LIMIT):
+        super().__init__()
+        self.limit = limit
+        self.counts = {}
+
+    def filter(self, record):
+        # the same record passes through every handler, only count it once
+        if hasattr(record, "rate_limit_keep"):
+            return record.rate_limit_keep
+        key = getattr(record, "rate_key", None)
+        if key is None and record.levelno < logging.WARNING:
+            record.rate_limit_keep = True
+            return True
+        if key is None:
+            key = record.msg
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        record.rate_limit_keep = count <= self.limit
+        if count == self.limit:
+            record.msg = (
+                f"{record.getMessage()} (further messages like this are "
+                f"suppressed)"
+            )
+            record.args = None
+        return record.rate_limit_keep
+
+    def suppressed(self):
+        """
+        :return: dictionary of key to number of suppressed messages
+        """
+        return {
+            k: v - self.limit for k, v in self.counts.items() if v > self.limit
+        }
+
+
+class ArtifactFilter(logging.Filter):
+    """
+    writes large messages, such as program output and tables, to their own
+    file in artifact_dir and replaces them with a pointer to that file
+    """
+
+    def __init__(self, artifact_dir, max_length=MAX_MESSAGE_LENGTH):
+        super().__init__()
+        self.artifact_dir = artifact_dir
+        self.max_length = max_length
+        self.count = 0
+        os.makedirs(artifact_dir, exist_ok=True)
+
+    def filter(self, record):
+        if hasattr(record, "artifact_path"):
+            return True
+        record.artifact_path = None
+        msg = record.getMessage()
+        name = getattr(record, "artifact", None)
+        if len(msg) <= self.max_length and name is None:
+            return True
+        self.count += 1
+        if name is None:
+            name = record.name.split(".")[-1].lower()
+        path = os.path.join(self.artifact_dir, f"{self.count:04d}_{name}.log")
+        with open(path, "w", encoding="utf8") as f:
+            f.write(msg)
+        record.msg = f"{msg.split(chr(10))[0]} (full output in {path})"
+        record.args = None
+        record.artifact_path = path
+        return True
+
+
+def _close_handlers(logger):
+    """
+    Remove and close every handler of a logger so log files are not left open
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
 
 def setup_applevel_logger(logger_name=APP_LOGGER_NAME, is_debug=False,
-                          file_name=None):
+                          file_name=None, use_queue=False, json_lines=False,
+                          artifact_dir=None, rate_limit=None):
     """
     Set up the logger for the app
+    :param logger_name: name of the app logger
+    :param is_debug: log debug messages
+    :param file_name: also log to this file
+    :param use_queue: hand records to a background thread through a
+    multiprocessing queue so logging never blocks the caller. Worker processes
+    started with fork log through the same queue, others must call
+    setup_worker_logger with get_log_queue()
+    :param json_lines: write the log file as one json object per line
+    :param artifact_dir: write large messages to files in this directory
+    :param rate_limit: show repeated warnings at most this many times
     """
+    stop_queue_logging()
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG if is_debug else logging.INFO)
 
     formatter = logging.Formatter(
             "%(name)s - %(levelname)s - %(message)s"
     )
+    filters = []
+    if rate_limit is not None:
+        filters.append(RateLimitFilter(rate_limit))
+    if artifact_dir is not None:
+        filters.append(ArtifactFilter(artifact_dir))
 
     # pylint: disable=C0103
     sh = logging.StreamHandler(sys.stdout)
     sh.setFormatter(formatter)
-    logger.handlers.clear()
-    logger.addHandler(sh)
+    handlers = [sh]
 
     if file_name:
         # pylint: disable=C0103
         fh = logging.FileHandler(file_name)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        fh.setFormatter(JsonFormatter() if json_lines else formatter)
+        handlers.append(fh)
+
+    for handler in handlers:
+        for f in filters:
+            handler.addFilter(f)
+
+    _close_handlers(logger)
+    if use_queue:
+        global _listener, _log_queue, _queue_logger_name
+        _queue_logger_name = logger_name
+        _log_queue = multiprocessing.Queue(-1)
+        _listener = QueueListener(
+            _log_queue, *handlers, respect_handler_level=True
+        )
+        _listener.start()
+        logger.addHandler(QueueHandler(_log_queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+    return logger
+
+
+def get_log_queue():
+    """
+    Get the queue used by queue based logging, None if it is not in use
+    """
+    return _log_queue
 
+
+def setup_worker_logger(log_queue, logger_name=APP_LOGGER_NAME,
+                        is_debug=False):
+    """
+    Set up logging in a worker process to send records to the main process
+    """
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(logging.DEBUG if is_debug else logging.INFO)
+    _close_handlers(logger)
+    logger.addHandler(QueueHandler(log_queue))
     return logger
 
 
+def stop_queue_logging():
+    """
+    Flush and stop the background logging thread if one is running. The
+    handlers it fed are attached to the logger directly again so later
+    records are still written
+    """
+    global _listener, _log_queue, _queue_logger_name
+    if _listener is None:
+        return
+    _listener.stop()
+    logger = logging.getLogger(_queue_logger_name)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler) and handler.queue is _log_queue:
+            logger.removeHandler(handler)
+    for handler in _listener.handlers:
+        for f in handler.filters:
+            if isinstance(f, RateLimitFilter):
+                for key, count in f.suppressed().items():
+                    handler.handle(
+                        logging.makeLogRecord(
+                            {
+                                "name": APP_LOGGER_NAME,
+                                "levelno": logging.WARNING,
+                                "levelname": "WARNING",
+                                "msg": f"suppressed {count} more messages "
+                                f"like: {key}",
+                                "rate_limit_keep": True,
+                            }
+                        )
+                    )
+        handler.flush()
+        logger.addHandler(handler)
+    _listener = None
+    _log_queue = None
+    _queue_logger_name = None
+
+
+atexit.register(stop_queue_logging)
+
+
 def get_logger(module_name):
     """
     Get the logger for the module
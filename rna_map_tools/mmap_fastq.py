@@ -0,0 +1,264 @@
+"""
+zero copy reader for uncompressed fastq files. The file is memory mapped read
+only and scanned for record boundaries in fixed size chunks, so only one
+offset per record is kept in memory. Sequences and qualities are returned as
+views into the mapped buffer. Processes that open the same file share its
+pages through the page cache.
+"""
+import os
+import mmap
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from rna_map_tools.compression import is_compressed_path
+
+NEWLINE = ord("\n")
+CR = ord("\r")
+# bytes searched for newlines at a time
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class MappedFastq:
+    """
+    a memory mapped uncompressed fastq file
+    """
+
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE):
+        if is_compressed_path(path):
+            raise ValueError(f"{path} is compressed, cannot memory map it")
+        self.path = path
+        self.chunk_size = chunk_size
+        self._open()
+
+    def _open(self) -> None:
+        self._file = open(self.path, "rb")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._mmap = None
+            self._view = memoryview(b"")
+        else:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            self._view = memoryview(self._mmap)
+        self.buffer = np.frombuffer(self._view, dtype=np.uint8)
+        dtype = np.uint32 if len(self.buffer) < 2**32 else np.uint64
+        record_starts = []
+        records_end = 0
+        self.num_lines = 0
+        for starts, ends in self._scan():
+            self.num_lines += len(starts)
+            num = len(starts) - len(starts) % 4
+            if num == 0:
+                continue
+            record_starts.append(starts[0:num:4].astype(dtype))
+            records_end = int(ends[num - 1])
+        # one past the final newline of the last complete record
+        for char in (CR, NEWLINE):
+            if (
+                records_end < len(self.buffer)
+                and self.buffer[records_end] == char
+            ):
+                records_end += 1
+        record_starts.append(np.array([records_end], dtype=dtype))
+        # start of every record and the end of the last one
+        self.record_starts = np.concatenate(record_starts)
+
+    def _scan(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        finds the lines of the file chunk by chunk. Every chunk but the last
+        ends on a record boundary so the lines of a record are never split
+        :return: iterator of the start and end offsets of the lines in each
+        chunk, ends exclude the newline and a windows carriage return
+        """
+        n = len(self.buffer)
+        pos = 0
+        chunk_size = self.chunk_size
+        while pos < n:
+            end = min(pos + chunk_size, n)
+            nl = np.flatnonzero(self.buffer[pos:end] == NEWLINE) + pos
+            if end == n:
+                # a last line without a newline still counts
+                if len(nl) == 0 or nl[-1] != n - 1:
+                    nl = np.append(nl, n)
+            else:
+                nl = nl[: len(nl) - len(nl) % 4]
+                if len(nl) == 0:
+                    # a record longer than the chunk
+                    chunk_size *= 2
+                    continue
+            starts = np.empty_like(nl)
+            starts[0] = pos
+            starts[1:] = nl[:-1] + 1
+            has_cr = (nl > starts) & (
+                self.buffer[np.maximum(nl - 1, 0)] == CR
+            )
+            yield starts, nl - has_cr
+            pos = int(nl[-1]) + 1
+
+    def _record_lines(self, i: int) -> List[Tuple[int, int]]:
+        """
+        :param i: record index
+        :return: start and end offsets of the 4 lines of record i
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"record {i} out of range")
+        start = int(self.record_starts[i])
+        end = int(self.record_starts[i + 1])
+        nl = np.flatnonzero(self.buffer[start:end] == NEWLINE)[:4] + start
+        nl = list(nl) + [end] * (4 - len(nl))
+        lines = []
+        for line_end in nl:
+            line_end = int(line_end)
+            stop = line_end
+            if stop > start and self.buffer[stop - 1] == CR:
+                stop -= 1
+            lines.append((start, stop))
+            start = line_end + 1
+        return lines
+
+    def close(self) -> None:
+        """
+        unmaps the file, all views returned earlier must be released first
+        """
+        self.buffer = None
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # workers reopen the file by path which shares the page cache
+        return {"path": self.path, "chunk_size": self.chunk_size}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.chunk_size = state["chunk_size"]
+        self._open()
+
+    def __len__(self):
+        return len(self.record_starts) - 1
+
+    def _line(self, i: int, line: int) -> memoryview:
+        start, end = self._record_lines(i)[line]
+        return self._view[start:end]
+
+    def name(self, i: int) -> memoryview:
+        """
+        :param i: record index
+        :return: the header line of record i without the @
+        """
+        start, end = self._record_lines(i)[0]
+        return self._view[start + 1 : end]
+
+    def sequence(self, i: int) -> memoryview:
+        """
+        :param i: record index
+        :return: view of the sequence of record i
+        """
+        return self._line(i, 1)
+
+    def quality(self, i: int) -> memoryview:
+        """
+        :param i: record index
+        :return: view of the quality string of record i
+        """
+        return self._line(i, 3)
+
+    def sequences(self) -> Iterator[memoryview]:
+        for i in range(len(self)):
+            yield self.sequence(i)
+
+    def _record_chunks(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :return: iterator of line starts and ends of the complete records in
+        each chunk
+        """
+        for starts, ends in self._scan():
+            num = len(starts) - len(starts) % 4
+            if num > 0:
+                yield starts[:num], ends[:num]
+
+    def sequence_lengths(self) -> np.ndarray:
+        """
+        :return: length of every sequence
+        """
+        lengths = [
+            ends[1::4] - starts[1::4]
+            for starts, ends in self._record_chunks()
+        ]
+        if len(lengths) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(lengths)
+
+    def record_bounds(self, i: int):
+        """
+        :param i: record index
+        :return: start and end byte offsets of record i including its final
+        newline
+        """
+        return int(self.record_starts[i]), int(self.record_starts[i + 1])
+
+    def validate(self) -> bool:
+        """
+        checks every record in a few vectorized passes over each chunk
+        :return: True if every record is valid
+        """
+        if self.num_lines == 0 or self.num_lines % 4 != 0:
+            return False
+        for starts, ends in self._record_chunks():
+            seq_lens = ends[1::4] - starts[1::4]
+            qual_lens = ends[3::4] - starts[3::4]
+            if np.any(seq_lens == 0) or np.any(seq_lens != qual_lens):
+                return False
+            if not np.all(self.buffer[starts[0::4]] == ord("@")):
+                return False
+            if not np.all(self.buffer[starts[2::4]] == ord("+")):
+                return False
+        return True
+
+    def mean_qualities(self, offset: int = 33) -> np.ndarray:
+        """
+        mean phred quality of each record without copying quality strings
+        :param offset: phred offset of the quality encoding
+        :return: array of mean qualities, nan for empty quality strings
+        """
+        means = []
+        for starts, ends in self._record_chunks():
+            q_starts = starts[3::4]
+            lengths = ends[3::4] - q_starts
+            mean = np.full(len(lengths), np.nan)
+            has_bases = lengths > 0
+            if np.any(has_bases):
+                idx = np.stack(
+                    [q_starts[has_bases], ends[3::4][has_bases]], axis=1
+                ).ravel()
+                if idx[-1] >= len(self.buffer):
+                    # reduceat sums the last segment to the end of the buffer
+                    idx = idx[:-1]
+                sums = np.add.reduceat(self.buffer, idx, dtype=np.int64)[::2]
+                mean[has_bases] = sums / lengths[has_bases] - offset
+            means.append(mean)
+        if len(means) == 0:
+            return np.zeros(0)
+        return np.concatenate(means)
+
+    def write_records(self, indices: Sequence[int], out_path: str) -> None:
+        """
+        writes a subset of records to a new file straight from the mapping
+        :param indices: record indices to write in order
+        :param out_path: path of the fastq to write
+        :return: None
+        """
+        with open(out_path, "wb") as f:
+            for i in indices:
+                start, end = self.record_bounds(i)
+                f.write(self._view[start:end])
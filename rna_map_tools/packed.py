@@ -0,0 +1,223 @@
+"""
+2-bit packed nucleotide sequences. A/C/G/T are stored 32 bases per uint64
+word, with the first base in the highest bits, and positions that are not
+A/C/G/T (N) are recorded in a side mask with the same layout. Comparing
+packed sequences touches a quarter of the memory of byte strings.
+"""
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+BASES_PER_WORD = 32
+
+_ENCODE = np.zeros(256, dtype=np.uint64)
+_IS_BASE = np.zeros(256, dtype=bool)
+for _chars, _code in [("Aa", 0), ("Cc", 1), ("Gg", 2), ("TtUu", 3)]:
+    for _c in _chars:
+        _ENCODE[ord(_c)] = _code
+        _IS_BASE[ord(_c)] = True
+_DECODE = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+_SHIFTS = np.arange(2 * (BASES_PER_WORD - 1), -1, -2, dtype=np.uint64)
+_LOW_BITS = np.uint64(0x5555555555555555)
+_ALL_BITS = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:  # pragma: no cover
+    _POPCOUNT_8 = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+    def _popcount(x):
+        x = np.ascontiguousarray(x)
+        counts = _POPCOUNT_8[x.view(np.uint8)]
+        return counts.reshape(x.shape + (8,)).sum(axis=-1)
+
+
+@dataclass(frozen=True)
+class PackedSequences:
+    """
+    a set of equal length sequences packed at 2 bits per base
+    """
+
+    words: np.ndarray  # uint64 (num_seqs, num_words)
+    n_mask: np.ndarray  # uint64 (num_seqs, num_words) 0b11 where base is N
+    length: int
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            item = slice(item, item + 1)
+        return PackedSequences(self.words[item], self.n_mask[item], self.length)
+
+    def has_n(self) -> np.ndarray:
+        """
+        :return: boolean array True for sequences that contain an N
+        """
+        return self.n_mask.any(axis=1)
+
+
+def _to_byte_matrix(seqs: Sequence[str], length: int) -> np.ndarray:
+    """
+    converts sequences into a (num_seqs, length) uint8 array, sequences that
+    are too short are padded with N and longer ones are truncated
+    """
+    if len(seqs) > 0 and all(len(s) == length for s in seqs):
+        buf = "".join(seqs).encode("ascii")
+        return np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), length)
+    arr = np.full((len(seqs), length), ord("N"), dtype=np.uint8)
+    for i, s in enumerate(seqs):
+        s = s[:length].encode("ascii")
+        arr[i, : len(s)] = np.frombuffer(s, dtype=np.uint8)
+    return arr
+
+
+def _pack_codes(codes: np.ndarray) -> np.ndarray:
+    """
+    packs a (num_seqs, num_words * 32) array of 2 bit codes into words
+    """
+    num_seqs = codes.shape[0]
+    codes = codes.reshape(num_seqs, -1, BASES_PER_WORD)
+    return np.bitwise_or.reduce(codes << _SHIFTS, axis=2)
+
+
+def encode(seqs: Sequence[str], length: int = None) -> PackedSequences:
+    """
+    packs sequences at 2 bits per base
+    :param seqs: sequences of A/C/G/T/U, any other character is treated as N
+    :param length: length to pad or truncate to, defaults to the longest
+    sequence
+    :return: PackedSequences
+    """
+    if length is None:
+        length = max((len(s) for s in seqs), default=0)
+    arr = _to_byte_matrix(seqs, length)
+    num_words = max((length + BASES_PER_WORD - 1) // BASES_PER_WORD, 1)
+    padded = np.zeros((len(seqs), num_words * BASES_PER_WORD), np.uint64)
+    padded[:, :length] = _ENCODE[arr]
+    n_codes = np.zeros_like(padded)
+    n_codes[:, :length] = np.where(_IS_BASE[arr], 0, 3)
+    return PackedSequences(_pack_codes(padded), _pack_codes(n_codes), length)
+
+
+def decode(packed: PackedSequences) -> List[str]:
+    """
+    unpacks sequences back into strings
+    :param packed: PackedSequences
+    :return: list of sequences with N where the mask is set
+    """
+    codes = (packed.words[:, :, None] >> _SHIFTS) & np.uint64(3)
+    codes = codes.reshape(len(packed), -1)[:, : packed.length]
+    n_codes = (packed.n_mask[:, :, None] >> _SHIFTS) & np.uint64(3)
+    n_codes = n_codes.reshape(len(packed), -1)[:, : packed.length]
+    chars = np.where(n_codes != 0, ord("N"), _DECODE[codes])
+    chars = np.ascontiguousarray(chars, dtype=np.uint8)
+    return [row.tobytes().decode("ascii") for row in chars]
+
+
+def _mismatch_bits(
+    words_1: np.ndarray, mask_1: np.ndarray, words_2: np.ndarray, mask_2
+) -> np.ndarray:
+    """
+    one bit set per mismatched position, any N counts as a mismatch
+    """
+    x = words_1 ^ words_2
+    x = (x | (x >> np.uint64(1))) & _LOW_BITS
+    return x | ((mask_1 | mask_2) & _LOW_BITS)
+
+
+def hamming_distance(a: PackedSequences, b: PackedSequences) -> np.ndarray:
+    """
+    hamming distance between every pair of sequences in a and b. Positions
+    with an N in either sequence count as mismatches
+    :param a: PackedSequences of n sequences
+    :param b: PackedSequences of m sequences with the same length as a
+    :return: (n, m) array of distances
+    """
+    if a.length != b.length:
+        raise ValueError(
+            f"cannot compare sequences of length {a.length} and {b.length}"
+        )
+    bits = _mismatch_bits(
+        a.words[:, None, :],
+        a.n_mask[:, None, :],
+        b.words[None, :, :],
+        b.n_mask[None, :, :],
+    )
+    return _popcount(bits).sum(axis=2, dtype=np.int32)
+
+
+def _reverse_words(words: np.ndarray) -> np.ndarray:
+    """
+    reverses the order of the 2 bit groups in each word
+    """
+    m2 = np.uint64(0x3333333333333333)
+    m4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+    words = ((words >> np.uint64(2)) & m2) | ((words & m2) << np.uint64(2))
+    words = ((words >> np.uint64(4)) & m4) | ((words & m4) << np.uint64(4))
+    return words.byteswap()
+
+
+def _shift_left(words: np.ndarray, num_bits: int) -> np.ndarray:
+    """
+    shifts multi word rows left by num_bits < 64
+    """
+    if num_bits == 0:
+        return words
+    shifted = words << np.uint64(num_bits)
+    shifted[:, :-1] |= words[:, 1:] >> np.uint64(64 - num_bits)
+    return shifted
+
+
+def reverse_complement(packed: PackedSequences) -> PackedSequences:
+    """
+    reverse complement of packed sequences without unpacking them
+    :param packed: PackedSequences
+    :return: PackedSequences of the reverse complements
+    """
+    num_words = packed.words.shape[1]
+    pad_bits = 2 * (num_words * BASES_PER_WORD - packed.length)
+    # A<->T and C<->G is 3 - code which is code ^ 0b11
+    words = _reverse_words(packed.words ^ _ALL_BITS)[:, ::-1]
+    n_mask = _reverse_words(packed.n_mask)[:, ::-1]
+    words = _shift_left(words, pad_bits)
+    n_mask = _shift_left(n_mask, pad_bits)
+    # N positions have no meaningful complement keep them as A like encode
+    words &= ~n_mask
+    return PackedSequences(
+        np.ascontiguousarray(words), np.ascontiguousarray(n_mask), packed.length
+    )
+
+
+def best_matches(
+    reads: PackedSequences,
+    barcodes: PackedSequences,
+    max_distance: int,
+    chunk_size: int = 4096,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    finds the closest barcode for each read
+    :param reads: packed barcode regions of each read
+    :param barcodes: packed barcode sequences
+    :param max_distance: largest hamming distance that counts as a match
+    :param chunk_size: number of reads compared at once, bounds memory
+    :return: index of the matched barcode, -1 if there is no match within
+    max_distance or the closest barcode is tied, and the closest distance
+    """
+    indices = np.full(len(reads), -1, dtype=np.int64)
+    distances = np.zeros(len(reads), dtype=np.int32)
+    if len(barcodes) == 0:
+        distances[:] = reads.length
+        return indices, distances
+    for start in range(0, len(reads), chunk_size):
+        end = min(start + chunk_size, len(reads))
+        dist = hamming_distance(reads[start:end], barcodes)
+        best = dist.argmin(axis=1)
+        best_dist = dist[np.arange(end - start), best]
+        num_best = (dist == best_dist[:, None]).sum(axis=1)
+        ok = (best_dist <= max_distance) & (num_best == 1)
+        indices[start:end] = np.where(ok, best, -1)
+        distances[start:end] = best_dist
+    return indices, distances
@@ -1,4 +1,6 @@
 import os
+import copy
+import functools
 import yaml
 import json
 import jsonschema
@@ -17,7 +19,11 @@ def extend_with_default(validator_class):
     def set_defaults(validator, properties, instance, schema):
         for property_, subschema in properties.items():
             if "default" in subschema and not isinstance(instance, list):
-                instance.setdefault(property_, subschema["default"])
+                # the schema is shared by every parse, defaults are copied
+                # so changing one set of parameters does not change another
+                instance.setdefault(
+                    property_, copy.deepcopy(subschema["default"])
+                )
 
         for error in validate_properties(
             validator,
@@ -33,10 +39,18 @@ def extend_with_default(validator_class):
     )
 
 
-def validate_parameters(params):
+@functools.lru_cache(maxsize=None)
+def get_schema():
+    """
+    Get the parameter schema, it is only read once per process
+    """
     path = PY_DIR + "/resources/params_schema.json"
     with open(path) as f:
-        schema = json.load(f)
+        return json.load(f)
+
+
+def validate_parameters(params):
+    schema = get_schema()
     # Validate the params against the schema
     FillDefaultValidatingDraft4Validator = extend_with_default(Draft4Validator)
     try:
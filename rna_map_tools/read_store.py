@@ -0,0 +1,408 @@
+"""
+single file store of a demultiplexed run. Replaces the BARCODE/ directory
+tree with one file that holds a compressed block for each read of each
+barcode and an index of where every block is.
+
+file layout:
+--MAGIC (8 bytes) VERSION (uint32)
+--blocks, each a complete compressed stream of one fastq
+--index, json of the offset, length, codec and record count of each block
+--index offset (uint64) MAGIC (8 bytes)
+
+appending to a store writes the new blocks, a new index and a new footer
+after the old footer, only the index of the last footer is used. The old
+index and replaced blocks stay in the file until it is packed again. The
+length of the store before an append is kept in STORE.append until the new
+footer is on disk. While it exists readers use the old footer and the next
+append truncates the store back to it, so an append that was killed part
+way never makes the store unreadable.
+"""
+import io
+import os
+import json
+import shutil
+import struct
+from typing import Dict, List, Optional
+
+from rna_map_tools.compression import (
+    CODEC_EXTENSIONS,
+    check_codec,
+    detect_codec,
+    open_file,
+    open_stream,
+)
+from rna_map_tools.fastq import get_read_fastq, is_valid_record
+from rna_map_tools.logger import get_logger
+
+log = get_logger("READ-STORE")
+
+MAGIC = b"RMTSTORE"
+VERSION = 1
+READS = ["R1", "R2"]
+READ_STORE_FILE = "demultiplexed.store"
+_FOOTER = struct.Struct("<Q8s")
+APPEND_SUFFIX = ".append"
+
+
+def _pending_append(path: str) -> Optional[int]:
+    """
+    :param path: path of a store
+    :return: length of the store before an unfinished append, None if there
+    is none
+    """
+    try:
+        with open(path + APPEND_SUFFIX, encoding="utf8") as f:
+            return json.load(f)["length"]
+    except FileNotFoundError:
+        return None
+
+
+def _write_pending_append(path: str, length: int) -> None:
+    tmp_path = f"{path}{APPEND_SUFFIX}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump({"length": length}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path + APPEND_SUFFIX)
+
+
+def fastq_name(read: str, codec: str = "none") -> str:
+    """
+    :param read: R1 or R2
+    :param codec: codec the file is compressed with
+    :return: name of the fastq in the legacy BARCODE/ layout
+    """
+    return f"test_S1_L001_{read}_001.fastq{CODEC_EXTENSIONS[codec]}"
+
+
+def is_read_store(path: str) -> bool:
+    """
+    :param path: any path
+    :return: True if path is a read store file
+    """
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class _BlockReader(io.RawIOBase):
+    """
+    reads a byte range of a file as if it was its own file
+    """
+
+    def __init__(self, f, offset: int, length: int):
+        self._f = f
+        self._pos = offset
+        self._end = offset + length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._end - self._pos)
+        if n <= 0:
+            return 0
+        self._f.seek(self._pos)
+        data = self._f.read(n)
+        b[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class _CountingWriter:
+    """
+    counts newlines of everything written through it
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.num_lines = 0
+
+    def write(self, b):
+        self.num_lines += b.count(b"\n")
+        return self._f.write(b)
+
+
+class ReadStoreWriter:
+    """
+    writes a read store, blocks are added one fastq at a time
+    :param path: path of the store
+    :param codec: codec for uncompressed fastqs
+    :param append: add to an existing store at path in place, blocks of
+    barcodes that are added again replace the old ones
+    """
+
+    def __init__(
+        self, path: str, codec: str = "gzip-fast", append: bool = False
+    ):
+        check_codec(codec)
+        self.path = path
+        self.codec = codec
+        self._index = {}
+        if append and os.path.exists(path):
+            with ReadStore(path) as store:
+                self._index = store.index()
+            self._tmp_path = None
+            self._f = open(path, "r+b")
+            length = _pending_append(path)
+            if length is not None:
+                log.warning(f"removing an interrupted append from {path}")
+                self._f.truncate(length)
+            self._f.seek(0, os.SEEK_END)
+            self._start = self._f.tell()
+            _write_pending_append(path, self._start)
+        else:
+            self._tmp_path = f"{path}.{os.getpid()}.tmp"
+            self._f = open(self._tmp_path, "wb")
+            self._f.write(MAGIC + struct.pack("<I", VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        elif self._tmp_path is None:
+            # the footer of the old store is the last one again
+            self._f.truncate(self._start)
+            self._f.close()
+            os.remove(self.path + APPEND_SUFFIX)
+        else:
+            self._f.close()
+            os.remove(self._tmp_path)
+
+    def add_fastq(self, barcode_seq: str, read: str, path: str) -> None:
+        """
+        adds a fastq as a block. Compressed fastqs are copied as they are,
+        uncompressed ones are compressed with the codec of the store
+        :param barcode_seq: barcode the reads belong to
+        :param read: R1 or R2
+        :param path: path to the fastq of any supported codec
+        :return: None
+        """
+        if read not in READS:
+            raise ValueError(f"read must be one of {READS} not {read}")
+        offset = self._f.tell()
+        src_codec = detect_codec(path)
+        if src_codec == "none":
+            codec = self.codec
+            with open(path, "rb") as f_in:
+                with open_stream(self._f, "wb", codec) as f_out:
+                    counter = _CountingWriter(f_out)
+                    shutil.copyfileobj(f_in, counter, 1024 * 1024)
+            num_lines = counter.num_lines
+        else:
+            # gzip-fast is stored as gzip, both are read the same way
+            codec = src_codec
+            with open(path, "rb") as f_in:
+                shutil.copyfileobj(f_in, self._f, 1024 * 1024)
+            num_lines = 0
+            with open_file(path, "rb") as f_in:
+                for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+                    num_lines += chunk.count(b"\n")
+        self._f.flush()
+        self._index.setdefault(barcode_seq, {})[read] = {
+            "offset": offset,
+            "length": self._f.tell() - offset,
+            "codec": codec,
+            "records": num_lines // 4,
+        }
+
+    def add_barcode_dir(self, barcode_seq: str, directory: str) -> None:
+        """
+        adds the read pair of a legacy BARCODE/ directory
+        :param barcode_seq: barcode the reads belong to
+        :param directory: directory with test_S1_L001_R{1,2}_001.fastq[.gz]
+        :return: None
+        """
+        for read in READS:
+            self.add_fastq(barcode_seq, read, get_read_fastq(directory, read))
+
+    def close(self) -> None:
+        """
+        writes the index and moves a new store into place
+        """
+        index_offset = self._f.tell()
+        self._f.write(json.dumps({"barcodes": self._index}).encode())
+        self._f.write(_FOOTER.pack(index_offset, MAGIC))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        if self._tmp_path is not None:
+            os.replace(self._tmp_path, self.path)
+        else:
+            # the new footer is on disk
+            os.remove(self.path + APPEND_SUFFIX)
+
+
+class ReadStore:
+    """
+    read access to a read store by barcode
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "rb")
+        if self._f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a read store")
+        # the end of the store before an unfinished append
+        end = _pending_append(path)
+        if end is None:
+            end = os.path.getsize(path)
+        self._f.seek(end - _FOOTER.size)
+        index_offset, magic = _FOOTER.unpack(self._f.read(_FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated, no index found")
+        self._f.seek(index_offset)
+        size = end - _FOOTER.size - index_offset
+        self._index = json.loads(self._f.read(size))["barcodes"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __contains__(self, barcode_seq):
+        return barcode_seq in self._index
+
+    def barcodes(self) -> List[str]:
+        return list(self._index.keys())
+
+    def index(self) -> Dict:
+        """
+        :return: a copy of the block info of every barcode
+        """
+        return {b: dict(reads) for b, reads in self._index.items()}
+
+    def block_info(self, barcode_seq: str, read: str) -> Dict:
+        """
+        :return: offset, length, codec and number of records of a block
+        """
+        return self._index[barcode_seq][read]
+
+    def num_records(self, barcode_seq: str) -> int:
+        return self.block_info(barcode_seq, "R1")["records"]
+
+    def open_block(self, barcode_seq: str, read: str) -> io.RawIOBase:
+        """
+        :return: the compressed bytes of one block
+        """
+        info = self.block_info(barcode_seq, read)
+        return _BlockReader(self._f, info["offset"], info["length"])
+
+    def open(self, barcode_seq: str, read: str):
+        """
+        opens the fastq of one read of a barcode
+        :param barcode_seq: the barcode
+        :param read: R1 or R2
+        :return: binary file object of the uncompressed fastq
+        """
+        info = self.block_info(barcode_seq, read)
+        return open_stream(
+            self.open_block(barcode_seq, read), "rb", info["codec"]
+        )
+
+    def validate(self, barcode_seq: str, full: bool = False) -> bool:
+        """
+        checks the first record, or every record if full, of both reads
+        :param barcode_seq: the barcode
+        :param full: check every record
+        :return: True if valid
+        """
+        if barcode_seq not in self._index:
+            return False
+        for read in READS:
+            try:
+                with self.open(barcode_seq, read) as f:
+                    f = io.TextIOWrapper(f, encoding="utf8")
+                    num_records = 0
+                    while True:
+                        lines = [f.readline().rstrip("\n") for _ in range(4)]
+                        if lines[0] == "":
+                            break
+                        if not is_valid_record(lines):
+                            return False
+                        num_records += 1
+                        if not full:
+                            break
+            except (OSError, EOFError):
+                return False
+            if num_records == 0:
+                return False
+            if full and num_records != self.num_records(barcode_seq):
+                return False
+        return True
+
+    def export(self, barcode_seq: str, directory: str) -> List[str]:
+        """
+        writes the read pair of a barcode in the legacy layout, blocks are
+        copied without being decompressed
+        :param barcode_seq: the barcode
+        :param directory: directory to write the fastqs to
+        :return: paths of the R1 and R2 fastqs
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for read in READS:
+            info = self.block_info(barcode_seq, read)
+            path = os.path.join(directory, fastq_name(read, info["codec"]))
+            with open(path, "wb") as f:
+                shutil.copyfileobj(
+                    self.open_block(barcode_seq, read), f, 1024 * 1024
+                )
+            paths.append(path)
+        return paths
+
+    def export_all(self, directory: str, barcodes: List[str] = None) -> None:
+        """
+        recreates the legacy BARCODE/ layout
+        :param directory: directory to create the barcode directories in
+        :param barcodes: only export these barcodes
+        :return: None
+        """
+        if barcodes is None:
+            barcodes = self.barcodes()
+        for barcode_seq in barcodes:
+            self.export(barcode_seq, os.path.join(directory, barcode_seq))
+        log.info(f"exported {len(barcodes)} barcodes to {directory}")
+
+
+def pack_barcode_dirs(
+    directory: str,
+    barcodes: List[str],
+    codec: str = "gzip-fast",
+    path: str = None,
+    remove: bool = False,
+    append: bool = False,
+) -> str:
+    """
+    packs BARCODE/ directories into a read store
+    :param directory: directory with the barcode directories
+    :param barcodes: barcodes to pack
+    :param codec: codec for uncompressed fastqs
+    :param path: path of the store, defaults to directory/demultiplexed.store
+    :param remove: remove the barcode directories once packed
+    :param append: add the barcodes to an existing store at path in place
+    :return: path of the store
+    """
+    if path is None:
+        path = os.path.join(directory, READ_STORE_FILE)
+    packed = []
+    with ReadStoreWriter(path, codec, append) as writer:
+        for barcode_seq in barcodes:
+            barcode_dir = os.path.join(directory, barcode_seq)
+            if not os.path.isdir(barcode_dir):
+                log.warning(f"no output for {barcode_seq} nothing to pack")
+                continue
+            writer.add_barcode_dir(barcode_seq, barcode_dir)
+            packed.append(barcode_dir)
+    if remove:
+        for barcode_dir in packed:
+            shutil.rmtree(barcode_dir)
+    log.info(f"packed {len(packed)} barcodes into {path}")
+    return path
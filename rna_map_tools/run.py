@@ -7,6 +7,7 @@ import glob
 
 from rna_map_tools.logger import get_logger
 from rna_map_tools.fastq import get_paired_fastqs
+from rna_map_tools.download_cache import DownloadCache
 
 log = get_logger("RUN")
 
@@ -27,11 +28,18 @@ def download(run_name, download_dir, params):
     Download a run from basespace
     :param run_name:
     :param download_dir:
+    :param params: download parameters, if cache_dir is set runs are restored
+    from the cache instead of being downloaded again
     :return:
     """
+    bs_command = params["bs_command"]
+    cache = None
+    if params["cache_dir"] is not None:
+        cache = DownloadCache(params["cache_dir"], params["cache_max_size_gb"])
+    use_cache = cache is not None and cache.has(run_name)
     # check that bs program exists before starting
-    if not does_program_exist("bs"):
-        log.error("cannot find program 'bs', please install it")
+    if not use_cache and not does_program_exist(bs_command):
+        log.error(f"cannot find program '{bs_command}', please install it")
         exit()
     # if download_dir is not set assume we are using $BASESPACE
     if download_dir is None:
@@ -47,11 +55,25 @@ def download(run_name, download_dir, params):
         exit()
     os.makedirs(run_name)
     os.chdir(run_name)
-    log.info(f"running: `bs download project --name {run_name}`")
-    # do not use subprocess here because then we cant see progress
-    os.system(
-        f"bs download project --name {run_name}",
-    )
+    if use_cache:
+        log.info(f"{run_name} found in download cache {cache.path}")
+        cache.materialize(run_name, os.getcwd())
+    else:
+        log.info(f"running: `{bs_command} download project --name {run_name}`")
+        # do not use subprocess here because then we cant see progress
+        status = os.system(
+            f"{bs_command} download project --name {run_name}",
+        )
+        if status != 0:
+            # a partial download must never end up in the cache
+            log.error(
+                f"`{bs_command} download` failed with exit status "
+                f"{os.waitstatus_to_exitcode(status)}"
+            )
+            exit()
+        if cache is not None:
+            cache.store(run_name, os.getcwd())
+            cache.evict()
     # get the only directory in the current directory with other files
     current_dir = os.getcwd()
     dirs = [
@@ -0,0 +1,274 @@
+"""
+measures the orchestration overhead of runmulti, everything it does besides
+running rna_map. rna_map is replaced by a stub that sleeps for a fixed latency
+and runmulti is driven over synthetic sample sheets of increasing size. Runs
+offline with no sequencing data.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from rna_map_tools.logger import get_logger
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.tools import runmulti as runmulti_module
+
+log = get_logger("BENCHMARK")
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+# a short reference and read pair, only their layout matters
+REF_SEQ = "GGAAGATCGAGTAGATCAAAGCATGCAACGAAACAACAACAACAAC"
+REF_STRUCTURE = "." * len(REF_SEQ)
+READ_SEQ = REF_SEQ[:40]
+
+
+def _barcode_seq(i: int, length: int = 10) -> str:
+    """
+    a unique barcode sequence for each index
+    """
+    seq = ""
+    for _ in range(length):
+        seq += "ACGT"[i % 4]
+        i //= 4
+    return seq
+
+
+def make_synthetic_run(
+    path: str, num_rows: int, num_codes: int = 10
+) -> pd.DataFrame:
+    """
+    creates the directories runmulti expects for a synthetic sample sheet
+    --PATH/
+      |--demultiplexed/BARCODE/test_S1_L001_R{1,2}_001.fastq
+      |--seq/fasta/CODE.fasta
+      |--seq/rna/CODE.csv
+      |--rna_map_params.yml
+      |--run/
+    :param path: directory to create the run in
+    :param num_rows: number of rows in the sample sheet
+    :param num_codes: number of distinct reference codes shared by the rows
+    :return: the sample sheet
+    """
+    path = os.path.abspath(path)
+    for d in ["demultiplexed", "seq/fasta", "seq/rna", "run"]:
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+    num_codes = max(1, min(num_codes, num_rows))
+    codes = [f"C{i:04d}" for i in range(num_codes)]
+    for code in codes:
+        with open(f"{path}/seq/fasta/{code}.fasta", "w", encoding="utf8") as f:
+            f.write(f">{code}_ref\n{REF_SEQ}\n")
+        pd.DataFrame(
+            [[f"{code}_ref", REF_SEQ, REF_STRUCTURE]],
+            columns=["name", "sequence", "structure"],
+        ).to_csv(f"{path}/seq/rna/{code}.csv", index=False)
+    record = f"@read\n{READ_SEQ}\n+\n{'I' * len(READ_SEQ)}\n"
+    rows = []
+    for i in range(num_rows):
+        barcode_seq = _barcode_seq(i)
+        fastq_dir = os.path.join(path, "demultiplexed", barcode_seq)
+        os.makedirs(fastq_dir, exist_ok=True)
+        for read in ["R1", "R2"]:
+            fname = f"{fastq_dir}/test_S1_L001_{read}_001.fastq"
+            with open(fname, "w", encoding="utf8") as f:
+                f.write(record)
+        rows.append(
+            {
+                "construct": f"construct_{i}",
+                "code": codes[i % num_codes],
+                "barcode": f"RTB{i:05d}",
+                "barcode_seq": barcode_seq,
+                "data_type": "DMS",
+            }
+        )
+    with open(f"{path}/rna_map_params.yml", "w", encoding="utf8") as f:
+        yaml.dump({"overwrite": True}, f)
+    return pd.DataFrame(rows)
+
+
+class TimedStub:
+    """
+    stands in for rna_map.run.run and run_rna_map_validated, sleeps for latency seconds and records how
+    long it was called for so that time can be removed from the total
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.num_calls = 0
+        self.elapsed = 0.0
+
+    def __call__(self, fasta, fastq1, fastq2, dot_bracket, params):
+        start = time.perf_counter()
+        for p in [fasta, fastq1, fastq2, dot_bracket]:
+            if not os.path.exists(p):
+                raise ValueError(f"{p} does not exist")
+        if self.latency > 0:
+            time.sleep(self.latency)
+        os.makedirs("output/BitVector_Files", exist_ok=True)
+        self.num_calls += 1
+        self.elapsed += time.perf_counter() - start
+
+
+@contextmanager
+def _patched(name: str, func):
+    """
+    replaces a module level name in runmulti for the duration of the block
+    """
+    original = getattr(runmulti_module, name)
+    setattr(runmulti_module, name, func)
+    try:
+        yield
+    finally:
+        setattr(runmulti_module, name, original)
+
+
+def _timed(func, timings: Dict[str, float], key: str):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+
+    return wrapper
+
+
+def time_runmulti(
+    path: str, num_rows: int, latency: float = 0.0, num_codes: int = 10
+) -> Dict:
+    """
+    runs runmulti once on a synthetic sample sheet with a stubbed rna_map
+    :param path: directory to create the synthetic run in
+    :param num_rows: number of rows in the sample sheet
+    :param latency: seconds each stubbed rna_map call takes
+    :param num_codes: number of distinct reference codes
+    :return: timings of each phase in seconds
+    """
+    df = make_synthetic_run(path, num_rows, num_codes)
+    path = os.path.abspath(path)
+    params = get_default_params()["runmulti"]
+    params["rna_map_params_file"] = f"{path}/rna_map_params.yml"
+    stub = TimedStub(latency)
+    timings = {}
+    cur_dir = os.getcwd()
+    try:
+        with _patched("run_rna_map", stub), _patched(
+            "run_rna_map_validated", stub
+        ), _patched(
+            "check_runmulti_inputs",
+            _timed(runmulti_module.check_runmulti_inputs, timings, "validation"),
+        ), _patched(
+            "setup_run_dir",
+            _timed(runmulti_module.setup_run_dir, timings, "setup"),
+        ), _patched(
+            "run_construct",
+            _timed(runmulti_module.run_construct, timings, "constructs"),
+        ):
+            start = time.perf_counter()
+            runmulti_module.runmulti(
+                df,
+                f"{path}/run",
+                f"{path}/demultiplexed",
+                f"{path}/seq",
+                params,
+            )
+            total = time.perf_counter() - start
+    finally:
+        os.chdir(cur_dir)
+    if stub.num_calls != num_rows:
+        raise ValueError(
+            f"expected {num_rows} rna_map calls but got {stub.num_calls}"
+        )
+    overhead = total - stub.elapsed
+    return {
+        "num_rows": num_rows,
+        "num_codes": min(num_codes, num_rows),
+        "total_s": total,
+        "rna_map_s": stub.elapsed,
+        "validation_s": timings.get("validation", 0.0),
+        "setup_s": timings.get("setup", 0.0),
+        "constructs_s": timings.get("constructs", 0.0) - stub.elapsed,
+        "overhead_s": overhead,
+        "overhead_per_row_ms": 1000 * overhead / num_rows,
+    }
+
+
+def fit_scaling(results: List[Dict]) -> Dict:
+    """
+    fits total overhead against the number of rows
+    :param results: output of time_runmulti for several sizes
+    :return: the fixed and per row cost of a linear fit and the exponent of a
+    power law fit, an exponent well above 1 means overhead is superlinear
+    """
+    if len(results) < 2:
+        return {}
+    rows = np.array([r["num_rows"] for r in results], dtype=float)
+    overhead = np.array([r["overhead_s"] for r in results])
+    per_row, fixed = np.polyfit(rows, overhead, 1)
+    exponent = np.polyfit(np.log(rows), np.log(np.maximum(overhead, 1e-9)), 1)
+    return {
+        "fixed_s": float(fixed),
+        "per_row_ms": float(1000 * per_row),
+        "exponent": float(exponent[0]),
+    }
+
+
+def benchmark_runmulti(
+    sizes: List[int] = None,
+    latency: float = 0.0,
+    num_codes: int = 10,
+    repeats: int = 1,
+    work_dir: str = None,
+) -> Dict:
+    """
+    measures runmulti orchestration overhead over sample sheets of each size
+    :param sizes: number of rows of each sample sheet
+    :param latency: seconds each stubbed rna_map call takes
+    :param num_codes: number of distinct reference codes
+    :param repeats: times each size is run, the fastest run is kept
+    :param work_dir: directory synthetic runs are created in, defaults to a
+    temporary directory that is removed afterwards
+    :return: a json serializable report
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    tmp_dir = None
+    if work_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="rna_map_tools_benchmark_")
+        work_dir = tmp_dir
+    results = []
+    try:
+        for num_rows in sizes:
+            best = None
+            for i in range(repeats):
+                path = os.path.join(work_dir, f"rows_{num_rows}_{i}")
+                r = time_runmulti(path, num_rows, latency, num_codes)
+                shutil.rmtree(path)
+                if best is None or r["overhead_s"] < best["overhead_s"]:
+                    best = r
+            log.info(
+                f"{num_rows} rows: {best['overhead_s']:.3f} s overhead "
+                f"{best['overhead_per_row_ms']:.3f} ms per row"
+            )
+            results.append(best)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {
+        "latency_s": latency,
+        "repeats": repeats,
+        "results": results,
+        "scaling": fit_scaling(results),
+    }
+
+
+def write_report(report: Dict, path: str) -> None:
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
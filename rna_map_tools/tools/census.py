@@ -0,0 +1,201 @@
+"""
+counts how many reads match each barcode without writing any demultiplexed
+output. Useful to check a sample sheet in seconds before a full demultiplex
+"""
+import itertools
+import multiprocessing
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from rna_map_tools.compression import open_file
+from rna_map_tools.dataframe import check_if_columns_exist
+from rna_map_tools.fastq import PairedFastqFiles
+from rna_map_tools.logger import get_logger
+from rna_map_tools.packed import best_matches, encode, hamming_distance
+
+log = get_logger("CENSUS")
+
+# unassigned sequences are pruned to this many once there are ten times as
+# many, counts of rare sequences are approximate after pruning
+MAX_UNASSIGNED_TRACKED = 10000
+
+_barcodes = None
+
+
+@dataclass
+class Census:
+    """
+    number of reads matching each barcode
+    """
+
+    num_reads: int
+    counts: pd.DataFrame
+    unassigned: pd.DataFrame
+
+    def log(self) -> None:
+        log.info(f"scanned {self.num_reads} reads")
+        log.info(
+            "reads per barcode:\n\n"
+            + tabulate(self.counts, "keys", tablefmt="github", showindex=False)
+            + "\n",
+            extra={"artifact": "census_counts"},
+        )
+        log.info(
+            "most common unassigned barcode sequences:\n\n"
+            + tabulate(
+                self.unassigned, "keys", tablefmt="github", showindex=False
+            )
+            + "\n",
+            extra={"artifact": "census_unassigned"},
+        )
+        for _, row in self.counts[self.counts["total"] == 0].iterrows():
+            log.warning(f"{row['barcode']} ({row['barcode_seq']}) has no reads")
+
+
+def read_barcode_regions(
+    path: str, start: int, length: int, max_reads: int = None
+) -> Iterator[str]:
+    """
+    yields the region of each read where the barcode should be
+    :param path: path to a fastq of any supported codec
+    :param start: position of the barcode in the read
+    :param length: length of the barcode
+    :param max_reads: stop after this many reads
+    """
+    with open_file(path, "rb") as f:
+        for i, line in enumerate(f):
+            if i % 4 != 1:
+                continue
+            if max_reads is not None and i // 4 >= max_reads:
+                break
+            yield line[start : start + length].decode("ascii")
+
+
+def _init_worker(barcode_seqs: List[str]) -> None:
+    global _barcodes
+    _barcodes = encode(barcode_seqs)
+
+
+def _count_batch(regions: List[str], max_distance: int):
+    """
+    counts exact and near matches of a batch of barcode regions
+    """
+    packed = encode(regions, length=_barcodes.length)
+    indices, distances = best_matches(packed, _barcodes, max_distance)
+    matched = indices >= 0
+    exact = np.bincount(
+        indices[matched & (distances == 0)], minlength=len(_barcodes)
+    )
+    near = np.bincount(
+        indices[matched & (distances > 0)], minlength=len(_barcodes)
+    )
+    unassigned = Counter(
+        regions[i] for i in np.nonzero(~matched)[0] if len(regions[i]) > 0
+    )
+    return exact, near, unassigned, len(regions)
+
+
+def _count_batch_star(args):
+    return _count_batch(*args)
+
+
+def _batches(regions: Iterator[str], batch_size: int) -> Iterator[List[str]]:
+    while True:
+        batch = list(itertools.islice(regions, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def barcode_census(
+    df: pd.DataFrame,
+    paired_fqs: PairedFastqFiles,
+    max_reads: int = None,
+    num_workers: int = 1,
+    max_distance: int = 2,
+    barcode_read: str = "read_1",
+    barcode_start: int = 0,
+    num_unassigned: int = 20,
+    batch_size: int = 100000,
+) -> Census:
+    """
+    counts exact and near matches of each barcode_seq without writing any
+    demultiplexed output
+    :param df: sample sheet with barcode, barcode_seq and construct
+    :param paired_fqs: the input fastqs
+    :param max_reads: only scan the first max_reads reads, scans all if None
+    :param num_workers: number of processes used for matching
+    :param max_distance: largest hamming distance that counts as a near match
+    :param barcode_read: read_1 or read_2, the read the barcode is in
+    :param barcode_start: position of the barcode in the read
+    :param num_unassigned: number of unassigned sequences to report
+    :param batch_size: number of reads sent to a worker at once
+    :return: a Census
+    """
+    check_if_columns_exist(df, ["barcode", "barcode_seq", "construct"])
+    df = df.drop_duplicates("barcode")[["barcode", "barcode_seq", "construct"]]
+    barcode_seqs = list(df["barcode_seq"])
+    lengths = {len(seq) for seq in barcode_seqs}
+    if len(lengths) != 1:
+        raise ValueError("census requires all barcodes to be the same length")
+    length = lengths.pop()
+    path = getattr(paired_fqs, barcode_read).path
+    log.info(
+        f"scanning {path} for {len(barcode_seqs)} barcodes starting at "
+        f"position {barcode_start}"
+    )
+    regions = read_barcode_regions(path, barcode_start, length, max_reads)
+    exact = np.zeros(len(barcode_seqs), dtype=np.int64)
+    near = np.zeros(len(barcode_seqs), dtype=np.int64)
+    unassigned = Counter()
+    num_reads = 0
+    if num_workers > 1:
+        pool = multiprocessing.Pool(
+            num_workers, initializer=_init_worker, initargs=(barcode_seqs,)
+        )
+        results = pool.imap(
+            _count_batch_star,
+            ((b, max_distance) for b in _batches(regions, batch_size)),
+        )
+    else:
+        pool = None
+        _init_worker(barcode_seqs)
+        results = (
+            _count_batch(b, max_distance) for b in _batches(regions, batch_size)
+        )
+    try:
+        for batch_exact, batch_near, batch_unassigned, count in results:
+            exact += batch_exact
+            near += batch_near
+            num_reads += count
+            unassigned.update(batch_unassigned)
+            if len(unassigned) > MAX_UNASSIGNED_TRACKED * 10:
+                unassigned = Counter(
+                    dict(unassigned.most_common(MAX_UNASSIGNED_TRACKED))
+                )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    df_counts = df.copy()
+    df_counts["exact"] = exact
+    df_counts["near"] = near
+    df_counts["total"] = exact + near
+    df_counts["fraction"] = df_counts["total"] / max(num_reads, 1)
+    top = unassigned.most_common(num_unassigned)
+    df_unassigned = pd.DataFrame(top, columns=["sequence", "count"])
+    if len(top) > 0:
+        dist = hamming_distance(
+            encode([seq for seq, _ in top], length=length), encode(barcode_seqs)
+        )
+        closest = dist.argmin(axis=1)
+        df_unassigned["closest_barcode"] = [
+            barcode_seqs[i] for i in closest
+        ]
+        df_unassigned["distance"] = dist[np.arange(len(top)), closest]
+    return Census(num_reads, df_counts, df_unassigned)
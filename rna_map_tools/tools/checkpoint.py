@@ -0,0 +1,190 @@
+"""
+checkpointing of long demultiplexing runs. The input is processed in record
+aligned chunks and after each chunk the input offsets and the size of every
+output file are recorded. An interrupted run truncates its outputs back to
+the last checkpoint and continues from the recorded input offsets. A checkpoint
+is only resumed by a run with the same inputs, barcodes and parameters and
+records when the outputs were finalized so that is not done twice.
+"""
+import os
+import json
+import shutil
+import hashlib
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from rna_map_tools.compression import is_compressed_path, open_file
+from rna_map_tools.fastq import REWRITE_NEW, REWRITE_OLD
+from rna_map_tools.logger import get_logger
+
+log = get_logger("CHECKPOINT")
+
+CHECKPOINT_FILE = "demultiplex_checkpoint.json"
+
+
+@dataclass
+class DemultiplexCheckpoint:
+    """
+    the state of a demultiplexing run after its last finished chunk
+    """
+
+    inputs: List[str]
+    chunk_records: int
+    # hash of the barcodes and parameters the run was started with
+    key: str = ""
+    num_records: int = 0
+    # byte offset into each input, None for compressed inputs which are
+    # skipped forward by record count instead
+    offsets: List[Optional[int]] = field(default_factory=list)
+    output_sizes: Dict[str, int] = field(default_factory=dict)
+    outputs: List[str] = field(default_factory=list)
+    finished: bool = False
+    # barcodes whose outputs were trimmed, collapsed, subsampled and
+    # compressed and the statistics of each stage for them
+    finalized_barcodes: List[str] = field(default_factory=list)
+    barcode_stats: Dict[str, Dict] = field(default_factory=dict)
+    # packing into a read store started, the store is appended to on resume
+    packing: bool = False
+    # trimming, collapsing, subsampling, compression and packing are done
+    finalized: bool = False
+
+    def save(self, path: str = CHECKPOINT_FILE) -> None:
+        """
+        atomically writes the checkpoint
+        :param path: path of the checkpoint file
+        :return: None
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(asdict(self), f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = CHECKPOINT_FILE) -> "DemultiplexCheckpoint":
+        with open(path, encoding="utf8") as f:
+            return cls(**json.load(f))
+
+    @classmethod
+    def load_or_create(
+        cls,
+        inputs: List[str],
+        chunk_records: int,
+        key: str = "",
+        path: str = CHECKPOINT_FILE,
+    ) -> "DemultiplexCheckpoint":
+        """
+        loads the checkpoint of an earlier run on the same inputs with the
+        same key or starts a new one
+        :param inputs: paths to the input fastqs
+        :param chunk_records: number of records per chunk
+        :param key: see get_checkpoint_key
+        :param path: path of the checkpoint file
+        :return: a DemultiplexCheckpoint
+        """
+        inputs = [os.path.abspath(p) for p in inputs]
+        if os.path.exists(path):
+            checkpoint = cls.load(path)
+            if checkpoint.inputs == inputs and checkpoint.key == key:
+                log.info(
+                    f"resuming from checkpoint after {checkpoint.num_records} "
+                    f"records"
+                )
+                return checkpoint
+            if checkpoint.inputs != inputs:
+                log.warning("checkpoint is for different inputs starting over")
+            else:
+                log.warning(
+                    "checkpoint is for different barcodes or parameters "
+                    "starting over"
+                )
+        return cls(inputs, chunk_records, key, offsets=[0] * len(inputs))
+
+    def restore_outputs(self, output_dirs: List[str], directory: str = "."):
+        """
+        truncates outputs back to their size at the checkpoint and removes
+        fastqs written after it. Only the output directories of the run are
+        touched
+        :param output_dirs: barcode directories and NC of the run
+        :param directory: directory the outputs are in
+        :return: None
+        """
+        for output_dir in output_dirs:
+            # left by a rewrite of an earlier run that was not committed
+            for suffix in [REWRITE_NEW, REWRITE_OLD]:
+                shutil.rmtree(
+                    os.path.join(directory, output_dir + suffix),
+                    ignore_errors=True,
+                )
+            for root, _, fnames in os.walk(os.path.join(directory, output_dir)):
+                for fname in fnames:
+                    path = os.path.relpath(os.path.join(root, fname), directory)
+                    if path in self.output_sizes:
+                        with open(os.path.join(directory, path), "r+b") as f:
+                            f.truncate(self.output_sizes[path])
+                    elif ".fastq" in fname:
+                        os.remove(os.path.join(directory, path))
+
+
+def get_checkpoint_key(barcode_file: str, params: Dict) -> str:
+    """
+    a checkpoint is only resumed by a run with the same key
+    :param barcode_file: the barcodes written for the demultiplex program
+    :param params: the parameters that change the outputs
+    :return: sha256 of the barcode file and parameters
+    """
+    h = hashlib.sha256()
+    with open(barcode_file, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class FastqChunkReader:
+    """
+    reads record aligned chunks of a fastq starting from a checkpoint
+    """
+
+    def __init__(self, path: str, num_records: int, offset: Optional[int]):
+        self.path = path
+        self.compressed = is_compressed_path(path)
+        self._f = open_file(path, "rb")
+        if not self.compressed:
+            self._f.seek(offset)
+        else:
+            # compressed streams cannot seek, skip records instead
+            for _ in range(num_records * 4):
+                self._f.readline()
+
+    def offset(self) -> Optional[int]:
+        if self.compressed:
+            return None
+        return self._f.tell()
+
+    def write_chunk(self, out_path: str, num_records: int) -> int:
+        """
+        copies the next num_records records to out_path
+        :return: number of records written
+        """
+        count = 0
+        with open(out_path, "wb") as f:
+            while count < num_records:
+                lines = [self._f.readline() for _ in range(4)]
+                if not lines[0]:
+                    break
+                f.write(b"".join(lines))
+                count += 1
+        return count
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def append_file(src: str, dest: str) -> None:
+    """
+    appends the contents of src to dest
+    """
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    with open(src, "rb") as f_in, open(dest, "ab") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
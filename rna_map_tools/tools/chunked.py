@@ -0,0 +1,213 @@
+"""
+runs rna_map on record aligned chunks of a fastq pair in parallel and merges
+the mutation histograms of every chunk. Reads are mapped and turned into bit
+vectors independently of each other so the merged histograms are the same as
+those of a single run on the whole pair.
+
+layout inside the construct directory:
+--CONSTRUCT_DIR/
+  |--chunks/chunk_000000/  fastqs and rna_map output of each chunk, removed
+  |                        once merged
+  |--output/BitVector_Files/mutation_histos.json  merged histograms
+  |--output/BitVector_Files/mutation_histos.p
+  |--output/BitVector_Files/summary.csv
+"""
+import os
+import copy
+import shutil
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+from rna_map.mutation_histogram import (
+    MutationHistogram,
+    get_dataframe,
+    get_mut_histos_from_json_file,
+    write_mut_histos_to_json_file,
+    write_mut_histos_to_pickle_file,
+)
+from rna_map.run import run as run_rna_map
+
+from rna_map_tools.logger import get_logger
+from rna_map_tools.tools.checkpoint import FastqChunkReader
+from rna_map_tools.tools.references import run_rna_map_validated
+
+log = get_logger("CHUNKED")
+
+HISTOS_PATH = os.path.join("output", "BitVector_Files", "mutation_histos.json")
+
+SUMMARY_COLS = [
+    "name",
+    "reads",
+    "aligned",
+    "no_mut",
+    "1_mut",
+    "2_mut",
+    "3_mut",
+    "3plus_mut",
+    "sn",
+]
+
+
+def split_fastq_pair(
+    fastq1: str, fastq2: str, out_dir: str, chunk_records: int
+) -> List[Tuple[str, str]]:
+    """
+    splits a fastq pair into uncompressed chunks of chunk_records pairs
+    :param fastq1: path to the first fastq, any supported codec
+    :param fastq2: path to the second fastq, any supported codec
+    :param out_dir: directory to create one sub directory per chunk in
+    :param chunk_records: number of read pairs per chunk
+    :return: paths of the fastq pair of each chunk
+    """
+    readers = [FastqChunkReader(p, 0, 0) for p in [fastq1, fastq2]]
+    chunks = []
+    try:
+        while True:
+            chunk_dir = os.path.join(out_dir, f"chunk_{len(chunks):06d}")
+            os.makedirs(chunk_dir, exist_ok=True)
+            paths = (
+                os.path.join(chunk_dir, "test_S1_L001_R1_001.fastq"),
+                os.path.join(chunk_dir, "test_S1_L001_R2_001.fastq"),
+            )
+            counts = [
+                reader.write_chunk(path, chunk_records)
+                for reader, path in zip(readers, paths)
+            ]
+            if counts[0] != counts[1]:
+                raise ValueError(
+                    f"{fastq1} and {fastq2} have a different number of records"
+                )
+            if counts[0] == 0:
+                shutil.rmtree(chunk_dir)
+                break
+            chunks.append(paths)
+    finally:
+        for reader in readers:
+            reader.close()
+    return chunks
+
+
+def _run_chunk(args) -> str:
+    """
+    runs rna_map in the directory of a chunk, called in a worker process
+    """
+    fasta, fastq1, fastq2, dot_bracket, params, validated = args
+    chunk_dir = os.path.dirname(fastq1)
+    os.chdir(chunk_dir)
+    if validated:
+        run_rna_map_validated(fasta, fastq1, fastq2, dot_bracket, params)
+    else:
+        run_rna_map(fasta, fastq1, fastq2, dot_bracket, params)
+    return os.path.join(chunk_dir, HISTOS_PATH)
+
+
+def merge_histos(left: MutationHistogram, right: MutationHistogram) -> None:
+    """
+    adds the counts of right to left. MutationHistogram.merge checks the
+    histograms match and sums every count but del_bases, which is summed
+    here
+    :param left: histogram that is updated
+    :param right: histogram of the same reference
+    :return: None
+    """
+    del_bases = left.del_bases + right.del_bases
+    left.merge(right)
+    left.del_bases = del_bases
+
+
+def merge_histo_files(paths: List[str]) -> Dict[str, MutationHistogram]:
+    """
+    merges the mutation histograms of several rna_map runs
+    :param paths: paths to mutation_histos.json files
+    :return: the merged histograms
+    """
+    merged = {}
+    for path in paths:
+        for name, mh in get_mut_histos_from_json_file(path).items():
+            if name in merged:
+                merge_histos(merged[name], mh)
+            else:
+                merged[name] = mh
+    return merged
+
+
+def write_merged_histos(
+    mut_histos: Dict[str, MutationHistogram], out_dir: str
+) -> None:
+    """
+    writes merged histograms where rna_map would have written them
+    :param mut_histos: the merged histograms
+    :param out_dir: output/BitVector_Files directory
+    :return: None
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    write_mut_histos_to_json_file(
+        mut_histos, os.path.join(out_dir, "mutation_histos.json")
+    )
+    write_mut_histos_to_pickle_file(
+        mut_histos, os.path.join(out_dir, "mutation_histos.p")
+    )
+    df = get_dataframe(mut_histos, SUMMARY_COLS)
+    df.to_csv(os.path.join(out_dir, "summary.csv"), index=False)
+
+
+def run_rna_map_chunked(
+    fasta: str,
+    fastq1: str,
+    fastq2: str,
+    dot_bracket: str,
+    params: Dict,
+    chunk_records: int,
+    num_workers: int = None,
+    validated: bool = False,
+) -> Dict[str, MutationHistogram]:
+    """
+    runs rna_map on chunks of a fastq pair in parallel and merges the results
+    into output/ of the current directory
+    :param fasta: path to the reference fasta
+    :param fastq1: path to the first fastq
+    :param fastq2: path to the second fastq
+    :param dot_bracket: path to the secondary structure csv
+    :param params: rna_map parameters
+    :param chunk_records: number of read pairs per chunk
+    :param num_workers: number of chunks run at once, defaults to all cores
+    :param validated: the fasta and csv come from a ReferenceCache and are
+    not validated again for every chunk
+    :return: the merged histograms
+    """
+    cur_dir = os.getcwd()
+    chunks_dir = os.path.join(cur_dir, "chunks")
+    shutil.rmtree(chunks_dir, ignore_errors=True)
+    chunks = split_fastq_pair(fastq1, fastq2, chunks_dir, chunk_records)
+    if len(chunks) == 0:
+        raise ValueError(f"{fastq1} has no records")
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(num_workers, len(chunks)))
+    log.info(
+        f"running rna_map on {len(chunks)} chunks of {chunk_records} reads "
+        f"with {num_workers} workers"
+    )
+    args = [
+        (
+            os.path.abspath(fasta),
+            fq1,
+            fq2,
+            os.path.abspath(dot_bracket),
+            copy.deepcopy(params),
+            validated,
+        )
+        for fq1, fq2 in chunks
+    ]
+    try:
+        if num_workers == 1:
+            histo_paths = [_run_chunk(a) for a in args]
+        else:
+            with Pool(num_workers) as pool:
+                histo_paths = pool.map(_run_chunk, args, chunksize=1)
+    finally:
+        os.chdir(cur_dir)
+    mut_histos = merge_histo_files(histo_paths)
+    write_merged_histos(mut_histos, os.path.dirname(HISTOS_PATH))
+    shutil.rmtree(chunks_dir)
+    return mut_histos
@@ -0,0 +1,186 @@
+"""
+collapses PCR duplicates of each barcode, either read pairs with identical
+sequences or read pairs that share a UMI. Each pair is reduced to a 64 bit
+fingerprint. Once max_fingerprints unique pairs are held in memory, new
+pairs are spilled to disk partitions by fingerprint, and each partition is
+collapsed on its own. The number of copies of every kept pair is written to
+a counts file.
+
+rna_map does not read the counts back, every kept pair counts once in the
+mutation histograms. Without a UMI, pairs with identical sequences are not
+necessarily PCR duplicates: independent molecules with the same mutations,
+including the many with none, are collapsed too, which under counts common
+mutations. Collapsing without a UMI therefore has to be turned on with
+collapse_identical.
+"""
+import os
+import gzip
+import pickle
+import shutil
+import hashlib
+import tempfile
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Iterator, Tuple
+
+import pandas as pd
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("DEDUP")
+
+COUNTS_DIR = "duplicate_counts"
+
+
+@dataclass
+class DedupStats:
+    """
+    number of read pairs of one barcode before and after collapsing
+    """
+
+    pairs_in: int = 0
+    pairs_out: int = 0
+    spilled: int = 0
+
+
+def dedup_enabled(params: Dict) -> bool:
+    """
+    :param params: the demultiplex/dedup section of the parameters
+    :return: True if pairs should be collapsed, which without a UMI also
+    requires collapse_identical
+    """
+    if not params["enabled"]:
+        return False
+    if params["umi_length"] == 0 and not params["collapse_identical"]:
+        log.warning(
+            "dedup is enabled without a UMI, pairs are not collapsed. Set "
+            "umi_length or collapse_identical to collapse identical pairs"
+        )
+        return False
+    return True
+
+
+def fingerprint(pair: Tuple, params: Dict) -> int:
+    """
+    :param pair: (read 1, read 2) records from read_fastq_pairs
+    :param params: the demultiplex/dedup section of the parameters
+    :return: 64 bit fingerprint of the UMI or of both sequences
+    """
+    if params["umi_length"] > 0:
+        seq = pair[0 if params["umi_read"] == "read_1" else 1][1]
+        start = params["umi_start"]
+        key = seq[start : start + params["umi_length"]]
+    else:
+        key = pair[0][1] + b"\0" + pair[1][1]
+    return int.from_bytes(
+        hashlib.blake2b(key, digest_size=8).digest(), "little"
+    )
+
+
+def _write_counts(f, counts: Dict) -> None:
+    for num, header in counts.values():
+        f.write(f"{header[1:].decode()}\t{num}\n")
+
+
+def _collapse_partition(path: str, counts_f) -> Iterator[Tuple]:
+    """
+    collapses the pairs spilled to one partition file
+    """
+    seen = {}
+    with open(path, "rb") as f:
+        while True:
+            try:
+                fp, pair = pickle.load(f)
+            except EOFError:
+                break
+            if fp in seen:
+                seen[fp][0] += 1
+                continue
+            seen[fp] = [1, pair[0][0]]
+            yield pair
+    _write_counts(counts_f, seen)
+
+
+def dedup_pairs(
+    pairs: Iterable[Tuple],
+    params: Dict,
+    stats: DedupStats,
+    counts_path: str,
+    spill_dir: str = ".",
+) -> Iterator[Tuple]:
+    """
+    yields the first pair of every fingerprint and writes how many copies of
+    each were seen to counts_path
+    :param pairs: (read 1, read 2) records from read_fastq_pairs
+    :param params: the demultiplex/dedup section of the parameters
+    :param stats: updated with the number of pairs in and out
+    :param counts_path: gzipped tsv of read name and number of copies
+    :param spill_dir: directory partitions are written to
+    :return: iterator of the kept pairs
+    """
+    max_fingerprints = params["max_fingerprints"]
+    num_partitions = params["num_partitions"]
+    # fingerprint -> [copies, read name of the kept pair]
+    counts = {}
+    tmp_dir = None
+    partitions = None
+    try:
+        for pair in pairs:
+            stats.pairs_in += 1
+            fp = fingerprint(pair, params)
+            if fp in counts:
+                counts[fp][0] += 1
+                continue
+            if len(counts) < max_fingerprints:
+                counts[fp] = [1, pair[0][0]]
+                stats.pairs_out += 1
+                yield pair
+                continue
+            if partitions is None:
+                log.info(
+                    f"more than {max_fingerprints} unique pairs, spilling to "
+                    f"{num_partitions} partitions"
+                )
+                tmp_dir = tempfile.mkdtemp(prefix="dedup_", dir=spill_dir)
+                partitions = [
+                    open(os.path.join(tmp_dir, f"{i}.p"), "wb")
+                    for i in range(num_partitions)
+                ]
+            pickle.dump((fp, pair), partitions[fp % num_partitions])
+            stats.spilled += 1
+        os.makedirs(os.path.dirname(counts_path) or ".", exist_ok=True)
+        with gzip.open(counts_path, "wt", compresslevel=1) as counts_f:
+            counts_f.write("name\tcount\n")
+            _write_counts(counts_f, counts)
+            counts.clear()
+            if partitions is not None:
+                for f in partitions:
+                    f.close()
+                for f in partitions:
+                    for pair in _collapse_partition(f.name, counts_f):
+                        stats.pairs_out += 1
+                        yield pair
+    finally:
+        if partitions is not None:
+            for f in partitions:
+                f.close()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_dedup_stats(stats: Dict[str, DedupStats], path: str) -> pd.DataFrame:
+    """
+    writes per barcode deduplication statistics to a csv
+    :param stats: DedupStats for each barcode sequence
+    :param path: path of the csv
+    :return: the statistics as a dataframe
+    """
+    df = pd.DataFrame(
+        [{"barcode_seq": barcode, **asdict(s)} for barcode, s in stats.items()]
+    )
+    df.to_csv(path, index=False)
+    if len(df) > 0 and df["pairs_in"].sum() > 0:
+        log.info(
+            f"collapsed {df['pairs_in'].sum()} read pairs to "
+            f"{df['pairs_out'].sum()} "
+            f"({100 * df['pairs_out'].sum() / df['pairs_in'].sum():.1f}%)"
+        )
+    return df
@@ -4,36 +4,103 @@ handles demultiplexing of fastq files currently using novobaracode
 import os
 import shutil
 import subprocess
+from abc import ABC, abstractmethod
+import numpy as np
 import pandas as pd
 from tabulate import tabulate
 from pathlib import Path
-import gzip
+from dataclasses import asdict
+from typing import Dict, List
 
+from rna_map_tools.compression import compress_files, decompress_file
+from rna_map_tools.tools.checkpoint import (
+    DemultiplexCheckpoint,
+    FastqChunkReader,
+    append_file,
+    get_checkpoint_key,
+)
 from rna_map_tools.dataframe import check_if_columns_exist
 from rna_map_tools.logger import get_logger
-from rna_map_tools.fastq import PairedFastqFiles
+from rna_map_tools.fastq import (
+    REWRITE_OLD,
+    PairedFastqFiles,
+    get_paired_fastqs,
+    rewrite_fastq_dir,
+)
+from rna_map_tools.packed import encode, hamming_distance
+from rna_map_tools.read_store import pack_barcode_dirs
+from rna_map_tools.tools.dedup import (
+    COUNTS_DIR,
+    DedupStats,
+    dedup_enabled,
+    dedup_pairs,
+    write_dedup_stats,
+)
+from rna_map_tools.tools.incremental import (
+    BARCODE_SET_FILE,
+    PREVIOUS_NC,
+    get_new_barcodes,
+    load_barcode_set,
+    merge_incremental_outputs,
+    recover_nc,
+    write_barcode_set,
+)
+from rna_map_tools.tools.subsample import (
+    SubsampleStats,
+    get_rng,
+    subsample_pairs,
+    write_subsample_stats,
+)
+from rna_map_tools.tools.trim import TrimStats, trim_pairs, write_trim_stats
 
 log = get_logger("DEMULTIPLEX")
 
+STAGED_FASTQS = ["test_S1_L001_R1_001.fastq", "test_S1_L001_R2_001.fastq"]
+# parameters that change the outputs of a checkpointed run
+CHECKPOINT_PARAMS = [
+    "intermediate_codec",
+    "trim",
+    "dedup",
+    "subsample",
+    "read_store",
+]
 
-def gzip_files(directory):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if not file.endswith(".gz"):  # Ignore already compressed files
-                file_path = os.path.join(root, file)
-                compressed_file_path = f"{file_path}.gz"
-                with open(file_path, "rb") as f_in:
-                    with gzip.open(compressed_file_path, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
 
-                os.remove(file_path)  # Remove the original file
+def check_barcode_distances(df: pd.DataFrame, max_mismatches: int) -> bool:
+    """
+    checks that no two barcodes are so similar that a read matching one
+    exactly would also match the other within max_mismatches
+    :param df: a dataframe with barcode and barcode_seq columns
+    :param max_mismatches: mismatches allowed by the demultiplexer
+    :return: True if no conflicts were found
+    """
+    df = df.drop_duplicates("barcode")
+    valid = True
+    for length, df_len in df.groupby(df["barcode_seq"].str.len()):
+        dist = hamming_distance(
+            encode(list(df_len["barcode_seq"])),
+            encode(list(df_len["barcode_seq"])),
+        )
+        names = list(df_len["barcode"])
+        for i, j in zip(*np.nonzero(dist <= max_mismatches)):
+            if i >= j:
+                continue
+            log.warning(
+                f"{names[i]} and {names[j]} differ by only {dist[i, j]} "
+                f"bases, reads may be assigned to the wrong barcode"
+            )
+            valid = False
+    return valid
 
 
-class Demultiplexer:
+class Demultiplexer(ABC):
     """
     An abstract class for demultiplexing fastq files
     """
 
+    # file the barcodes are written to for the demultiplexing program
+    barcode_file = None
+
     def setup(self, params) -> None:
         """
         setup demultiplexer
@@ -41,6 +108,8 @@ class Demultiplexer:
         :return: None
         """
         self._params = params
+        # set by checkpointed runs
+        self._checkpoint = None
 
     def run(
         self,
@@ -57,10 +126,9 @@ class Demultiplexer:
         paired read fastq files
         :return: None
         """
-        log.info("unzipping fastq files")
-        shutil.copy(paired_fqs.read_1.path, "test_S1_L001_R1_001.fastq.gz")
-        shutil.copy(paired_fqs.read_2.path, "test_S1_L001_R2_001.fastq.gz")
-        subprocess.call(f"gunzip --force *.gz", shell=True)
+        log.info("decompressing fastq files")
+        decompress_file(paired_fqs.read_1.path, "test_S1_L001_R1_001.fastq")
+        decompress_file(paired_fqs.read_2.path, "test_S1_L001_R2_001.fastq")
         log.info("read1 fastq -> test_S1_L001_R1_001.fastq")
         log.info("read2 fastq -> test_S1_L001_R2_001.fastq")
 
@@ -79,8 +147,348 @@ class Demultiplexer:
             log.info(f"copying {paired_fqs.read_1.path} -> test_S1_L001_R1_001.fastq")
             log.info(f"copying {paired_fqs.read_2.path} -> test_S1_L001_R2_001.fastq")
 
+    def _output_codec(self) -> str:
+        """
+        codec the barcode outputs are compressed with
+        """
+        return self._params["intermediate_codec"]
+
+    @abstractmethod
+    def _demultiplex_command(self) -> str:
+        """
+        the command that demultiplexes test_S1_L001_R1_001.fastq and
+        test_S1_L001_R2_001.fastq in the current directory
+        """
+
+    def _output_dirs(self, df: pd.DataFrame) -> List[str]:
+        """
+        directories that must exist before the demultiplex command runs
+        """
+        return []
+
+    def _run_command(self) -> str:
+        output = subprocess.check_output(self._demultiplex_command(), shell=True)
+        return output.decode("UTF-8")
+
+    def _demultiplex(
+        self, df: pd.DataFrame, paired_fqs: PairedFastqFiles
+    ) -> List[str]:
+        """
+        demultiplexes the input fastqs into the current directory, either on
+        staged copies of the inputs or chunk by chunk with checkpoints
+        :param df: a dataframe with barcode information
+        :param paired_fqs: the input fastqs
+        :return: the output of each run of the demultiplex command
+        """
+        if self._params["checkpoint"]:
+            return self._run_checkpointed(df, paired_fqs)
+        self._prepare_fastq_files(paired_fqs)
+        return [self._run_command()]
+
+    def _run_checkpointed(
+        self, df: pd.DataFrame, paired_fqs: PairedFastqFiles
+    ) -> List[str]:
+        """
+        streams the inputs in chunks of checkpoint_records records through the
+        demultiplex command and appends each chunk's outputs. A checkpoint is
+        written after every chunk so an interrupted run can resume. No staged
+        copy of the inputs is made
+        :param df: a dataframe with barcode information
+        :param paired_fqs: the input fastqs
+        :return: the output of each run of the demultiplex command
+        """
+        key = get_checkpoint_key(
+            self.barcode_file,
+            {
+                "demultiplexer": type(self).__name__,
+                **{name: self._params.get(name) for name in CHECKPOINT_PARAMS},
+            },
+        )
+        checkpoint = DemultiplexCheckpoint.load_or_create(
+            [paired_fqs.read_1.path, paired_fqs.read_2.path],
+            self._params["checkpoint_records"],
+            key,
+        )
+        self._checkpoint = checkpoint
+        if checkpoint.finished:
+            log.info("demultiplexing already finished according to checkpoint")
+            return checkpoint.outputs
+        output_dirs = set(self._output_dirs(df)) | {"NC"}
+        if "barcode_seq" in df:
+            output_dirs |= set(df["barcode_seq"].unique())
+        checkpoint.restore_outputs(sorted(output_dirs))
+        readers = [
+            FastqChunkReader(path, checkpoint.num_records, offset)
+            for path, offset in zip(checkpoint.inputs, checkpoint.offsets)
+        ]
+        try:
+            while True:
+                shutil.rmtree("chunk", ignore_errors=True)
+                os.makedirs("chunk")
+                counts = [
+                    reader.write_chunk(
+                        os.path.join("chunk", name), checkpoint.chunk_records
+                    )
+                    for reader, name in zip(readers, STAGED_FASTQS)
+                ]
+                if counts[0] != counts[1]:
+                    raise ValueError(
+                        "read 1 and read 2 have a different number of records"
+                    )
+                if counts[0] == 0:
+                    break
+                shutil.copy(self.barcode_file, "chunk")
+                for d in self._output_dirs(df):
+                    os.makedirs(os.path.join("chunk", d), exist_ok=True)
+                os.chdir("chunk")
+                try:
+                    output = self._run_command()
+                finally:
+                    os.chdir("..")
+                self.__append_chunk_outputs(checkpoint)
+                checkpoint.num_records += counts[0]
+                checkpoint.offsets = [reader.offset() for reader in readers]
+                checkpoint.outputs.append(output)
+                checkpoint.save()
+                log.info(
+                    f"checkpoint: {checkpoint.num_records} records demultiplexed"
+                )
+        finally:
+            for reader in readers:
+                reader.close()
+        shutil.rmtree("chunk", ignore_errors=True)
+        checkpoint.finished = True
+        checkpoint.save()
+        return checkpoint.outputs
+
+    def _finalize_outputs(self, df: pd.DataFrame, codec: str) -> None:
+        """
+        trims, collapses duplicates and subsamples, if enabled, and
+        compresses the output of every barcode in a single pass over each
+        file. If read_store is set the barcode directories are then packed
+        into a single read store file compressed with intermediate_codec
+        :param df: a dataframe with barcode information
+        :param codec: codec to compress the barcode directories with
+        :return: None
+        """
+        checkpoint = self._checkpoint
+        if checkpoint is not None and checkpoint.finalized:
+            log.info("outputs already finalized according to checkpoint")
+            return
+        # barcodes finalized before an interruption are not processed again
+        done = set()
+        if checkpoint is not None:
+            done = set(checkpoint.finalized_barcodes)
+        trim_params = self._params["trim"]
+        dedup_params = self._params["dedup"]
+        subsample_params = self._params["subsample"]
+        barcode_seqs = df["barcode_seq"].unique()
+        dedup = dedup_enabled(dedup_params)
+        if trim_params["enabled"] or dedup or subsample_params["enabled"]:
+            trim_stats = {}
+            dedup_stats = {}
+            subsample_stats = {}
+            for barcode_seq in barcode_seqs:
+                if barcode_seq in done:
+                    stats = checkpoint.barcode_stats[barcode_seq]
+                    trim_stats[barcode_seq] = TrimStats(**stats["trim"])
+                    dedup_stats[barcode_seq] = DedupStats(**stats["dedup"])
+                    subsample_stats[barcode_seq] = SubsampleStats(
+                        **stats["subsample"]
+                    )
+                    shutil.rmtree(barcode_seq + REWRITE_OLD, ignore_errors=True)
+                    continue
+                if not os.path.isdir(barcode_seq) and not os.path.isdir(
+                    barcode_seq + REWRITE_OLD
+                ):
+                    log.warning(f"no output for {barcode_seq} skipping")
+                    continue
+                trim_stats[barcode_seq] = TrimStats()
+                dedup_stats[barcode_seq] = DedupStats()
+                subsample_stats[barcode_seq] = SubsampleStats()
+
+                def transform(pairs):
+                    # trim and collapse first so the depth cap counts usable
+                    # unique pairs
+                    if trim_params["enabled"]:
+                        pairs = trim_pairs(
+                            pairs, trim_params, trim_stats[barcode_seq]
+                        )
+                    if dedup:
+                        pairs = dedup_pairs(
+                            pairs,
+                            dedup_params,
+                            dedup_stats[barcode_seq],
+                            os.path.join(COUNTS_DIR, f"{barcode_seq}.tsv.gz"),
+                        )
+                    if subsample_params["enabled"]:
+                        pairs = subsample_pairs(
+                            pairs,
+                            subsample_params,
+                            get_rng(subsample_params["seed"], barcode_seq),
+                            subsample_stats[barcode_seq],
+                        )
+                    return pairs
+
+                def commit():
+                    self._barcode_finalized(
+                        barcode_seq,
+                        {
+                            "trim": trim_stats[barcode_seq],
+                            "dedup": dedup_stats[barcode_seq],
+                            "subsample": subsample_stats[barcode_seq],
+                        },
+                    )
+
+                rewrite_fastq_dir(barcode_seq, codec, transform, commit)
+            if trim_params["enabled"]:
+                write_trim_stats(trim_stats, "trim_stats.csv")
+            if dedup:
+                write_dedup_stats(dedup_stats, "dedup_stats.csv")
+            if subsample_params["enabled"]:
+                write_subsample_stats(subsample_stats, "subsample_stats.csv")
+        elif not self._params["read_store"]:
+            for barcode_seq in barcode_seqs:
+                compress_files(barcode_seq, codec)
+        if self._params["read_store"]:
+            # a store that was partly written before an interruption is
+            # appended to, the barcode directories it holds are removed
+            append = False
+            if checkpoint is not None:
+                append = checkpoint.packing
+                checkpoint.packing = True
+                checkpoint.save()
+            # uncompressed outputs are compressed as they are packed
+            pack_barcode_dirs(
+                ".",
+                barcode_seqs,
+                self._params["intermediate_codec"],
+                remove=True,
+                append=append,
+            )
+        if checkpoint is not None:
+            checkpoint.finalized = True
+            checkpoint.save()
+
+    def _barcode_finalized(self, barcode_seq: str, stats: Dict) -> None:
+        """
+        records in the checkpoint that the outputs of a barcode are final
+        :param barcode_seq: the barcode
+        :param stats: the statistics of each stage for the barcode
+        :return: None
+        """
+        if self._checkpoint is None:
+            return
+        self._checkpoint.finalized_barcodes.append(barcode_seq)
+        self._checkpoint.barcode_stats[barcode_seq] = {
+            name: asdict(s) for name, s in stats.items()
+        }
+        self._checkpoint.save()
+
+    def _record_barcode_set(self, df: pd.DataFrame) -> None:
+        """
+        keeps the barcode set with NC/ so barcodes added later can be
+        demultiplexed from NC/ alone
+        """
+        if self._params["incremental"] and os.path.isdir("NC"):
+            write_barcode_set(df, type(self).__name__)
+
+    def _run_incremental(self, df: pd.DataFrame, demultiplex_path) -> bool:
+        """
+        demultiplexes only the NC/ reads of an earlier run against barcodes
+        that were added to the sheet since then. Existing barcode outputs
+        are not touched
+        :param df: the current sample sheet
+        :param demultiplex_path: directory of the earlier run
+        :return: True if the run was brought up to date, False if all reads
+        have to be demultiplexed
+        """
+        demultiplex_path = os.path.abspath(demultiplex_path)
+        cur_dir = os.getcwd()
+        os.chdir(demultiplex_path)
+        try:
+            recover_nc()
+            recorded = load_barcode_set()
+            if recorded is None:
+                return False
+            df_new = get_new_barcodes(df, recorded, type(self).__name__)
+            if df_new is None:
+                log.warning("cannot update incrementally, using all reads")
+                return False
+            barcode_seqs = df_new["barcode_seq"].unique()
+            if len(barcode_seqs) == 0:
+                log.info("no new barcodes, nothing to demultiplex")
+                return True
+            log.info(
+                f"demultiplexing NC/ reads for {len(barcode_seqs)} new "
+                f"barcodes"
+            )
+            os.rename("NC", PREVIOUS_NC)
+            nc_fqs = get_paired_fastqs(
+                os.path.join(demultiplex_path, PREVIOUS_NC)
+            )
+            shutil.rmtree("incremental", ignore_errors=True)
+            os.makedirs("incremental")
+            params = dict(
+                self._params,
+                incremental=False,
+                delete_non_barcoded=False,
+                read_store=False,
+            )
+            demultiplexer = type(self)()
+            demultiplexer.setup(params)
+            demultiplexer.run(
+                df_new, nc_fqs, os.path.join(demultiplex_path, "incremental")
+            )
+            os.chdir(demultiplex_path)
+            for barcode_seq in barcode_seqs:
+                src = os.path.join("incremental", barcode_seq)
+                if not os.path.isdir(src):
+                    continue
+                # left over from an interrupted update
+                shutil.rmtree(barcode_seq, ignore_errors=True)
+                os.rename(src, barcode_seq)
+            merge_incremental_outputs("incremental")
+            if self._params["read_store"]:
+                pack_barcode_dirs(
+                    ".",
+                    barcode_seqs,
+                    self._params["intermediate_codec"],
+                    remove=True,
+                    append=True,
+                )
+            # recorded last, replaces the reads and the barcode set together
+            write_barcode_set(
+                df,
+                type(self).__name__,
+                os.path.join("incremental", BARCODE_SET_FILE),
+            )
+            os.rename(os.path.join("incremental", "NC"), "NC")
+            shutil.rmtree(PREVIOUS_NC)
+            shutil.rmtree("incremental")
+            return True
+        finally:
+            os.chdir(cur_dir)
+
+    def __append_chunk_outputs(self, checkpoint: DemultiplexCheckpoint):
+        for root, _, fnames in os.walk("chunk"):
+            if root == "chunk":
+                continue
+            for fname in fnames:
+                path = os.path.relpath(os.path.join(root, fname), "chunk")
+                append_file(os.path.join(root, fname), path)
+                checkpoint.output_sizes[path] = os.path.getsize(path)
+
 
 class NovobarcodeDemultiplexer(Demultiplexer):
+    barcode_file = "rtb_barcodes.fa"
+
+    def _demultiplex_command(self) -> str:
+        return (
+            "novobarcode -b rtb_barcodes.fa -f test_S1_L001_R1_001.fastq "
+            "test_S1_L001_R2_001.fastq"
+        )
+
     def run(
         self,
         df: pd.DataFrame,
@@ -91,18 +499,24 @@ class NovobarcodeDemultiplexer(Demultiplexer):
         if not os.path.isdir(demultiplex_path):
             log.error(f"{demultiplex_path} does not exist")
             exit()
+        if self._params["incremental"]:
+            if self._run_incremental(df, demultiplex_path):
+                return
         os.chdir(demultiplex_path)
-        self._prepare_fastq_files(paired_fqs)
         log.info("preparing rtb_barcodes.fa file for demultiplexing")
         self.__generate_barcode_file(df)
-        output = subprocess.check_output(
-            "novobarcode -b rtb_barcodes.fa -f test_S1_L001_R1_001.fastq "
-            "test_S1_L001_R2_001.fastq",
-            shell=True,
-        )
-        output = output.decode("UTF-8")
-        log.info(f"output from novobarcode:\n{output}")
-        df_demult = self.__parse_novobarcode_stdout(output)
+        outputs = self._demultiplex(df, paired_fqs)
+        dfs = []
+        for output in outputs:
+            log.info(
+                f"output from novobarcode:\n{output}",
+                extra={"artifact": "novobarcode_output"},
+            )
+            dfs.append(self.__parse_novobarcode_stdout(output))
+        df_demult = pd.concat(dfs)
+        df_demult = df_demult.groupby(["id", "tag"], sort=False)["count"].sum()
+        df_demult = df_demult.reset_index()
+        df_demult.to_csv("demultiplex.csv", index=False)
         log.info(f"total number of reads: {df_demult['count'].sum()}")
         log.info(
             f"total number of data reads: "
@@ -111,11 +525,16 @@ class NovobarcodeDemultiplexer(Demultiplexer):
         if not os.path.isdir("NC"):
             log.error("nothing was generated STOPING NOW!")
             exit()
+        self._finalize_outputs(df, self._output_codec())
+        self._record_barcode_set(df)
         if self._params["delete_fastqs"]:
             log.info("deleting copied fastq files")
-            os.remove("test_S1_L001_R1_001.fastq")
-            os.remove("test_S1_L001_R2_001.fastq")
-        if self._params["delete_non_barcoded"]:
+            for fname in STAGED_FASTQS:
+                if os.path.exists(fname):
+                    os.remove(fname)
+        # NC/ is kept for incremental runs
+        keep_nc = self._params["incremental"]
+        if self._params["delete_non_barcoded"] and not keep_nc:
             log.info("deleting reads that do not have a barcode")
             shutil.rmtree("NC")
 
@@ -139,7 +558,6 @@ class NovobarcodeDemultiplexer(Demultiplexer):
             data.append(spl)
         df = pd.DataFrame(data, columns="id,tag,count".split(","))
         df["count"] = pd.to_numeric(df["count"])
-        df.to_csv("demultiplex.csv", index=False)
         return df
 
     def __generate_barcode_file(self, df, fname="rtb_barcodes.fa"):
@@ -163,19 +581,23 @@ class NovobarcodeDemultiplexer(Demultiplexer):
                 tablefmt="github",
                 showindex=False,
             )
-            + "\n"
+            + "\n",
+            extra={"artifact": "constructs"},
         )
         for i, row in df.iterrows():
             if row["barcode"] in seen:
                 log.warning(
                     f"{row['barcode']} has been used more than once this may be an "
-                    f"issue"
+                    f"issue",
+                    extra={"rate_key": "duplicate_barcode"},
                 )
                 warning = True
                 continue
             s += f"{row['barcode']}\t{row['barcode_seq']}\n"
             seen.append(row["barcode"])
         log.info(f"{len(seen)} unique barcodes found from csv file")
+        if not check_barcode_distances(df, 4):
+            warning = True
         if not warning:
             log.info("no barcode conflicts detected")
         with open(fname, "w", encoding="utf8") as f:
@@ -183,6 +605,19 @@ class NovobarcodeDemultiplexer(Demultiplexer):
 
 
 class SabreDemultiplexer(Demultiplexer):
+    barcode_file = "barcode.txt"
+
+    def _demultiplex_command(self) -> str:
+        return (
+            "sabre pe -f test_S1_L001_R1_001.fastq -r "
+            "test_S1_L001_R2_001.fastq -b barcode.txt "
+            "-u NC/test_S1_L001_R1_001.fastq "
+            "-w NC/test_S1_L001_R2_001.fastq -m 4"
+        )
+
+    def _output_dirs(self, df: pd.DataFrame) -> List[str]:
+        return list(df["barcode_seq"].unique()) + ["NC"]
+
     def run(
         self,
         df: pd.DataFrame,
@@ -192,21 +627,19 @@ class SabreDemultiplexer(Demultiplexer):
         if not os.path.isdir(demultiplex_path):
             log.error(f"{demultiplex_path} does not exist")
             exit()
+        if self._params["incremental"]:
+            if self._run_incremental(df, demultiplex_path):
+                return
         os.chdir(demultiplex_path)
-        self._prepare_fastq_files(paired_fqs)
         log.info("preparing barcodes.txt file for demultiplexing")
         self.__generate_barcode_file(df)
-        output = subprocess.check_output(
-            " sabre pe -f test_S1_L001_R1_001.fastq -r "
-            "test_S1_L001_R2_001.fastq -b barcode.txt "
-            "-u NC/test_S1_L001_R1_001.fastq "
-            "-w NC/test_S1_L001_R2_001.fastq -m 4",
-            shell=True,
-        )
-        output = output.decode("UTF-8")
-        log.info(f"output from sabre:\n{output}")
-        for _, row in df.iterrows():
-            gzip_files(row["barcode_seq"])
+        for output in self._demultiplex(df, paired_fqs):
+            log.info(
+                f"output from sabre:\n{output}",
+                extra={"artifact": "sabre_output"},
+            )
+        self._finalize_outputs(df, self._output_codec())
+        self._record_barcode_set(df)
 
     def __generate_barcode_file(self, df, fname="barcode.txt"):
         expects = ["barcode", "barcode_seq", "construct"]
@@ -221,14 +654,16 @@ class SabreDemultiplexer(Demultiplexer):
                 tablefmt="github",
                 showindex=False,
             )
-            + "\n"
+            + "\n",
+            extra={"artifact": "constructs"},
         )
         s = ""
         for i, row in df.iterrows():
             if row["barcode"] in seen:
                 log.warning(
                     f"{row['barcode']} has been used more than once this may "
-                    f"be an issue"
+                    f"be an issue",
+                    extra={"rate_key": "duplicate_barcode"},
                 )
                 warning = True
                 continue
@@ -239,6 +674,8 @@ class SabreDemultiplexer(Demultiplexer):
             seen.append(row["barcode"])
         os.makedirs("NC", exist_ok=True)
         log.info(f"{len(seen)} unique barcodes found from csv file")
+        if not check_barcode_distances(df, 4):
+            warning = True
         if not warning:
             log.info("no barcode conflicts detected")
         with open(fname, "w", encoding="utf8") as f:
@@ -0,0 +1,186 @@
+"""
+bookkeeping for incremental demultiplexing. After a run the barcode set it
+used is recorded in NC/barcode_set.json next to the kept NC/ reads. When
+barcodes are later added to the sheet only the NC/ reads are demultiplexed
+against the new barcodes, existing barcode outputs are left alone. The reads
+and the barcode set are replaced together by renaming NC/ once everything
+else is in place, so an interrupted update never leaves them out of sync and
+is simply repeated by the next run.
+"""
+import os
+import json
+import shutil
+import hashlib
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from rna_map_tools.dataframe import check_if_columns_exist
+from rna_map_tools.logger import get_logger
+from rna_map_tools.tools.dedup import COUNTS_DIR
+
+log = get_logger("INCREMENTAL")
+
+BARCODE_SET_FILE = os.path.join("NC", "barcode_set.json")
+PREVIOUS_NC = "NC.previous"
+# per barcode statistics written by _finalize_outputs
+STATS_FILES = ["trim_stats.csv", "dedup_stats.csv", "subsample_stats.csv"]
+
+
+def get_barcode_set(df: pd.DataFrame) -> List[List[str]]:
+    """
+    :param df: a dataframe with barcode and barcode_seq columns
+    :return: sorted unique barcode, barcode_seq pairs
+    """
+    check_if_columns_exist(df, ["barcode", "barcode_seq"])
+    pairs = df[["barcode", "barcode_seq"]].drop_duplicates()
+    return sorted([list(p) for p in pairs.itertuples(index=False)])
+
+
+def barcode_set_fingerprint(barcodes: List[List[str]], demultiplexer: str):
+    """
+    :return: sha256 of the barcode set and the demultiplexer that used it
+    """
+    data = json.dumps({"demultiplexer": demultiplexer, "barcodes": barcodes})
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def write_barcode_set(
+    df: pd.DataFrame, demultiplexer: str, path: str = BARCODE_SET_FILE
+) -> None:
+    """
+    records the barcode set a run was demultiplexed with
+    :param df: the sample sheet of the run
+    :param demultiplexer: name of the demultiplexer
+    :param path: path of the json file
+    :return: None
+    """
+    barcodes = get_barcode_set(df)
+    data = {
+        "demultiplexer": demultiplexer,
+        "barcodes": barcodes,
+        "fingerprint": barcode_set_fingerprint(barcodes, demultiplexer),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_barcode_set(path: str = BARCODE_SET_FILE) -> Optional[Dict]:
+    """
+    :param path: path of the json file
+    :return: the recorded barcode set or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def get_new_barcodes(
+    df: pd.DataFrame, recorded: Dict, demultiplexer: str
+) -> Optional[pd.DataFrame]:
+    """
+    finds the rows of the sample sheet with barcodes that were not part of
+    the recorded run
+    :param df: the current sample sheet
+    :param recorded: output of load_barcode_set
+    :param demultiplexer: name of the current demultiplexer
+    :return: rows with new barcodes, None if the run cannot be updated
+    incrementally because a barcode name or sequence was reassigned or the
+    demultiplexer differs
+    """
+    if recorded["demultiplexer"] != demultiplexer:
+        log.warning(
+            f"run was demultiplexed with {recorded['demultiplexer']} not "
+            f"{demultiplexer}"
+        )
+        return None
+    old = {tuple(b) for b in recorded["barcodes"]}
+    current = {tuple(b) for b in get_barcode_set(df)}
+    old_names = {b[0] for b in old}
+    old_seqs = {b[1] for b in old}
+    changed = [
+        b for b in current - old if b[0] in old_names or b[1] in old_seqs
+    ]
+    if len(changed) > 0:
+        log.warning(f"barcodes were changed since the last run: {changed}")
+        return None
+    new_seqs = {b[1] for b in current - old}
+    return df[df["barcode_seq"].isin(new_seqs)]
+
+
+def recover_nc(directory: str = ".") -> None:
+    """
+    puts NC/ back in place if an incremental run was interrupted
+    :param directory: the demultiplex directory
+    :return: None
+    """
+    previous = os.path.join(directory, PREVIOUS_NC)
+    if not os.path.isdir(previous):
+        return
+    nc = os.path.join(directory, "NC")
+    if os.path.isdir(nc):
+        # the new NC/ was already moved into place
+        shutil.rmtree(previous)
+    else:
+        log.warning("restoring NC/ from an interrupted incremental run")
+        os.rename(previous, nc)
+
+
+def merge_stats(src: str, dest: str) -> None:
+    """
+    merges per barcode statistics of an incremental run into those of the
+    earlier runs, rows of barcodes in src replace rows in dest
+    :param src: csv with a barcode_seq column
+    :param dest: csv with a barcode_seq column, created if it does not exist
+    :return: None
+    """
+    df = pd.read_csv(src)
+    if os.path.exists(dest):
+        df_old = pd.read_csv(dest)
+        df_old = df_old[~df_old["barcode_seq"].isin(df["barcode_seq"])]
+        df = pd.concat([df_old, df])
+    df.to_csv(dest, index=False)
+
+
+def merge_demultiplex_csv(src: str, dest: str) -> None:
+    """
+    merges the read counts of an incremental run into those of the earlier
+    runs. The last row of each is the count of NC/, which is replaced
+    :param src: demultiplex.csv of the incremental run
+    :param dest: demultiplex.csv of the earlier runs
+    :return: None
+    """
+    df = pd.read_csv(src)
+    if os.path.exists(dest):
+        df_old = pd.read_csv(dest).iloc[:-1]
+        df_old = df_old[~df_old["id"].isin(df["id"])]
+        df = pd.concat([df_old, df])
+    df.to_csv(dest, index=False)
+
+
+def merge_incremental_outputs(src_dir: str, dest_dir: str = ".") -> None:
+    """
+    merges the statistics, duplicate counts and read counts written by an
+    incremental run into the files of the demultiplex directory
+    :param src_dir: directory the incremental run was done in
+    :param dest_dir: the demultiplex directory
+    :return: None
+    """
+    for fname in STATS_FILES:
+        src = os.path.join(src_dir, fname)
+        if os.path.exists(src):
+            merge_stats(src, os.path.join(dest_dir, fname))
+    src = os.path.join(src_dir, "demultiplex.csv")
+    if os.path.exists(src):
+        merge_demultiplex_csv(src, os.path.join(dest_dir, "demultiplex.csv"))
+    counts_dir = os.path.join(src_dir, COUNTS_DIR)
+    if os.path.isdir(counts_dir):
+        os.makedirs(os.path.join(dest_dir, COUNTS_DIR), exist_ok=True)
+        for fname in os.listdir(counts_dir):
+            os.replace(
+                os.path.join(counts_dir, fname),
+                os.path.join(dest_dir, COUNTS_DIR, fname),
+            )
@@ -0,0 +1,306 @@
+"""
+estimates the cost of a run (wall time, scratch disk and memory per stage)
+from a sample of the input fastqs without processing them
+"""
+
+import os
+import gzip
+import heapq
+import shutil
+from dataclasses import dataclass, field
+from typing import List
+
+import yaml
+import pandas as pd
+from tabulate import tabulate
+
+from rna_map_tools.compression import check_codec, detect_codec, zstandard, lz4
+from rna_map_tools.dataframe import check_if_columns_exist
+from rna_map_tools.fastq import PairedFastqFiles
+from rna_map_tools.logger import get_logger
+from rna_map_tools.parameters import PY_DIR
+
+log = get_logger("PLAN")
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def get_default_coefficients() -> dict:
+    """
+    get the stored benchmark coefficients
+    :return: dictionary of coefficients for each stage
+    """
+    return load_coefficients(PY_DIR + "/resources/plan_coefficients.yml")
+
+
+def load_coefficients(path: str) -> dict:
+    """
+    load benchmark coefficients from a yaml file
+    :param path: path to the yaml file
+    :return: dictionary of coefficients for each stage
+    """
+    with open(path, encoding="utf8") as f:
+        return yaml.safe_load(f)
+
+
+@dataclass
+class FastqSample:
+    """
+    statistics from the first reads of a fastq file
+    """
+
+    path: str
+    sequences: List[str]
+    uncompressed_bytes: int
+    compressed_bytes: int
+    reached_end: bool
+
+    def bytes_per_read(self) -> float:
+        return self.uncompressed_bytes / max(len(self.sequences), 1)
+
+    def estimate_num_reads(self) -> int:
+        """
+        estimates the total number of reads in the file from its size
+        """
+        if self.reached_end:
+            return len(self.sequences)
+        reads_per_byte = len(self.sequences) / max(self.compressed_bytes, 1)
+        return int(os.path.getsize(self.path) * reads_per_byte)
+
+    def estimate_uncompressed_size(self) -> int:
+        return int(self.estimate_num_reads() * self.bytes_per_read())
+
+
+def _open_raw_reader(f, codec):
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=f)
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    if codec == "lz4":
+        return lz4.frame.LZ4FrameFile(f)
+    return f
+
+
+def sample_fastq(path: str, num_reads: int) -> FastqSample:
+    """
+    reads the first num_reads records of a fastq file
+    :param path: path to a fastq of any supported codec
+    :param num_reads: number of reads to sample
+    :return: a FastqSample
+    """
+    sequences = []
+    uncompressed_bytes = 0
+    reached_end = False
+    codec = detect_codec(path)
+    check_codec(codec)
+    with open(path, "rb") as raw:
+        reader = _open_raw_reader(raw, codec)
+        while len(sequences) < num_reads:
+            lines = [reader.readline() for _ in range(4)]
+            if not lines[3]:
+                reached_end = True
+                break
+            uncompressed_bytes += sum(len(l) for l in lines)
+            sequences.append(lines[1].rstrip().decode("ascii"))
+        # tell on the raw file includes the decompressor's read ahead buffer,
+        # this only slightly overestimates the bytes used by the sample
+        compressed_bytes = raw.tell()
+    return FastqSample(
+        path, sequences, uncompressed_bytes, compressed_bytes, reached_end
+    )
+
+
+def estimate_barcode_fractions(
+    df: pd.DataFrame, seqs_1: List[str], seqs_2: List[str]
+) -> pd.DataFrame:
+    """
+    estimates the fraction of reads that belong to each barcode by searching
+    for the barcode sequence, or its reverse complement, in either read
+    :param df: sample sheet with barcode, barcode_seq and construct
+    :param seqs_1: sampled read 1 sequences
+    :param seqs_2: sampled read 2 sequences
+    :return: dataframe with a fraction column
+    """
+    df = df[["barcode", "barcode_seq", "construct"]].copy()
+    counts = {seq: 0 for seq in df["barcode_seq"]}
+    patterns = [
+        (seq, seq.translate(COMPLEMENT)[::-1]) for seq in df["barcode_seq"]
+    ]
+    for seq_1, seq_2 in zip(seqs_1, seqs_2):
+        for barcode_seq, rc in patterns:
+            if any(p in s for p in (barcode_seq, rc) for s in (seq_1, seq_2)):
+                counts[barcode_seq] += 1
+                break
+    num = max(len(seqs_1), 1)
+    df["fraction"] = [counts[seq] / num for seq in df["barcode_seq"]]
+    return df
+
+
+def _schedule(durations: List[float], num_workers: int) -> float:
+    """
+    longest processing time first schedule of jobs onto workers
+    :return: the time the last worker finishes
+    """
+    workers = [0.0] * num_workers
+    for d in sorted(durations, reverse=True):
+        heapq.heappush(workers, heapq.heappop(workers) + d)
+    return max(workers)
+
+
+@dataclass
+class JobPlan:
+    """
+    the estimated cost of a run
+    """
+
+    num_reads: int
+    barcodes: pd.DataFrame
+    stages: pd.DataFrame
+    suggested_workers: int
+    warnings: List[str] = field(default_factory=list)
+
+    def total_wall_time(self) -> float:
+        return self.stages["wall_time_s"].sum()
+
+    def log(self) -> None:
+        log.info(f"estimated total number of reads: {self.num_reads}")
+        log.info(
+            "estimated reads per barcode:\n\n"
+            + tabulate(
+                self.barcodes, "keys", tablefmt="github", showindex=False
+            )
+            + "\n"
+        )
+        log.info(
+            "estimated cost per stage:\n\n"
+            + tabulate(self.stages, "keys", tablefmt="github", showindex=False)
+            + "\n"
+        )
+        log.info(f"suggested number of workers: {self.suggested_workers}")
+        log.info(f"estimated wall time: {self.total_wall_time() / 3600:.2f} h")
+        for w in self.warnings:
+            log.warning(w)
+
+
+def plan_run(
+    df: pd.DataFrame,
+    paired_fqs: PairedFastqFiles,
+    num_reads: int = 10000,
+    max_workers: int = None,
+    max_memory_gb: float = None,
+    scratch_dir: str = None,
+    coefficients: dict = None,
+    intermediate_codec: str = "none",
+) -> JobPlan:
+    """
+    estimates reads per barcode, wall time, scratch disk and peak memory for
+    staging, demultiplexing and running rna_map without processing anything
+    :param df: sample sheet with barcode, barcode_seq and construct
+    :param paired_fqs: the input fastqs
+    :param num_reads: number of reads to sample from the start of the fastqs
+    :param max_workers: most workers available, defaults to the cpu count
+    :param max_memory_gb: memory available for rna_map workers
+    :param scratch_dir: directory the run will be written to, used to check
+    free space
+    :param coefficients: benchmark coefficients, defaults to the stored ones
+    :param intermediate_codec: codec the demultiplexed outputs are kept in
+    :return: a JobPlan
+    """
+    check_if_columns_exist(df, ["barcode", "barcode_seq", "construct"])
+    if len(df) == 0:
+        raise ValueError("sample sheet has no rows, nothing to plan")
+    check_codec(intermediate_codec)
+    if coefficients is None:
+        coefficients = get_default_coefficients()
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = max(max_workers, 1)
+    sample_1 = sample_fastq(paired_fqs.read_1.path, num_reads)
+    sample_2 = sample_fastq(paired_fqs.read_2.path, num_reads)
+    total_reads = sample_1.estimate_num_reads()
+    uncompressed_gb = (
+        sample_1.estimate_uncompressed_size()
+        + sample_2.estimate_uncompressed_size()
+    ) / 1e9
+    df_bc = estimate_barcode_fractions(
+        df, sample_1.sequences, sample_2.sequences
+    )
+    df_bc["est_reads"] = (df_bc["fraction"] * total_reads).astype(int)
+
+    c_stage = coefficients["staging"]
+    c_demult = coefficients["demultiplex"]
+    c_rna_map = coefficients["rna_map"]
+    if intermediate_codec == "none":
+        compress_seconds_per_gb = 0.0
+        outputs_gb = uncompressed_gb
+    else:
+        compress_seconds_per_gb = c_demult["compress_seconds_per_gb"]
+        outputs_gb = uncompressed_gb * c_demult["compression_ratio"]
+    stages = []
+    stages.append(
+        {
+            "stage": "staging",
+            "wall_time_s": uncompressed_gb * c_stage["seconds_per_gb"],
+            "scratch_gb": uncompressed_gb,
+            "peak_memory_gb": 0.1,
+        }
+    )
+    stages.append(
+        {
+            "stage": "demultiplex",
+            "wall_time_s": total_reads
+            / 1e6
+            * c_demult["seconds_per_million_reads"]
+            + uncompressed_gb * compress_seconds_per_gb,
+            # outputs kept after compression with intermediate_codec
+            "scratch_gb": outputs_gb,
+            "peak_memory_gb": c_demult["peak_memory_gb"],
+        }
+    )
+    millions = df_bc["est_reads"] / 1e6
+    durations = list(
+        c_rna_map["overhead_seconds"]
+        + millions * c_rna_map["seconds_per_million_reads"]
+    )
+    worker_memory = c_rna_map["peak_memory_gb"] + (
+        millions.max() * c_rna_map["memory_gb_per_million_reads"]
+    )
+    max_workers = min(max_workers, len(durations))
+    if max_memory_gb is not None:
+        max_workers = min(
+            max_workers, max(int(max_memory_gb / worker_memory), 1)
+        )
+    # fewest workers that get within 10% of the best possible wall time
+    best = _schedule(durations, max_workers)
+    workers = 1
+    while _schedule(durations, workers) > best * 1.1:
+        workers += 1
+    stages.append(
+        {
+            "stage": "rna_map",
+            "wall_time_s": _schedule(durations, workers),
+            "scratch_gb": millions.sum()
+            * c_rna_map["scratch_gb_per_million_reads"],
+            "peak_memory_gb": worker_memory * workers,
+        }
+    )
+    df_stages = pd.DataFrame(stages)
+    plan = JobPlan(total_reads, df_bc, df_stages, workers)
+    # staged copies and uncompressed outputs exist at the same time while
+    # demultiplexing, the compressed outputs are kept while rna_map runs
+    peak_scratch = max(
+        uncompressed_gb * 2, outputs_gb + df_stages.iloc[2]["scratch_gb"]
+    )
+    if scratch_dir is not None:
+        free_gb = shutil.disk_usage(scratch_dir).free / 1e9
+        if peak_scratch > free_gb:
+            plan.warnings.append(
+                f"run needs about {peak_scratch:.1f} GB of scratch but only "
+                f"{free_gb:.1f} GB is free in {scratch_dir}"
+            )
+    for _, row in df_bc[df_bc["est_reads"] == 0].iterrows():
+        plan.warnings.append(
+            f"{row['barcode']} ({row['barcode_seq']}) was not found in the "
+            f"first {len(sample_1.sequences)} reads"
+        )
+    return plan
@@ -0,0 +1,226 @@
+"""
+loads and validates the fasta and secondary structure csv of each reference
+code once, no matter how many rows of a sample sheet use it. rna_map is then
+run on the validated files without validating them again for every row.
+rna_map still reads the fasta itself to build its bowtie2 index and bit
+vectors, only the validation is skipped
+"""
+import os
+import pickle
+import functools
+from importlib import metadata
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pandas as pd
+import yaml
+
+from rna_map.bit_vector import BitVectorGenerator
+from rna_map.exception import DREEMInputException
+from rna_map.mapping import Mapper
+from rna_map.parameters import Inputs, get_default_params, validate_parameters
+from rna_map.run import validate_csv_file, validate_fasta_file
+from rna_map.run import run as run_rna_map
+from rna_map.util import fasta_to_dict
+
+from rna_map_tools.dataframe import check_if_columns_exist
+from rna_map_tools.logger import get_logger
+
+log = get_logger("REFERENCES")
+
+# the version of rna_map whose rna_map.run.run is mirrored by
+# run_rna_map_validated, also noted in requirements.txt
+RNA_MAP_VERSION = "0.4.0"
+
+
+@dataclass(frozen=True)
+class Reference:
+    """
+    a validated fasta and structure csv of a single code
+    """
+
+    code: str
+    fasta_path: str
+    csv_path: str
+    names: Tuple[str, ...]
+
+    def __len__(self):
+        return len(self.names)
+
+
+def load_reference(code: str, fasta_path: str, csv_path: str) -> Reference:
+    """
+    validates the fasta and csv of a code
+    :param code: the code of the reference
+    :param fasta_path: path to code.fasta
+    :param csv_path: path to code.csv
+    :return: a Reference
+    """
+    validate_fasta_file(fasta_path)
+    validate_csv_file(fasta_path, csv_path)
+    return Reference(
+        code,
+        os.path.abspath(fasta_path),
+        os.path.abspath(csv_path),
+        tuple(fasta_to_dict(fasta_path).keys()),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def rna_map_version_matches() -> bool:
+    """
+    checks the installed rna_map is the one run_rna_map_validated mirrors
+    :return: True if the installed version is RNA_MAP_VERSION
+    """
+    try:
+        version = metadata.version("rna_map")
+    except metadata.PackageNotFoundError:
+        version = None
+    if version != RNA_MAP_VERSION:
+        log.warning(
+            f"rna_map {version} is installed but only {RNA_MAP_VERSION} is "
+            "known to match run_rna_map_validated, inputs will be validated "
+            "on every run"
+        )
+        return False
+    return True
+
+
+def run_rna_map_validated(
+    fasta: str, fastq1: str, fastq2: str, dot_bracket: str, params: Dict = None
+) -> None:
+    """
+    runs rna_map the same way as rna_map.run.run of RNA_MAP_VERSION but
+    without validating the inputs, which reads the whole fasta and csv again
+    on every call. Only use it with the fasta and csv of a Reference and
+    fastqs that were checked with valid_fastq_files. Any other rna_map
+    version runs rna_map.run.run instead
+    :param fasta: path to the reference fasta
+    :param fastq1: path to the first fastq
+    :param fastq2: path to the second fastq
+    :param dot_bracket: path to the secondary structure csv
+    :param params: rna_map parameters
+    :return: None
+    """
+    if not rna_map_version_matches():
+        run_rna_map(fasta, fastq1, fastq2, dot_bracket, params)
+        return
+    ins = Inputs(Path(fasta), Path(fastq1), Path(fastq2), Path(dot_bracket))
+    if params is None:
+        params = get_default_params()
+    else:
+        validate_parameters(params)
+    m = Mapper()
+    m.setup(params)
+    m.check_program_versions()
+    m.run(ins)
+    bt = BitVectorGenerator()
+    bt.setup(params)
+    sam_path = Path(params["dirs"]["output"]) / "Mapping_Files" / "aligned.sam"
+    bt.run(sam_path, ins.fasta, ins.is_paired(), ins.csv)
+    with open(Path(params["dirs"]["log"]) / "params.yml", "w") as f:
+        yaml.dump(params, f)
+
+
+def _file_stamp(*paths) -> Tuple:
+    return tuple((os.stat(p).st_mtime_ns, os.stat(p).st_size) for p in paths)
+
+
+class ReferenceCache:
+    """
+    references used by a sample sheet, each code is loaded exactly once
+    """
+
+    def __init__(self):
+        self._refs = {}
+        # code -> mtime and size of the fasta and csv when they were loaded
+        self._stamps = {}
+
+    def __contains__(self, code):
+        return str(code) in self._refs
+
+    def __len__(self):
+        return len(self._refs)
+
+    def get(self, code) -> Reference:
+        """
+        :param code: the code of the reference
+        :return: the Reference
+        """
+        return self._refs[str(code)]
+
+    def load(self, df: pd.DataFrame, seq_data_path: str) -> bool:
+        """
+        loads every unique code in the sample sheet that is not already
+        loaded from seq_data_path/fasta/code.fasta and seq_data_path/rna/code.csv
+        :param df: sample sheet with a code column
+        :param seq_data_path: path to the directory with fasta/ and rna/
+        :return: True if every reference exists and is valid
+        """
+        check_if_columns_exist(df, ["code"])
+        codes = [str(c) for c in df["code"].unique() if str(c) not in self]
+        for code in codes:
+            fasta = Path(seq_data_path) / "fasta" / f"{code}.fasta"
+            csv = Path(seq_data_path) / "rna" / f"{code}.csv"
+            for path in [fasta, csv]:
+                if not os.path.exists(path):
+                    log.error(f"reference file: {path} does not exist")
+                    return False
+            try:
+                self._refs[code] = load_reference(code, fasta, csv)
+                self._stamps[code] = _file_stamp(fasta, csv)
+            except (DREEMInputException, KeyError) as e:
+                log.error(f"reference {code} is not valid: {e}")
+                return False
+        log.info(
+            f"loaded {len(codes)} references for {len(df)} rows of the sample "
+            f"sheet"
+        )
+        return True
+
+    def drop_stale(self) -> int:
+        """
+        removes references whose fasta or csv changed since they were loaded
+        so the next load reads them again
+        :return: number of references removed
+        """
+        stale = []
+        for code, stamp in self._stamps.items():
+            ref = self._refs[code]
+            try:
+                if _file_stamp(ref.fasta_path, ref.csv_path) != stamp:
+                    stale.append(code)
+            except FileNotFoundError:
+                stale.append(code)
+        for code in stale:
+            del self._refs[code]
+            del self._stamps[code]
+        return len(stale)
+
+    def save(self, path: str) -> None:
+        """
+        writes a read only snapshot that workers can load instead of
+        validating every reference again
+        :param path: path to the snapshot
+        :return: None
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                (self._refs, self._stamps), f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_snapshot(cls, path: str) -> "ReferenceCache":
+        """
+        loads a snapshot written by save, call drop_stale to remove
+        references whose files changed since it was written
+        :param path: path to the snapshot
+        :return: a ReferenceCache
+        """
+        cache = cls()
+        with open(path, "rb") as f:
+            cache._refs, cache._stamps = pickle.load(f)
+        return cache
@@ -2,21 +2,39 @@
 This module contains the runmulti function.
 """
 import os
+import json
+import shutil
 import yaml
 import pandas as pd
 from pathlib import Path
 
 from rna_map_tools.dataframe import check_if_columns_exist
 from rna_map_tools.logger import get_logger
-from rna_map_tools.fastq import get_paired_fastqs
+from rna_map_tools.compression import decompress_file, strip_extension
+from rna_map_tools.fastq import (
+    FastqFile,
+    get_paired_fastqs,
+    validate_fastq_file,
+)
 from rna_map_tools.exceptions import RNAMapToolsInputException
+from rna_map_tools.read_store import ReadStore, is_read_store
+from rna_map_tools.tools.chunked import run_rna_map_chunked
+from rna_map_tools.tools.references import (
+    ReferenceCache,
+    run_rna_map_validated,
+)
+from rna_map_tools.tools.workqueue import (
+    WorkQueue,
+    check_claim,
+    run_worker,
+)
 
 from rna_map.run import (
-    validate_fastq_file,
     validate_fasta_file,
     validate_csv_file,
 )
 from rna_map.run import run as run_rna_map
+from rna_map.exception import DREEMInputException
 from rna_map.mutation_histogram import (
     get_dataframe,
     get_mut_histos_from_json_file,
@@ -25,15 +43,41 @@ from rna_map.mutation_histogram import (
 log = get_logger("RUNMULTI")
 
 
-def valid_fastq_files(df: pd.DataFrame, data_path: str) -> bool:
+def valid_read_store(df: pd.DataFrame, store_path: str, full: bool = False):
+    """
+    Check that every barcode has valid reads in a read store
+    :param df: pandas dataframe that contains the barcode information
+    :param store_path: path to the read store
+    :param full: check every record not just the first
+    :return: True if every barcode is in the store and valid
+    """
+    with ReadStore(store_path) as store:
+        for barcode_seq in df["barcode_seq"].unique():
+            if barcode_seq not in store:
+                log.error(f"barcode: {barcode_seq} is not in {store_path}")
+                return False
+            if not store.validate(barcode_seq, full):
+                log.error(
+                    f"reads of barcode: {barcode_seq} are not valid fastqs"
+                )
+                return False
+    return True
+
+
+def valid_fastq_files(
+    df: pd.DataFrame, data_path: str, full: bool = False
+) -> bool:
     """
     Check that the fastq files exist
     :param df: pandas dataframe that contains the barcode information
-    :param data_path: path to the data directory
+    :param data_path: path to the data directory or a read store
+    :param full: check every record of uncompressed fastqs not just the first
     :return: True if the fastq files exist, False otherwise
     """
     expects = ["barcode", "barcode_seq", "construct"]
     check_if_columns_exist(df, expects)
+    if is_read_store(data_path):
+        return valid_read_store(df, data_path, full)
     msg = f"\n{data_path} directory structure should be as follows:"
     msg += "each BARCODE directory should be the sequence of the barcode as "
     msg += "it appears in the data.csv\n"
@@ -58,7 +102,7 @@ def valid_fastq_files(df: pd.DataFrame, data_path: str) -> bool:
             log.error(msg)
             return False
         for fq in [pfq.read_1, pfq.read_2]:
-            if not validate_fastq_file(fq.path):
+            if not validate_fastq_file(fq.path, full):
                 log.error(f"fastq file: {fq.path} is not a valid fastq")
                 log.error(msg)
                 return False
@@ -79,54 +123,86 @@ def valid_fasta_files(df: pd.DataFrame, fasta_path: str) -> bool:
     msg += "  |--code_2.fasta\n"
     fasta_path = Path(fasta_path)
     check_if_columns_exist(df, ["code"])
-    for _, row in df.iterrows():
-        fasta = Path(fasta_path) / f'{row["code"]}.fasta'
+    # many rows share the same code only check each file once
+    for code in df["code"].unique():
+        fasta = Path(fasta_path) / f"{code}.fasta"
         if not os.path.exists(fasta):
             log.error(f"fasta file: {fasta} does not exist")
             log.error(msg)
             return False
-        if not validate_fasta_file(fasta):
-            log.error(f"fasta file: {fasta} is not a valid fasta")
+        try:
+            validate_fasta_file(fasta)
+        except DREEMInputException as e:
+            log.error(f"fasta file: {fasta} is not a valid fasta: {e}")
             log.error(msg)
             return False
     return True
 
 
-def valid_csv_files(df: pd.DataFrame, csv_path: str) -> bool:
+def valid_csv_files(
+    df: pd.DataFrame, csv_path: str, fasta_path: str = None
+) -> bool:
+    """
+    Check that the secondary structure csv files exist
+    :param df: pandas dataframe with a code column
+    :param csv_path: path to the directory with code.csv files
+    :param fasta_path: if supplied each csv is checked against code.fasta
+    :return: True if all csv files exist and are valid
+    """
     check_if_columns_exist(df, ["code"])
-    for _, row in df.iterrows():
-        csv = Path(csv_path) / row["code"] + ".csv"
+    for code in df["code"].unique():
+        csv = Path(csv_path) / f"{code}.csv"
         if not os.path.exists(csv):
             log.error(f"csv file: {csv} does not exist")
             return False
-        if not validate_csv_file(csv):
-            log.error(f"csv file: {csv} is not a valid csv")
+        if fasta_path is None:
+            continue
+        try:
+            validate_csv_file(Path(fasta_path) / f"{code}.fasta", csv)
+        except DREEMInputException as e:
+            log.error(f"csv file: {csv} is not a valid csv: {e}")
             return False
     return True
 
 
-
-
-def runmulti(df, run_path, data_path, seq_data_path, params):
-    # TODO add option to hide rna-map output
-    # TODO add some processing before to remove katie's constructs
-    # TODO add validation for csvs
-    # TODO give links to instructions for how to setup data and google drive
-    # check everything is setup properly and exists
+def check_runmulti_inputs(
+    df, run_path, data_path, seq_data_path, references=None, full=False
+) -> ReferenceCache:
+    """
+    checks everything is setup properly and exists before starting a run
+    :param df: pandas dataframe that contains the construct information
+    :param run_path: path to the run directory
+    :param data_path: path to the demultiplexed data directory
+    :param seq_data_path: path to the directory with fasta/ and rna/
+    :param references: already validated references, codes that are missing
+    from it are loaded
+    :param full: check every record of the fastqs not just the first
+    :return: the references used by the sample sheet
+    """
     if not os.path.exists(run_path):
         log.error(f"{run_path} does not exist cannot run multi")
         exit()
     # check all the data is valid before starting the run!
     # check to make sure fastqs actually exist and are valid
-    if not valid_fastq_files(df, data_path):
+    if not valid_fastq_files(df, data_path, full):
         exit()
-    # check to make sure fasta exists
-    if not valid_fasta_files(df, Path(seq_data_path) / "fasta"):
-        exit()
-    # check to make sure csv exists
-    if not valid_csv_files(df, Path(seq_data_path) / "rna"):
+    # check to make sure fasta and csv files exist and are valid, each code
+    # is only loaded once
+    if references is None:
+        references = ReferenceCache()
+    if not references.load(df, seq_data_path):
         exit()
+    return references
+
 
+def setup_run_dir(df: pd.DataFrame, run_path) -> pd.DataFrame:
+    """
+    creates processed/ and analysis/ in the run directory and moves into
+    processed/
+    :param df: pandas dataframe that contains the construct information
+    :param run_path: path to the run directory
+    :return: the dataframe with old column names updated
+    """
     os.chdir(run_path)
     # catch old column names
     if "name" in df:
@@ -137,22 +213,192 @@ def runmulti(df, run_path, data_path, seq_data_path, params):
     os.makedirs("processed", exist_ok=True)
     os.makedirs("analysis", exist_ok=True)
     os.chdir("processed")
-    dfs = []
+    return df
+
+
+def get_construct_dir_name(row) -> str:
+    """
+    the name of the processed/ directory for a given construct
+    :param row: a row of the construct dataframe
+    :return: the directory name
+    """
+    return row["construct"] + "_" + row["code"] + "_" + row["data_type"]
+
+
+def run_construct(
+    row, data_path, seq_data_path, params, references=None
+) -> str:
+    """
+    runs rna_map on a single construct, must be called from processed/
+    :param row: a row of the construct dataframe
+    :param data_path: path to the demultiplexed data directory or a read
+    store
+    :param seq_data_path: path to the directory with fasta/ and rna/
+    :param params: runmulti parameters
+    :param references: validated references, rna_map does not validate the
+    fasta and csv of a code in it again
+    :return: the path to the directory rna_map was run in
+    """
+    # TODO add option to skip processing
+    dir_name = get_construct_dir_name(row)
+    os.makedirs(dir_name, exist_ok=True)
+    cur_dir = os.getcwd()
+    os.chdir(dir_name)
+    fa_path = f"{seq_data_path}/fasta/{row['code']}.fasta"
+    dot_bracket_path = f"{seq_data_path}/rna/{row['code']}.csv"
+    validated = references is not None and row["code"] in references
+    if validated:
+        reference = references.get(row["code"])
+        fa_path = reference.fasta_path
+        dot_bracket_path = reference.csv_path
+    from_store = is_read_store(data_path)
+    if from_store:
+        with ReadStore(data_path) as store:
+            store.export(row["barcode_seq"], "reads")
+        pfqs = get_paired_fastqs("reads")
+    else:
+        pfqs = get_paired_fastqs(f"{data_path}/{row['barcode_seq']}/test_S1")
+    # notice the switch of fastq1 and fastq2 since we are working with RNA
+    fastq1_path = get_rna_map_fastq(pfqs.read_2.path)
+    fastq2_path = get_rna_map_fastq(pfqs.read_1.path)
+    # decompressed copies made for rna_map
+    copies = [
+        path
+        for path, src in [
+            (fastq1_path, pfqs.read_2.path),
+            (fastq2_path, pfqs.read_1.path),
+        ]
+        if path != src
+    ]
+    params_path = params["rna_map_params_file"]
+    rna_map_params = yaml.safe_load(open(params_path))
+    try:
+        # reads are ready, do not start rna_map if another worker owns the
+        # construct now
+        check_claim()
+        if params["chunk_records"] > 0:
+            run_rna_map_chunked(
+                fa_path,
+                fastq1_path,
+                fastq2_path,
+                dot_bracket_path,
+                rna_map_params,
+                params["chunk_records"],
+                params["chunk_workers"],
+                validated,
+            )
+        elif validated:
+            run_rna_map_validated(
+                fa_path,
+                fastq1_path,
+                fastq2_path,
+                dot_bracket_path,
+                rna_map_params,
+            )
+        else:
+            run_rna_map(
+                fa_path,
+                fastq1_path,
+                fastq2_path,
+                dot_bracket_path,
+                rna_map_params,
+            )
+    finally:
+        for path in copies:
+            os.remove(path)
+        if from_store:
+            shutil.rmtree("reads")
+        os.chdir(cur_dir)
+    return os.path.join(cur_dir, dir_name)
+
+
+def get_rna_map_fastq(fastq_path: str) -> str:
+    """
+    rna_map can only read uncompressed or gzipped fastqs, other codecs are
+    decompressed into the current directory
+    :param fastq_path: path to a fastq file of any supported codec
+    :return: path to a fastq rna_map can read
+    """
+    if FastqFile(fastq_path).codec() in ["none", "gzip"]:
+        return fastq_path
+    dest_path = os.path.basename(strip_extension(fastq_path))
+    log.info(f"decompressing {fastq_path} -> {dest_path}")
+    decompress_file(fastq_path, dest_path)
+    return os.path.abspath(dest_path)
+
+
+def runmulti(df, run_path, data_path, seq_data_path, params):
+    # TODO add option to hide rna-map output
+    # TODO add some processing before to remove katie's constructs
+    # TODO add validation for csvs
+    # TODO give links to instructions for how to setup data and google drive
+    references = check_runmulti_inputs(
+        df,
+        run_path,
+        data_path,
+        seq_data_path,
+        full=params["full_validation"],
+    )
+    df = setup_run_dir(df, run_path)
     for i, row in df.iterrows():
-        # TODO add option to skip processing
-        dir_name = row["construct"] + "_" + row["code"] + "_" + row["data_type"]
-        os.chdir(dir_name)
-        fa_path = f"{seq_data_path}/fasta/{row['code']}.fasta"
-        # notice the switch of fastq1 and fastq2 since we are working with RNA
-        fastq1_path = (
-            f"{data_path}/{row['barcode_seq']}/test_S1_L001_R2_001.fastq"
-        )
-        fastq2_path = (
-            f"{data_path}/{row['barcode_seq']}/test_S1_L001_R1_001.fastq"
-        )
-        dot_bracket_path = f"{seq_data_path}/rna/{row['code']}.csv"
-        params_path = params["rna_map_params_file"]
-        rna_map_params = yaml.safe_load(open(params_path))
-        run_rna_map(
-            fa_path, fastq1_path, fastq2_path, dot_bracket_path, rna_map_params
+        run_construct(row, data_path, seq_data_path, params, references)
+
+
+def runmulti_worker(
+    df, run_path, data_path, seq_data_path, params, worker_id=None
+):
+    """
+    runs runmulti as one of many workers sharing the same run directory. Any
+    number of workers on any number of nodes can be started against the same
+    run_path as long as it is on a shared filesystem. Each construct is
+    claimed by exactly one worker, see rna_map_tools.tools.workqueue
+    :param df: pandas dataframe that contains the construct information
+    :param run_path: path to the run directory must be on a shared filesystem
+    :param data_path: path to the demultiplexed data directory
+    :param seq_data_path: path to the directory with fasta/ and rna/
+    :param params: runmulti parameters
+    :param worker_id: unique name of this worker defaults to hostname-pid
+    :return: dictionary of results for all constructs finished so far
+    """
+    # the first worker to validate the references saves them for the rest
+    snapshot_path = os.path.join(run_path, "references.p")
+    references = None
+    if os.path.exists(snapshot_path):
+        references = ReferenceCache.from_snapshot(snapshot_path)
+        num_stale = references.drop_stale()
+        if num_stale > 0:
+            log.info(f"{num_stale} references changed since {snapshot_path}")
+    num_loaded = 0 if references is None else len(references)
+    references = check_runmulti_inputs(
+        df,
+        run_path,
+        data_path,
+        seq_data_path,
+        references,
+        params["full_validation"],
+    )
+    if not os.path.exists(snapshot_path) or len(references) != num_loaded:
+        references.save(snapshot_path)
+    run_path = os.path.abspath(run_path)
+    df = setup_run_dir(df, run_path)
+    queue = WorkQueue(os.path.join(run_path, "queue"))
+    items = {
+        f"{i:06d}": json.loads(row.to_json()) for i, row in df.iterrows()
+    }
+    queue.populate(items)
+
+    def run_item(item_id, row):
+        path = run_construct(
+            row, data_path, seq_data_path, params, references
         )
+        return {"construct": row["construct"], "dir": path}
+
+    run_worker(
+        queue,
+        run_item,
+        worker_id=worker_id,
+        heartbeat_interval=params["heartbeat_interval"],
+        stale_timeout=params["stale_timeout"],
+        poll_interval=params["poll_interval"],
+    )
+    return queue.gather_results()
@@ -0,0 +1,102 @@
+"""
+caps the number of read pairs of each barcode. Pairs are kept with a fixed
+probability, a maximum depth or both, in one streaming pass that is part of
+the per barcode finalize pass of demultiplexing. The random number generator
+is seeded from the seed parameter and the barcode so reruns keep the same
+reads.
+"""
+import random
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Iterator, Tuple
+
+import pandas as pd
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("SUBSAMPLE")
+
+
+@dataclass
+class SubsampleStats:
+    """
+    number of read pairs of one barcode before and after subsampling
+    """
+
+    pairs_in: int = 0
+    pairs_out: int = 0
+
+
+def get_rng(seed: int, barcode_seq: str) -> random.Random:
+    """
+    :param seed: the seed parameter
+    :param barcode_seq: the barcode being subsampled
+    :return: a random number generator that is the same on every run
+    """
+    return random.Random(f"{seed}:{barcode_seq}")
+
+
+def subsample_pairs(
+    pairs: Iterable[Tuple],
+    params: Dict,
+    rng: random.Random,
+    stats: SubsampleStats,
+) -> Iterator[Tuple]:
+    """
+    subsamples a stream of read pairs. With a fraction each pair is kept
+    with that probability. With a max_depth a uniform sample of at most
+    max_depth pairs is kept by reservoir sampling, which holds up to
+    max_depth pairs in memory and yields them in their original order
+    :param pairs: (read 1, read 2) records from read_fastq_pairs
+    :param params: the demultiplex/subsample section of the parameters
+    :param rng: random number generator from get_rng
+    :param stats: updated with the number of pairs in and out
+    :return: iterator of the kept pairs
+    """
+    fraction = params["fraction"]
+    max_depth = params["max_depth"]
+    if max_depth is None:
+        for pair in pairs:
+            stats.pairs_in += 1
+            if fraction is None or rng.random() < fraction:
+                stats.pairs_out += 1
+                yield pair
+        return
+    reservoir = []
+    seen = 0
+    for pair in pairs:
+        stats.pairs_in += 1
+        if fraction is not None and rng.random() >= fraction:
+            continue
+        if seen < max_depth:
+            reservoir.append((seen, pair))
+        else:
+            j = rng.randint(0, seen)
+            if j < max_depth:
+                reservoir[j] = (seen, pair)
+        seen += 1
+    reservoir.sort(key=lambda item: item[0])
+    stats.pairs_out += len(reservoir)
+    for _, pair in reservoir:
+        yield pair
+
+
+def write_subsample_stats(
+    stats: Dict[str, SubsampleStats], path: str
+) -> pd.DataFrame:
+    """
+    writes per barcode subsampling statistics to a csv
+    :param stats: SubsampleStats for each barcode sequence
+    :param path: path of the csv
+    :return: the statistics as a dataframe
+    """
+    df = pd.DataFrame(
+        [{"barcode_seq": barcode, **asdict(s)} for barcode, s in stats.items()]
+    )
+    df.to_csv(path, index=False)
+    if len(df) > 0:
+        num_capped = int((df["pairs_out"] < df["pairs_in"]).sum())
+        log.info(
+            f"subsampled {num_capped} of {len(df)} barcodes, kept "
+            f"{df['pairs_out'].sum()} of {df['pairs_in'].sum()} read pairs"
+        )
+    return df
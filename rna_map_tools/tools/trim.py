@@ -0,0 +1,180 @@
+"""
+trims constant 5'/3' regions and low quality tails from demultiplexed reads.
+Trimming happens in the same pass that compresses each barcode's output so
+the reads are only read and written once after demultiplexing.
+"""
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Iterator, Tuple
+
+import pandas as pd
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("TRIM")
+
+
+@dataclass
+class TrimStats:
+    """
+    counts of what was trimmed from the reads of one barcode
+    """
+
+    pairs: int = 0
+    pairs_written: int = 0
+    too_short: int = 0
+    five_prime_trimmed: int = 0
+    three_prime_trimmed: int = 0
+    quality_trimmed: int = 0
+    bases_in: int = 0
+    bases_out: int = 0
+
+    def add(self, other: "TrimStats") -> None:
+        for key, value in asdict(other).items():
+            setattr(self, key, getattr(self, key) + value)
+
+
+@dataclass(frozen=True)
+class ReadTrimmer:
+    """
+    trims a single read
+    :param five_prime: constant sequence removed from the start of the read
+    :param three_prime: adapter removed from the end of the read, a partial
+    adapter at the very end is removed if at least min_overlap bases match
+    :param quality_cutoff: phred cutoff for 3' quality trimming, 0 disables
+    :param min_overlap: shortest partial adapter that is removed
+    :param quality_offset: phred offset of the quality encoding
+    """
+
+    five_prime: bytes = b""
+    three_prime: bytes = b""
+    quality_cutoff: int = 0
+    min_overlap: int = 3
+    quality_offset: int = 33
+
+    def quality_trim_index(self, qual: bytes) -> int:
+        """
+        finds where to cut the 3' end, the same running sum used by bwa and
+        cutadapt
+        :param qual: quality string of the read
+        :return: index to cut the read at
+        """
+        total = 0
+        max_total = 0
+        cut = len(qual)
+        for i in range(len(qual) - 1, -1, -1):
+            total += self.quality_cutoff - (qual[i] - self.quality_offset)
+            if total < 0:
+                break
+            if total > max_total:
+                max_total = total
+                cut = i
+        return cut
+
+    def adapter_index(self, seq: bytes) -> int:
+        """
+        :param seq: sequence of the read
+        :return: index where the 3' adapter starts or len(seq) if not found
+        """
+        pos = seq.find(self.three_prime)
+        if pos != -1:
+            return pos
+        longest = min(len(self.three_prime) - 1, len(seq))
+        for k in range(longest, self.min_overlap - 1, -1):
+            if seq.endswith(self.three_prime[:k]):
+                return len(seq) - k
+        return len(seq)
+
+    def trim(
+        self, seq: bytes, qual: bytes, stats: TrimStats
+    ) -> Tuple[bytes, bytes]:
+        """
+        :param seq: sequence of the read
+        :param qual: quality string of the read
+        :param stats: updated with what was trimmed
+        :return: trimmed sequence and quality
+        """
+        if self.quality_cutoff > 0:
+            cut = self.quality_trim_index(qual)
+            if cut < len(seq):
+                stats.quality_trimmed += 1
+                seq, qual = seq[:cut], qual[:cut]
+        if self.five_prime and seq.startswith(self.five_prime):
+            stats.five_prime_trimmed += 1
+            n = len(self.five_prime)
+            seq, qual = seq[n:], qual[n:]
+        if self.three_prime:
+            cut = self.adapter_index(seq)
+            if cut < len(seq):
+                stats.three_prime_trimmed += 1
+                seq, qual = seq[:cut], qual[:cut]
+        return seq, qual
+
+
+def get_trimmers(params: Dict) -> Tuple[ReadTrimmer, ReadTrimmer]:
+    """
+    builds the read 1 and read 2 trimmers from the demultiplex trim params
+    :param params: the demultiplex/trim section of the parameters
+    :return: trimmer for read 1 and read 2
+    """
+    trimmers = []
+    for read in ["read_1", "read_2"]:
+        trimmers.append(
+            ReadTrimmer(
+                params[f"{read}_five_prime"].upper().encode(),
+                params[f"{read}_three_prime"].upper().encode(),
+                params["quality_cutoff"],
+                params["min_overlap"],
+            )
+        )
+    return trimmers[0], trimmers[1]
+
+
+def trim_pairs(
+    pairs: Iterable[Tuple], params: Dict, stats: TrimStats
+) -> Iterator[Tuple]:
+    """
+    trims a stream of read pairs, pairs where either read ends up shorter
+    than min_length are dropped
+    :param pairs: (read 1, read 2) records from read_fastq_pairs
+    :param params: the demultiplex/trim section of the parameters
+    :param stats: updated with what was trimmed
+    :return: iterator of trimmed pairs
+    """
+    trimmers = get_trimmers(params)
+    min_length = params["min_length"]
+    for records in pairs:
+        stats.pairs += 1
+        trimmed = []
+        for (header, seq, plus, qual), trimmer in zip(records, trimmers):
+            stats.bases_in += len(seq)
+            seq, qual = trimmer.trim(seq, qual, stats)
+            trimmed.append((header, seq, plus, qual))
+        if any(len(record[1]) < min_length for record in trimmed):
+            stats.too_short += 1
+            continue
+        stats.pairs_written += 1
+        stats.bases_out += len(trimmed[0][1]) + len(trimmed[1][1])
+        yield trimmed[0], trimmed[1]
+
+
+def write_trim_stats(stats: Dict[str, TrimStats], path: str) -> pd.DataFrame:
+    """
+    writes per barcode trim statistics to a csv
+    :param stats: TrimStats for each barcode sequence
+    :param path: path of the csv
+    :return: the statistics as a dataframe
+    """
+    df = pd.DataFrame(
+        [{"barcode_seq": barcode, **asdict(s)} for barcode, s in stats.items()]
+    )
+    df.to_csv(path, index=False)
+    total = TrimStats()
+    for s in stats.values():
+        total.add(s)
+    if total.pairs > 0:
+        log.info(
+            f"trimmed {total.pairs} read pairs, kept {total.pairs_written} "
+            f"({100 * total.pairs_written / total.pairs:.1f}%), "
+            f"{total.bases_in - total.bases_out} bases removed"
+        )
+    return df
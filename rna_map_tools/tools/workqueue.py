@@ -0,0 +1,372 @@
+"""
+a work queue that lives entirely on a shared filesystem (NFS/Lustre) so that
+any number of workers on any number of nodes can split up the same set of
+items. All state changes are done with atomic renames/links so no locking
+daemon is required.
+
+queue layout:
+--QUEUE_PATH/
+  |--items/     every item ever added, written once
+  |--todo/      items waiting to be claimed
+  |--claimed/   ITEM_ID@WORKER_ID.json, mtime is the heartbeat
+  |--done/      finished items
+  |--failed/    items that raised an exception
+  |--results/   ITEM_ID.json result of each finished or failed item
+"""
+import os
+import json
+import time
+import glob
+import socket
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from rna_map_tools.logger import get_logger
+
+log = get_logger("WORKQUEUE")
+
+QUEUE_DIRS = ["items", "todo", "claimed", "done", "failed", "results"]
+
+
+class ClaimLostError(Exception):
+    """
+    raised by check_claim once the claim on the current item was taken over
+    by another worker
+    """
+
+
+# the heartbeat of the item the current thread is working on
+_CURRENT = threading.local()
+
+
+def get_default_worker_id() -> str:
+    """
+    a worker id that is unique across nodes
+    :return: hostname-pid
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json_atomic(path: str, data) -> None:
+    """
+    writes json to a temporary file and renames it into place so readers
+    never see a partial file
+    :param path: final path of the file
+    :param data: json serializable data
+    :return: None
+    """
+    tmp_path = f"{path}.{get_default_worker_id()}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@dataclass(frozen=True)
+class Claim:
+    """
+    an item claimed by a worker
+    """
+
+    item_id: str
+    worker_id: str
+    path: str
+
+
+class WorkQueue:
+    """
+    a queue of items stored in a directory on a shared filesystem
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        for d in QUEUE_DIRS:
+            os.makedirs(os.path.join(self.path, d), exist_ok=True)
+
+    def _dir(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def populate(self, items: Dict[str, dict]) -> int:
+        """
+        adds items to the queue. Safe to call from every worker at the same
+        time, each item is only ever queued once
+        :param items: dictionary of item id to a json serializable payload
+        :return: the number of items this call added
+        """
+        count = 0
+        for item_id, payload in items.items():
+            if "@" in item_id or os.sep in item_id:
+                raise ValueError(f"invalid item id: {item_id}")
+            item_path = os.path.join(self._dir("items"), f"{item_id}.json")
+            if os.path.exists(item_path):
+                continue
+            tmp_path = f"{item_path}.{get_default_worker_id()}.tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(payload, f)
+            # link is atomic and fails if the item exists, so only one worker
+            # will ever queue a given item
+            try:
+                os.link(tmp_path, item_path)
+            except FileExistsError:
+                continue
+            finally:
+                os.remove(tmp_path)
+            os.link(
+                item_path, os.path.join(self._dir("todo"), f"{item_id}.json")
+            )
+            count += 1
+        if count > 0:
+            log.info(f"added {count} items to queue {self.path}")
+        return count
+
+    def get_payload(self, item_id: str) -> dict:
+        """
+        gets the payload of an item
+        :param item_id: the id of the item
+        :return: the payload given to populate
+        """
+        with open(os.path.join(self._dir("items"), f"{item_id}.json")) as f:
+            return json.load(f)
+
+    def claim(self, worker_id: str) -> Optional[Claim]:
+        """
+        claims the next item in todo/
+        :param worker_id: the id of the worker claiming the item
+        :return: a Claim or None if nothing is left to claim
+        """
+        for path in sorted(glob.glob(os.path.join(self._dir("todo"), "*.json"))):
+            item_id = os.path.basename(path)[:-5]
+            claim_path = os.path.join(
+                self._dir("claimed"), f"{item_id}@{worker_id}.json"
+            )
+            # the heartbeat is set before the rename, otherwise the claim
+            # carries the mtime of populate and reclaim_stale can requeue it
+            # right away
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                continue
+            # only one worker can win the rename
+            try:
+                os.rename(path, claim_path)
+            except FileNotFoundError:
+                continue
+            return Claim(item_id, worker_id, claim_path)
+        return None
+
+    def heartbeat(self, claim: Claim) -> bool:
+        """
+        marks a claim as still being worked on
+        :param claim: the claim to update
+        :return: False if the claim has been reclaimed by another worker
+        """
+        try:
+            os.utime(claim.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def reclaim_stale(self, stale_timeout: float) -> int:
+        """
+        moves claims whose heartbeat is older than stale_timeout back to todo/
+        :param stale_timeout: seconds without a heartbeat before a claim is
+        considered abandoned
+        :return: the number of claims that were moved back
+        """
+        count = 0
+        now = time.time()
+        for path in glob.glob(os.path.join(self._dir("claimed"), "*.json")):
+            try:
+                age = now - os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            if age < stale_timeout:
+                continue
+            item_id, worker_id = os.path.basename(path)[:-5].split("@", 1)
+            try:
+                os.rename(
+                    path, os.path.join(self._dir("todo"), f"{item_id}.json")
+                )
+            except FileNotFoundError:
+                continue
+            log.warning(
+                f"reclaimed {item_id} from {worker_id} no heartbeat for "
+                f"{age:.0f} seconds"
+            )
+            count += 1
+        return count
+
+    def _finish(self, claim: Claim, dest: str, result) -> bool:
+        result_path = os.path.join(self._dir("results"), f"{claim.item_id}.json")
+        tmp_path = f"{result_path}.{claim.worker_id}.tmp"
+        _write_json_atomic(tmp_path, result)
+        # moving the claim proves this worker still owns the item, a lost
+        # item is left where it is for the worker that owns it now
+        try:
+            os.rename(
+                claim.path,
+                os.path.join(self._dir(dest), f"{claim.item_id}.json"),
+            )
+        except FileNotFoundError:
+            os.remove(tmp_path)
+            log.warning(
+                f"{claim.item_id} was reclaimed by another worker while "
+                f"{claim.worker_id} was still working on it, result dropped"
+            )
+            return False
+        os.replace(tmp_path, result_path)
+        return True
+
+    def complete(self, claim: Claim, result: dict) -> bool:
+        """
+        records the result of a finished item
+        :param claim: the claim that was finished
+        :param result: json serializable result
+        :return: False if the claim was lost and nothing was recorded
+        """
+        return self._finish(
+            claim, "done", {"status": "done", "result": result}
+        )
+
+    def fail(self, claim: Claim, error: str) -> bool:
+        """
+        records that an item raised an error
+        :param claim: the claim that failed
+        :param error: description of the error
+        :return: False if the claim was lost and nothing was recorded
+        """
+        return self._finish(
+            claim, "failed", {"status": "failed", "error": error}
+        )
+
+    def num_items(self, name: str) -> int:
+        """
+        the number of items in one of the queue directories
+        :param name: todo, claimed, done or failed
+        :return: number of items
+        """
+        return len(glob.glob(os.path.join(self._dir(name), "*.json")))
+
+    def is_finished(self) -> bool:
+        """
+        checks if every item has either been finished or failed
+        :return: True if nothing is left to do
+        """
+        return self.num_items("todo") == 0 and self.num_items("claimed") == 0
+
+    def gather_results(self) -> Dict[str, dict]:
+        """
+        collects the results of all finished items and writes them to
+        results.json in the queue directory
+        :return: dictionary of item id to result
+        """
+        results = {}
+        for path in sorted(glob.glob(os.path.join(self._dir("results"), "*.json"))):
+            with open(path) as f:
+                results[os.path.basename(path)[:-5]] = json.load(f)
+        _write_json_atomic(os.path.join(self.path, "results.json"), results)
+        return results
+
+
+class Heartbeat:
+    """
+    updates the heartbeat of a claim in a background thread and marks the
+    claim as lost once another worker took it over. Nothing is interrupted,
+    the item being worked on calls check_claim between its stages
+    """
+
+    def __init__(self, queue: WorkQueue, claim: Claim, interval: float):
+        self._queue = queue
+        self._claim = claim
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            if self._queue.heartbeat(self._claim):
+                continue
+            log.warning(f"lost claim on {self._claim.item_id} aborting")
+            self.lost = True
+            return
+
+    def __enter__(self):
+        _CURRENT.heartbeat = self
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        _CURRENT.heartbeat = None
+        self._stop.set()
+        self._thread.join()
+
+
+def check_claim() -> None:
+    """
+    raises ClaimLostError if the item the current thread is working on was
+    taken over by another worker. Call it between the stages of an item, it
+    does nothing outside of run_worker
+    :return: None
+    """
+    heartbeat = getattr(_CURRENT, "heartbeat", None)
+    if heartbeat is not None and heartbeat.lost:
+        raise ClaimLostError(heartbeat._claim.item_id)
+
+
+def run_worker(
+    queue: WorkQueue,
+    func: Callable[[str, dict], dict],
+    worker_id: str = None,
+    heartbeat_interval: float = 30,
+    stale_timeout: float = 300,
+    poll_interval: float = 10,
+) -> int:
+    """
+    claims and processes items until the queue is finished
+    :param queue: the queue to work on
+    :param func: called with (item_id, payload) must return a json
+    serializable result, long running items should call check_claim between
+    stages so a lost item is given up early
+    :param worker_id: unique name of this worker defaults to hostname-pid
+    :param heartbeat_interval: seconds between heartbeats
+    :param stale_timeout: seconds without a heartbeat before another worker
+    reclaims an item, must be much larger than heartbeat_interval
+    :param poll_interval: seconds to wait when other workers still hold claims
+    :return: the number of items this worker processed
+    """
+    if worker_id is None:
+        worker_id = get_default_worker_id()
+    log.info(f"starting worker {worker_id} on {queue.path}")
+    count = 0
+    while True:
+        queue.reclaim_stale(stale_timeout)
+        claim = queue.claim(worker_id)
+        if claim is None:
+            if queue.is_finished():
+                break
+            # other workers still hold claims, wait in case they go stale
+            time.sleep(poll_interval)
+            continue
+        log.info(f"{worker_id} claimed {claim.item_id}")
+        payload = queue.get_payload(claim.item_id)
+        heartbeat = Heartbeat(queue, claim, heartbeat_interval)
+        try:
+            with heartbeat:
+                result = func(claim.item_id, payload)
+        except ClaimLostError:
+            # another worker owns the item now, its result is the one kept
+            log.warning(f"{worker_id} gave up {claim.item_id}")
+            continue
+        except Exception:  # pylint: disable=W0703
+            if queue.fail(claim, traceback.format_exc()):
+                log.error(f"{claim.item_id} failed")
+                count += 1
+            continue
+        if queue.complete(claim, result):
+            count += 1
+    log.info(f"worker {worker_id} finished, processed {count} items")
+    return count
@@ -48,7 +48,7 @@ setup(
     ],
     entry_points = {
         'console_scripts' : [
-            'rna-map-tools = rna_map_tools.cli:cli'
+            'rna-map-tools = rna_map_tools.daemon:main'
         ]
     }
 )
@@ -0,0 +1,39 @@
+"""
+testing the runmulti orchestration benchmark
+"""
+import os
+
+from rna_map_tools.tools.benchmark import (
+    benchmark_runmulti,
+    make_synthetic_run,
+    time_runmulti,
+)
+
+
+def test_make_synthetic_run(tmp_path):
+    df = make_synthetic_run(str(tmp_path), 20, num_codes=3)
+    assert len(df) == 20
+    assert df["barcode_seq"].nunique() == 20
+    assert df["code"].nunique() == 3
+    for _, row in df.iterrows():
+        assert os.path.isfile(
+            tmp_path / "demultiplexed" / row["barcode_seq"]
+            / "test_S1_L001_R2_001.fastq"
+        )
+    assert os.path.isfile(tmp_path / "seq" / "rna" / "C0002.csv")
+
+
+def test_time_runmulti(tmp_path):
+    cwd = os.getcwd()
+    r = time_runmulti(str(tmp_path), 5, latency=0.01)
+    assert os.getcwd() == cwd
+    assert r["rna_map_s"] >= 0.05
+    assert 0 < r["overhead_s"] < r["total_s"]
+    assert len(os.listdir(tmp_path / "run" / "processed")) == 5
+
+
+def test_benchmark_runmulti(tmp_path):
+    report = benchmark_runmulti([2, 4, 8], work_dir=str(tmp_path))
+    assert [r["num_rows"] for r in report["results"]] == [2, 4, 8]
+    assert set(report["scaling"]) == {"fixed_s", "per_row_ms", "exponent"}
+    assert os.listdir(tmp_path) == []
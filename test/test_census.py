@@ -0,0 +1,35 @@
+"""
+testing barcode census
+"""
+import os
+
+import pandas as pd
+
+from rna_map_tools.fastq import get_paired_fastqs
+from rna_map_tools.tools.census import barcode_census
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_barcode_census():
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    pfqs = get_paired_fastqs(TEST_DIR + "/resources/test_fastqs_gziped")
+    census = barcode_census(df, pfqs, batch_size=64)
+    assert census.num_reads == 250
+    counts = census.counts.set_index("barcode")
+    assert counts.loc["RTB005", "exact"] == 58
+    assert (counts["total"] >= counts["exact"]).all()
+    assert census.unassigned["count"].sum() <= 250 - counts["total"].sum()
+    assert "closest_barcode" in census.unassigned
+    census.log()
+
+
+def test_barcode_census_parallel():
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    pfqs = get_paired_fastqs(TEST_DIR + "/resources/test_fastqs")
+    serial = barcode_census(df, pfqs, max_reads=200)
+    parallel = barcode_census(
+        df, pfqs, max_reads=200, num_workers=2, batch_size=50
+    )
+    assert serial.num_reads == parallel.num_reads == 200
+    assert list(serial.counts["total"]) == list(parallel.counts["total"])
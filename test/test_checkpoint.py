@@ -0,0 +1,238 @@
+"""
+testing checkpoint and resume of chunked demultiplexing with a stand in for
+the demultiplexing program
+"""
+import os
+import sys
+import json
+import subprocess
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.fastq import PairedFastqFiles, FastqFile
+from rna_map_tools.tools.checkpoint import CHECKPOINT_FILE, FastqChunkReader
+from rna_map_tools.tools.demultiplex import Demultiplexer
+
+# routes each read pair to a directory named after the first base of read 1
+# and fails after the first chunk if a file named fail exists in the parent
+# directory
+SPLIT_SCRIPT = """
+import os, sys
+r1 = open("test_S1_L001_R1_001.fastq").readlines()
+r2 = open("test_S1_L001_R2_001.fastq").readlines()
+if os.path.exists("../fail") and r1[0] != "@read0\\n":
+    sys.exit(1)
+counts = {}
+for i in range(0, len(r1), 4):
+    d = r1[i + 1][0] if r1[i + 1][0] in "AC" else "NC"
+    counts[d] = counts.get(d, 0) + 1
+    for name, lines in [("R1", r1), ("R2", r2)]:
+        with open(f"{d}/test_S1_L001_{name}_001.fastq", "a") as f:
+            f.writelines(lines[i : i + 4])
+print(counts)
+"""
+
+
+class SplitDemultiplexer(Demultiplexer):
+    barcode_file = "barcodes.txt"
+    script = None
+
+    def _demultiplex_command(self):
+        return f"{sys.executable} {self.script}"
+
+    def _output_dirs(self, df):
+        return ["A", "C", "NC"]
+
+    def run(self, df, paired_fqs, demultiplex_path):
+        os.chdir(demultiplex_path)
+        with open(self.barcode_file, "w") as f:
+            f.write("A\nC\n")
+        return self._demultiplex(df, paired_fqs)
+
+
+def write_fastqs(path, num_records):
+    paths = []
+    for read in ["R1", "R2"]:
+        fname = str(path / f"input_{read}_001.fastq")
+        with open(fname, "w") as f:
+            for i in range(num_records):
+                seq = "ACGT"[i % 4] + "GGTTAA"
+                f.write(f"@read{i}\n{seq}\n+\n{'I' * len(seq)}\n")
+        paths.append(fname)
+    return PairedFastqFiles(FastqFile(paths[0]), FastqFile(paths[1]))
+
+
+def read_dir(path):
+    data = {}
+    for d in ["A", "C", "NC"]:
+        with open(path / d / "test_S1_L001_R1_001.fastq") as f:
+            data[d] = f.read()
+    return data
+
+
+@pytest.fixture
+def restore_cwd():
+    cwd = os.getcwd()
+    yield
+    os.chdir(cwd)
+
+
+def test_fastq_chunk_reader(tmp_path):
+    pfqs = write_fastqs(tmp_path, 10)
+    reader = FastqChunkReader(pfqs.read_1.path, 0, 0)
+    assert reader.write_chunk(str(tmp_path / "a.fastq"), 4) == 4
+    offset = reader.offset()
+    reader.close()
+    reader = FastqChunkReader(pfqs.read_1.path, 4, offset)
+    assert reader.write_chunk(str(tmp_path / "b.fastq"), 100) == 6
+    reader.close()
+    with open(tmp_path / "b.fastq") as f:
+        assert f.readline() == "@read4\n"
+
+
+def test_resume_after_interrupt(tmp_path, restore_cwd, monkeypatch):
+    pfqs = write_fastqs(tmp_path, 25)
+    with open(tmp_path / "split.py", "w") as f:
+        f.write(SPLIT_SCRIPT)
+    monkeypatch.setattr(SplitDemultiplexer, "script", str(tmp_path / "split.py"))
+    params = {"checkpoint": True, "checkpoint_records": 10}
+    df = pd.DataFrame()
+    # uninterrupted run to compare against
+    os.makedirs(tmp_path / "full")
+    demult = SplitDemultiplexer()
+    demult.setup(params)
+    outputs = demult.run(df, pfqs, str(tmp_path / "full"))
+    assert len(outputs) == 3
+    expected = read_dir(tmp_path / "full")
+    # interrupted run, fails on the second chunk
+    run_dir = tmp_path / "resume"
+    os.makedirs(run_dir)
+    (run_dir / "fail").touch()
+    demult = SplitDemultiplexer()
+    demult.setup(params)
+    with pytest.raises(subprocess.CalledProcessError):
+        demult.run(df, pfqs, str(run_dir))
+    os.chdir(tmp_path)
+    with open(run_dir / CHECKPOINT_FILE) as f:
+        checkpoint = json.load(f)
+    assert checkpoint["num_records"] == 10
+    assert not checkpoint["finished"]
+    # output written after the checkpoint must be discarded on resume
+    with open(run_dir / "A" / "test_S1_L001_R1_001.fastq", "a") as f:
+        f.write("@partial\nAAA\n")
+    (run_dir / "NC" / "test_S1_L001_R1_001.fastq.gz").write_text("@partial\n")
+    # directories the run does not own are left alone
+    os.makedirs(run_dir / "G")
+    (run_dir / "G" / "test_S1_L001_R1_001.fastq").write_text("@other\n")
+    os.remove(run_dir / "fail")
+    demult = SplitDemultiplexer()
+    demult.setup(params)
+    outputs = demult.run(df, pfqs, str(run_dir))
+    assert len(outputs) == 3
+    assert read_dir(run_dir) == expected
+    assert not os.path.exists(run_dir / "NC" / "test_S1_L001_R1_001.fastq.gz")
+    assert (run_dir / "G" / "test_S1_L001_R1_001.fastq").read_text() == (
+        "@other\n"
+    )
+    assert not os.path.exists(run_dir / "chunk")
+    # a finished run is not demultiplexed again
+    assert demult.run(df, pfqs, str(run_dir)) == outputs
+
+
+def test_checkpoint_key(tmp_path, restore_cwd, monkeypatch):
+    pfqs = write_fastqs(tmp_path, 25)
+    with open(tmp_path / "split.py", "w") as f:
+        f.write(SPLIT_SCRIPT)
+    monkeypatch.setattr(SplitDemultiplexer, "script", str(tmp_path / "split.py"))
+    params = {"checkpoint": True, "checkpoint_records": 10}
+    run_dir = tmp_path / "run"
+    os.makedirs(run_dir)
+    demult = SplitDemultiplexer()
+    demult.setup(params)
+    demult.run(pd.DataFrame(), pfqs, str(run_dir))
+    with open(run_dir / CHECKPOINT_FILE) as f:
+        key = json.load(f)["key"]
+    # different parameters do not resume the finished run
+    demult = SplitDemultiplexer()
+    demult.setup(dict(params, trim={"enabled": True}))
+    demult.run(pd.DataFrame(), pfqs, str(run_dir))
+    with open(run_dir / CHECKPOINT_FILE) as f:
+        assert json.load(f)["key"] != key
+    # the outputs were written again not appended to
+    assert read_dir(run_dir)["A"].count("@") == 7
+
+
+def test_finalize_once(tmp_path, restore_cwd, monkeypatch):
+    from rna_map_tools.parameters import get_default_params
+    from rna_map_tools.tools import demultiplex
+
+    pfqs = write_fastqs(tmp_path, 25)
+    with open(tmp_path / "split.py", "w") as f:
+        f.write(SPLIT_SCRIPT)
+    monkeypatch.setattr(SplitDemultiplexer, "script", str(tmp_path / "split.py"))
+    params = get_default_params()["demultiplex"]
+    params.update(checkpoint=True, checkpoint_records=10)
+    df = pd.DataFrame({"barcode_seq": ["A", "C"]})
+    run_dir = tmp_path / "run"
+    os.makedirs(run_dir)
+    for _ in range(2):
+        demult = SplitDemultiplexer()
+        demult.setup(params)
+        demult.run(df, pfqs, str(run_dir))
+        demult._finalize_outputs(df, "gzip-fast")
+        # a second finalize would compress the compressed outputs again
+        monkeypatch.setattr(demultiplex, "compress_files", None)
+    with open(run_dir / CHECKPOINT_FILE) as f:
+        assert json.load(f)["finalized"]
+    assert sorted(os.listdir(run_dir / "A")) == [
+        "test_S1_L001_R1_001.fastq.gz",
+        "test_S1_L001_R2_001.fastq.gz",
+    ]
+
+
+def test_finalize_resume(tmp_path, restore_cwd, monkeypatch):
+    from rna_map_tools.parameters import get_default_params
+
+    pfqs = write_fastqs(tmp_path, 200)
+    with open(tmp_path / "split.py", "w") as f:
+        f.write(SPLIT_SCRIPT)
+    monkeypatch.setattr(SplitDemultiplexer, "script", str(tmp_path / "split.py"))
+    params = get_default_params()["demultiplex"]
+    params.update(checkpoint=True, checkpoint_records=100)
+    params["subsample"].update(enabled=True, fraction=0.5)
+    df = pd.DataFrame({"barcode_seq": ["A", "C"]})
+    results = []
+    for interrupt in [False, True]:
+        run_dir = tmp_path / f"run_{interrupt}"
+        os.makedirs(run_dir)
+        demult = SplitDemultiplexer()
+        demult.setup(params)
+        demult.run(df, pfqs, str(run_dir))
+        if interrupt:
+            finalized = SplitDemultiplexer._barcode_finalized
+
+            def fail_on_c(self, barcode_seq, stats):
+                if barcode_seq == "C":
+                    raise KeyboardInterrupt
+                finalized(self, barcode_seq, stats)
+
+            monkeypatch.setattr(
+                SplitDemultiplexer, "_barcode_finalized", fail_on_c
+            )
+            with pytest.raises(KeyboardInterrupt):
+                demult._finalize_outputs(df, "none")
+            monkeypatch.setattr(
+                SplitDemultiplexer, "_barcode_finalized", finalized
+            )
+            # resumes after the demultiplexing finished
+            demult = SplitDemultiplexer()
+            demult.setup(params)
+            demult.run(df, pfqs, str(run_dir))
+        demult._finalize_outputs(df, "none")
+        results.append(
+            (read_dir(run_dir), pd.read_csv(run_dir / "subsample_stats.csv"))
+        )
+    # every barcode was subsampled exactly once
+    assert results[0][0] == results[1][0]
+    assert results[0][1].equals(results[1][1])
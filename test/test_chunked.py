@@ -0,0 +1,115 @@
+"""
+testing chunked rna_map runs with a stand in for rna_map that counts reads
+"""
+import os
+import json
+
+import pytest
+
+from rna_map.mutation_histogram import (
+    MutationHistogram,
+    write_mut_histos_to_json_file,
+)
+
+from rna_map_tools.tools import chunked
+from rna_map_tools.tools.chunked import (
+    HISTOS_PATH,
+    run_rna_map_chunked,
+    split_fastq_pair,
+)
+
+REF_SEQ = "GGAAGATCGAGTAGATCAAAGC"
+
+
+def fake_rna_map(fasta, fastq1, fastq2, dot_bracket, params):
+    """
+    writes histograms where every read with an A at position 0 counts as
+    aligned, its third base as mutated and its fourth and fifth as deleted
+    and inserted
+    """
+    with open(fastq1) as f:
+        seqs = f.readlines()[1::4]
+    mh = MutationHistogram("ref", REF_SEQ, "DMS", 1, len(REF_SEQ))
+    mh.num_reads = len(seqs)
+    for seq in seqs:
+        if seq[0] == "A":
+            mh.num_aligned += 1
+            mh.mut_bases[3] += 1
+            mh.del_bases[4] += 1
+            mh.ins_bases[5] += 1
+            mh.info_bases[1:] += 1
+            mh.mod_bases["A"][3] += 1
+            mh.skips["short_read"] += 1
+            mh.num_of_mutations[1] += 1
+        mh.cov_bases[1 : len(seq.strip()) + 1] += 1
+    os.makedirs(os.path.dirname(HISTOS_PATH), exist_ok=True)
+    write_mut_histos_to_json_file({"ref": mh}, HISTOS_PATH)
+
+
+def write_pair(path, num_records):
+    paths = []
+    for read in ["R1", "R2"]:
+        fname = str(path / f"input_{read}_001.fastq")
+        with open(fname, "w") as f:
+            for i in range(num_records):
+                seq = "ACGT"[i % 4] + "GATCGAGTAG"[: 5 + i % 5]
+                f.write(f"@read{i}\n{seq}\n+\n{'I' * len(seq)}\n")
+        paths.append(fname)
+    return paths
+
+
+@pytest.fixture
+def restore_cwd():
+    cwd = os.getcwd()
+    yield
+    os.chdir(cwd)
+
+
+def test_split_fastq_pair(tmp_path):
+    fq1, fq2 = write_pair(tmp_path, 25)
+    chunks = split_fastq_pair(fq1, fq2, str(tmp_path / "chunks"), 10)
+    assert len(chunks) == 3
+    lines = []
+    for c1, _ in chunks:
+        with open(c1) as f:
+            lines.extend(f.readlines())
+    with open(fq1) as f:
+        assert f.readlines() == lines
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_run_rna_map_chunked(tmp_path, restore_cwd, monkeypatch, num_workers):
+    monkeypatch.setattr(chunked, "run_rna_map", fake_rna_map)
+    fq1, fq2 = write_pair(tmp_path, 25)
+    # unchunked run to compare against
+    os.makedirs(tmp_path / "full")
+    os.chdir(tmp_path / "full")
+    fake_rna_map("ref.fasta", fq1, fq2, "ref.csv", {})
+    with open(HISTOS_PATH) as f:
+        expected = json.load(f)
+    os.makedirs(tmp_path / "chunked")
+    os.chdir(tmp_path / "chunked")
+    mut_histos = run_rna_map_chunked(
+        "ref.fasta", fq1, fq2, "ref.csv", {}, 10, num_workers
+    )
+    assert os.getcwd() == str(tmp_path / "chunked")
+    assert mut_histos["ref"].num_reads == 25
+    assert mut_histos["ref"].del_bases[4] == 7
+    with open(HISTOS_PATH) as f:
+        assert json.load(f) == expected
+    assert os.path.isfile("output/BitVector_Files/summary.csv")
+    assert not os.path.exists("chunks")
+
+
+def test_run_rna_map_chunked_validated(tmp_path, restore_cwd, monkeypatch):
+    def fail(*args):
+        raise AssertionError("validated references are validated again")
+
+    monkeypatch.setattr(chunked, "run_rna_map", fail)
+    monkeypatch.setattr(chunked, "run_rna_map_validated", fake_rna_map)
+    fq1, fq2 = write_pair(tmp_path, 25)
+    os.chdir(tmp_path)
+    mut_histos = run_rna_map_chunked(
+        "ref.fasta", fq1, fq2, "ref.csv", {}, 10, 1, validated=True
+    )
+    assert mut_histos["ref"].num_reads == 25
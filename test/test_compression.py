@@ -0,0 +1,59 @@
+"""
+testing compression of intermediate files
+"""
+import os
+import shutil
+import pytest
+
+from rna_map_tools.compression import (
+    available_codecs,
+    compress_file,
+    compress_files,
+    decompress_file,
+    detect_codec,
+    open_file,
+)
+from rna_map_tools.fastq import FastqFile, validate_fastq_file
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+FASTQ_PATH = TEST_DIR + "/resources/test_fastqs/C0098_S1_L001_R1_001.fastq"
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_round_trip(tmp_path, codec):
+    path = str(tmp_path / "test_S1_L001_R1_001.fastq")
+    shutil.copy(FASTQ_PATH, path)
+    compressed_path = compress_file(path, codec)
+    if codec != "none":
+        assert not os.path.exists(path)
+        assert FastqFile(compressed_path).is_compressed()
+    assert detect_codec(compressed_path) == codec.replace("-fast", "")
+    assert validate_fastq_file(compressed_path)
+    decompress_file(compressed_path, str(tmp_path / "out.fastq"))
+    with open(FASTQ_PATH, "rb") as f1, open(tmp_path / "out.fastq", "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_open_file_text(tmp_path):
+    path = str(tmp_path / "test.txt.gz")
+    with open_file(path, "wt", "gzip-fast") as f:
+        f.write("@read\nACGT\n+\nFFFF\n")
+    with open_file(path, "rt") as f:
+        assert f.readline() == "@read\n"
+
+
+def test_compress_files(tmp_path):
+    shutil.copy(FASTQ_PATH, tmp_path / "test_S1_L001_R1_001.fastq")
+    compress_files(str(tmp_path), "gzip-fast")
+    compress_files(str(tmp_path), "gzip-fast")
+    assert os.listdir(tmp_path) == ["test_S1_L001_R1_001.fastq.gz"]
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        compress_file(FASTQ_PATH, "bzip2")
+
+
+def test_invalid_fastq():
+    path = TEST_DIR + "/resources/test_csvs/C0098.csv"
+    assert validate_fastq_file(path) is False
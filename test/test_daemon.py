@@ -0,0 +1,149 @@
+"""
+testing forwarding cli commands to the warm worker daemon
+"""
+import io
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+import pytest
+
+from rna_map_tools.daemon import DAEMON_COMMANDS, forward, get_command, request
+from rna_map_tools.read_store import ReadStoreWriter
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def wait_for(socket_path, proc, timeout=60):
+    start = time.time()
+    while request({"type": "status"}, socket_path) is None:
+        if proc.poll() is not None:
+            raise RuntimeError("daemon exited before it started serving")
+        if time.time() - start > timeout:
+            raise TimeoutError("daemon did not start")
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def restore_cwd():
+    cwd = os.getcwd()
+    yield
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    socket_path = str(tmp_path / "d.sock")
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from rna_map_tools.daemon import serve; "
+            f"serve({socket_path!r}, num_workers=1, max_jobs_per_worker=2)",
+        ]
+    )
+    wait_for(socket_path, proc)
+    yield socket_path
+    if request({"type": "shutdown"}, socket_path) is not None:
+        proc.wait(timeout=60)
+    else:
+        proc.kill()
+
+
+def run(args, socket_path):
+    out = io.StringIO()
+    code = forward(args, socket_path, out)
+    return code, out.getvalue()
+
+
+def test_no_daemon(tmp_path):
+    socket_path = str(tmp_path / "d.sock")
+    assert forward(["analysis", "test.csv"], socket_path) is None
+    assert request({"type": "status"}, socket_path) is None
+    # a socket file left behind by a daemon that was killed
+    (tmp_path / "d.sock").touch()
+    assert forward(["analysis", "test.csv"], socket_path) is None
+
+
+def test_forward(tmp_path, daemon, restore_cwd):
+    status = request({"type": "status"}, daemon)[0]
+    assert status["workers"] == 1
+    assert status["running"] == 0
+    barcode_dir = TEST_DIR + "/resources/demultiplexed/ACAAAATGGTGG"
+    with ReadStoreWriter(str(tmp_path / "test.store"), "gzip") as writer:
+        writer.add_barcode_dir("ACAAAATGGTGG", barcode_dir)
+    os.chdir(tmp_path)
+    # runs in the working directory of the caller and streams the log back,
+    # more jobs than max_jobs_per_worker so the worker is replaced
+    for i in range(3):
+        code, output = run(["export-store", "test.store", f"out{i}"], daemon)
+        assert code == 0
+        assert "exported 1 barcodes to out" in output
+        assert os.path.isdir(tmp_path / f"out{i}" / "ACAAAATGGTGG")
+    code, output = run(["export-store", "missing.store", "out"], daemon)
+    assert code == 1
+    assert "FileNotFoundError" in output
+    code, output = run(["not-a-command"], daemon)
+    assert code == 2
+    assert "No such command" in output
+    code, output = run(["analysis", "--help"], daemon)
+    assert code == 0
+    assert "Usage:" in output
+
+
+def get_workers(daemon_pid):
+    """
+    :return: pids of the worker processes of a daemon
+    """
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            continue
+        if ppid == daemon_pid and b"spawn_main" in cmdline:
+            pids.append(int(pid))
+    return pids
+
+
+def test_get_command():
+    assert get_command(["plan", "a.csv", "fastqs"]) == "plan"
+    args = ["--log-file", "x.log", "--json-log", "census", "a.csv", "fastqs"]
+    assert get_command(args) == "census"
+    assert get_command(["--json-log"]) is None
+    assert "export-store" in DAEMON_COMMANDS
+
+
+def test_worker_dies(tmp_path, daemon, restore_cwd):
+    os.chdir(tmp_path)
+    daemon_pid = request({"type": "status"}, daemon)[0]["pid"]
+    result = {}
+
+    def run_slow():
+        # long enough to be killed while it runs
+        args = ["benchmark", "--sizes", "2", "--latency", "60"]
+        result["code"], result["output"] = run(args, daemon)
+
+    thread = threading.Thread(target=run_slow)
+    thread.start()
+    start = time.time()
+    while len(get_workers(daemon_pid)) == 0:
+        assert time.time() - start < 60
+        time.sleep(0.1)
+    for pid in get_workers(daemon_pid):
+        os.kill(pid, signal.SIGKILL)
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert result["code"] == 1
+    assert "BrokenProcessPool" in result["output"]
+    # new workers are started for the next job
+    code, output = run(["analysis", "--help"], daemon)
+    assert code == 0
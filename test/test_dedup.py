@@ -0,0 +1,109 @@
+"""
+testing collapsing of duplicate read pairs
+"""
+import os
+
+import pandas as pd
+
+from rna_map_tools.compression import open_file
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.tools.dedup import DedupStats, dedup_enabled, dedup_pairs
+from rna_map_tools.tools.demultiplex import SabreDemultiplexer
+
+
+def get_dedup_params(**kwargs):
+    params = get_default_params()["demultiplex"]["dedup"]
+    params.update(enabled=True, **kwargs)
+    return params
+
+
+def make_pairs(seqs):
+    return [
+        (
+            (f"@r{i}".encode(), s1.encode(), b"+", b"I" * len(s1)),
+            (f"@r{i}".encode(), s2.encode(), b"+", b"I" * len(s2)),
+        )
+        for i, (s1, s2) in enumerate(seqs)
+    ]
+
+
+def read_counts(path):
+    return dict(pd.read_csv(path, sep="\t").itertuples(index=False))
+
+
+def test_exact_duplicates(tmp_path):
+    seqs = [("AAAA", "CCCC"), ("AAAA", "CCCG"), ("AAAA", "CCCC")] * 3
+    stats = DedupStats()
+    counts_path = str(tmp_path / "counts.tsv.gz")
+    kept = list(
+        dedup_pairs(make_pairs(seqs), get_dedup_params(), stats, counts_path)
+    )
+    assert [p[0][0] for p in kept] == [b"@r0", b"@r1"]
+    assert stats.pairs_in == 9 and stats.pairs_out == 2
+    assert read_counts(counts_path) == {"r0": 6, "r1": 3}
+
+
+def test_umi(tmp_path):
+    # the UMI is the first 3 bases of read 2
+    seqs = [("AAAA", "GGTCCCC"), ("TTTT", "GGTAAAA"), ("CCCC", "GGACCCC")]
+    params = get_dedup_params(umi_read="read_2", umi_length=3)
+    kept = list(
+        dedup_pairs(
+            make_pairs(seqs), params, DedupStats(), str(tmp_path / "c.tsv.gz")
+        )
+    )
+    assert [p[0][0] for p in kept] == [b"@r0", b"@r2"]
+
+
+def test_spill_to_disk(tmp_path):
+    seqs = [(f"A{i:04d}", "CCCC") for i in range(200)] * 2
+    params = get_dedup_params(max_fingerprints=50, num_partitions=4)
+    stats = DedupStats()
+    counts_path = str(tmp_path / "counts.tsv.gz")
+    kept = list(
+        dedup_pairs(
+            make_pairs(seqs), params, stats, counts_path, str(tmp_path)
+        )
+    )
+    assert len(kept) == 200
+    assert len({p[0][1] for p in kept}) == 200
+    assert stats.spilled == 300
+    counts = read_counts(counts_path)
+    assert len(counts) == 200
+    assert set(counts.values()) == {2}
+    # partitions are removed
+    assert os.listdir(tmp_path) == ["counts.tsv.gz"]
+
+
+def test_dedup_enabled():
+    assert not dedup_enabled(get_default_params()["demultiplex"]["dedup"])
+    # identical pairs are only collapsed when asked to
+    assert not dedup_enabled(get_dedup_params())
+    assert dedup_enabled(get_dedup_params(collapse_identical=True))
+    assert dedup_enabled(get_dedup_params(umi_length=8))
+
+
+def test_finalize_outputs(tmp_path):
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        os.makedirs("AAAA")
+        for read in ["R1", "R2"]:
+            with open(f"AAAA/test_S1_L001_{read}_001.fastq", "w") as f:
+                for i in range(4):
+                    f.write(f"@r{i}\nACGTACGT\n+\nIIIIIIII\n")
+        df = pd.DataFrame({"barcode_seq": ["AAAA"]})
+        params = get_default_params()["demultiplex"]
+        params["dedup"]["enabled"] = True
+        demultiplexer = SabreDemultiplexer()
+        demultiplexer.setup(params)
+        demultiplexer._finalize_outputs(df, "none")
+        assert not os.path.exists("dedup_stats.csv")
+        params["dedup"]["collapse_identical"] = True
+        demultiplexer.setup(params)
+        demultiplexer._finalize_outputs(df, "none")
+        assert list(pd.read_csv("dedup_stats.csv")["pairs_out"]) == [1]
+        with open_file("AAAA/test_S1_L001_R1_001.fastq", "rt") as f:
+            assert f.read() == "@r0\nACGTACGT\n+\nIIIIIIII\n"
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,173 @@
+"""
+testing the content addressed download cache with a stubbed bs command
+"""
+import os
+import stat
+
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from rna_map_tools.cli import cli
+from rna_map_tools.download_cache import DownloadCache
+from rna_map_tools.parameters import PY_DIR
+from rna_map_tools.run import download
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_default_params():
+    path = PY_DIR + "/resources/default.yml"
+    with open(path) as f:
+        params = yaml.safe_load(f)
+    return params
+
+
+def write_bs_stub(path, fail=False):
+    """
+    writes a fake bs that 'downloads' the gzipped test fastqs
+    """
+    data_dir = f"{TEST_DIR}/resources/test_fastqs_gziped"
+    if fail:
+        body = "exit 1\n"
+    else:
+        body = (
+            "mkdir -p C0098_L1_ds.abc\n"
+            f"cp {data_dir}/*.fastq.gz C0098_L1_ds.abc/\n"
+        )
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def restore_cwd():
+    cwd = os.getcwd()
+    yield
+    os.chdir(cwd)
+
+
+def test_download_with_cache(tmp_path, restore_cwd):
+    bs = str(tmp_path / "bs")
+    write_bs_stub(bs)
+    params = load_default_params()["download"]
+    params["bs_command"] = bs
+    params["cache_dir"] = str(tmp_path / "cache")
+    os.makedirs(tmp_path / "node_1")
+    os.makedirs(tmp_path / "node_2")
+    pfqs_1 = download("test_run", str(tmp_path / "node_1"), params)
+    # the second download must come from the cache
+    write_bs_stub(bs, fail=True)
+    pfqs_2 = download("test_run", str(tmp_path / "node_2"), params)
+    for fq_1, fq_2 in [
+        (pfqs_1.read_1, pfqs_2.read_1),
+        (pfqs_1.read_2, pfqs_2.read_2),
+    ]:
+        assert os.path.basename(fq_1.path) == os.path.basename(fq_2.path)
+        assert fq_2.path.startswith(str(tmp_path / "node_2"))
+        assert os.path.samefile(fq_1.path, fq_2.path)
+
+
+def test_evict(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    for i, run in enumerate(["old", "new"]):
+        run_dir = tmp_path / run
+        run_dir.mkdir()
+        (run_dir / "data.txt").write_text(run * 1000)
+        cache.store(run, str(run_dir))
+        obj = cache._object_path(cache.get_manifest(run)["files"][0]["sha256"])
+        os.utime(obj, (i, i))
+    assert cache.has("old") and cache.has("new")
+    assert cache.evict(max_size_gb=3500 / 1e9) == 1
+    assert not cache.has("old")
+    assert cache.get_manifest("old") is None
+    assert cache.has("new")
+
+
+def test_failed_download_not_cached(tmp_path, restore_cwd):
+    bs = str(tmp_path / "bs")
+    write_bs_stub(bs, fail=True)
+    params = load_default_params()["download"]
+    params["bs_command"] = bs
+    params["cache_dir"] = str(tmp_path / "cache")
+    os.makedirs(tmp_path / "node_1")
+    with pytest.raises(SystemExit):
+        download("test_run", str(tmp_path / "node_1"), params)
+    cache = DownloadCache(params["cache_dir"])
+    assert cache.get_manifest("test_run") is None
+    assert not cache.has("test_run")
+
+
+def test_incomplete_manifests(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    empty_dir = tmp_path / "empty"
+    empty_dir.mkdir()
+    with pytest.raises(ValueError):
+        cache.store("empty", str(empty_dir))
+    # manifests left by older versions
+    with open(cache._manifest_path("empty"), "w") as f:
+        f.write('{"key": "empty", "files": []}')
+    assert not cache.has("empty")
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    (run_dir / "data.txt").write_text("data")
+    manifest = cache.store("run", str(run_dir))
+    obj_path = cache._object_path(manifest["files"][0]["sha256"])
+    assert cache.has("run")
+    # objects and the files linked to them are read only
+    assert not os.stat(obj_path).st_mode & stat.S_IWUSR
+    assert not os.stat(run_dir / "data.txt").st_mode & stat.S_IWUSR
+    os.chmod(obj_path, 0o644)
+    with open(obj_path, "w") as f:
+        f.write("truncated")
+    assert not cache.has("run")
+
+
+def test_download_cli_cache(tmp_path, restore_cwd):
+    bs = str(tmp_path / "bs")
+    write_bs_stub(bs)
+    os.makedirs(tmp_path / "node_1")
+    os.makedirs(tmp_path / "node_2")
+    runner = CliRunner()
+    args = [
+        "download",
+        "test_run",
+        "--cache-dir",
+        str(tmp_path / "cache"),
+        "--cache-max-size-gb",
+        "1",
+        "--bs-command",
+        bs,
+    ]
+    result = runner.invoke(cli, args + ["-d", str(tmp_path / "node_1")])
+    assert result.exit_code == 0, result.output
+    assert DownloadCache(str(tmp_path / "cache")).has("test_run")
+    # the second download must come from the cache
+    write_bs_stub(bs, fail=True)
+    result = runner.invoke(cli, args + ["-d", str(tmp_path / "node_2")])
+    assert result.exit_code == 0, result.output
+    assert len(os.listdir(tmp_path / "node_2" / "test_run")) > 0
+
+
+def test_shared_cache_not_owner(tmp_path, monkeypatch):
+    """
+    objects owned by another user of a shared cache are still restored
+    """
+    cache = DownloadCache(str(tmp_path / "cache"))
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    (run_dir / "data.txt").write_text("data")
+    cache.store("run", str(run_dir))
+
+    def utime(*args, **kwargs):
+        raise PermissionError("not owner")
+
+    def remove(*args, **kwargs):
+        raise PermissionError("not owner")
+
+    monkeypatch.setattr(os, "utime", utime)
+    cache.materialize("run", str(tmp_path / "restored"))
+    assert (tmp_path / "restored" / "data.txt").read_text() == "data"
+    monkeypatch.setattr(os, "remove", remove)
+    assert cache.evict(max_size_gb=0) == 0
+    assert cache.has("run")
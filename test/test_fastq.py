@@ -4,7 +4,12 @@ testing structured data module
 import os
 import pytest
 
-from rna_map_tools.fastq import FastqFile, get_paired_fastqs
+from rna_map_tools.fastq import (
+    REWRITE_OLD,
+    FastqFile,
+    get_paired_fastqs,
+    rewrite_fastq_dir,
+)
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -52,3 +57,32 @@ def test_get_paired_fastqs():
     """
     path = TEST_DIR + "/resources/test_fastqs"
     pfqs = get_paired_fastqs(path)
+
+
+def test_rewrite_fastq_dir_interrupted(tmp_path):
+    directory = str(tmp_path / "AAAA")
+    os.makedirs(directory)
+    for read in ["R1", "R2"]:
+        with open(f"{directory}/test_S1_L001_{read}_001.fastq", "w") as f:
+            for i in range(4):
+                f.write(f"@r{i}\nACGT\n+\nIIII\n")
+    # left over from an earlier crash, not an input
+    with open(f"{directory}/test_S1_L001_R1_001.fastq.gz.tmp", "w") as f:
+        f.write("partial")
+
+    def fail():
+        raise KeyboardInterrupt
+
+    def keep_half(pairs):
+        return (p for i, p in enumerate(pairs) if i % 2 == 0)
+
+    with pytest.raises(KeyboardInterrupt):
+        rewrite_fastq_dir(directory, "none", keep_half, fail)
+    # not committed, the old pair is kept
+    assert os.path.isdir(directory + REWRITE_OLD)
+    assert rewrite_fastq_dir(directory, "none", keep_half) == 2
+    assert not os.path.exists(directory + REWRITE_OLD)
+    assert sorted(os.listdir(directory)) == [
+        "test_S1_L001_R1_001.fastq",
+        "test_S1_L001_R2_001.fastq",
+    ]
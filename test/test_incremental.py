@@ -0,0 +1,223 @@
+"""
+testing incremental demultiplexing of NC/ reads with a stand in for the
+demultiplexing program
+"""
+import os
+import sys
+import glob
+import json
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.compression import open_file
+from rna_map_tools.fastq import PairedFastqFiles, FastqFile
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.read_store import ReadStore, READ_STORE_FILE
+from rna_map_tools.tools.demultiplex import Demultiplexer
+from rna_map_tools.tools.incremental import (
+    BARCODE_SET_FILE,
+    PREVIOUS_NC,
+    get_new_barcodes,
+    load_barcode_set,
+    merge_demultiplex_csv,
+    recover_nc,
+    write_barcode_set,
+)
+
+# routes each read pair to the directory of the barcode read 1 starts with
+# and logs the number of read pairs it was given
+SPLIT_SCRIPT = """
+r1 = open("test_S1_L001_R1_001.fastq").readlines()
+r2 = open("test_S1_L001_R2_001.fastq").readlines()
+barcodes = open("barcodes.txt").read().split()
+with open("SCANNED", "a") as f:
+    f.write(f"{len(r1) // 4}\\n")
+for i in range(0, len(r1), 4):
+    d = "NC"
+    for barcode in barcodes:
+        if r1[i + 1].startswith(barcode):
+            d = barcode
+    for name, lines in [("R1", r1), ("R2", r2)]:
+        with open(f"{d}/test_S1_L001_{name}_001.fastq", "a") as f:
+            f.writelines(lines[i : i + 4])
+"""
+
+
+class PrefixDemultiplexer(Demultiplexer):
+    barcode_file = "barcodes.txt"
+    script = None
+
+    def _demultiplex_command(self):
+        return f"{sys.executable} {self.script}"
+
+    def run(self, df, paired_fqs, demultiplex_path):
+        if self._params["incremental"]:
+            if self._run_incremental(df, demultiplex_path):
+                return
+        os.chdir(demultiplex_path)
+        with open(self.barcode_file, "w") as f:
+            f.write("\n".join(df["barcode_seq"].unique()) + "\n")
+        for d in list(df["barcode_seq"].unique()) + ["NC"]:
+            os.makedirs(d, exist_ok=True)
+        self._demultiplex(df, paired_fqs)
+        self._finalize_outputs(df, self._output_codec())
+        self._record_barcode_set(df)
+
+
+def write_fastqs(path):
+    paths = []
+    seqs = ["AAAAGG", "CCCCGG", "GGGGTT", "TTTTAA"]
+    for read in ["R1", "R2"]:
+        fname = str(path / f"input_{read}_001.fastq")
+        with open(fname, "w") as f:
+            for i in range(20):
+                seq = seqs[i % 4]
+                f.write(f"@read{i}\n{seq}\n+\n{'I' * len(seq)}\n")
+        paths.append(fname)
+    return PairedFastqFiles(FastqFile(paths[0]), FastqFile(paths[1]))
+
+
+def get_df(barcode_seqs):
+    return pd.DataFrame(
+        {
+            "barcode": [f"bc{i}" for i in range(len(barcode_seqs))],
+            "barcode_seq": barcode_seqs,
+        }
+    )
+
+
+def get_params(**kwargs):
+    params = get_default_params()["demultiplex"]
+    params.update(incremental=True, delete_fastqs=True, **kwargs)
+    return params
+
+
+def count_records(path):
+    # barcode outputs are compressed with intermediate_codec, NC/ is not
+    path = glob.glob(f"{path}*")[0]
+    with open_file(path, "rt") as f:
+        return len(f.readlines()) // 4
+
+
+@pytest.fixture
+def restore_cwd():
+    cwd = os.getcwd()
+    yield
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def setup_run(tmp_path, restore_cwd, monkeypatch):
+    with open(tmp_path / "split.py", "w") as f:
+        f.write(SPLIT_SCRIPT.replace("SCANNED", str(tmp_path / "scanned.txt")))
+    monkeypatch.setattr(
+        PrefixDemultiplexer, "script", str(tmp_path / "split.py")
+    )
+    os.makedirs(tmp_path / "run")
+    return write_fastqs(tmp_path), tmp_path / "run"
+
+
+def run(pfqs, run_dir, barcode_seqs, **kwargs):
+    demult = PrefixDemultiplexer()
+    demult.setup(get_params(**kwargs))
+    demult.run(get_df(barcode_seqs), pfqs, str(run_dir))
+
+
+def get_scanned(run_dir):
+    with open(run_dir.parent / "scanned.txt") as f:
+        return [int(line) for line in f.read().split()]
+
+
+def test_new_barcode_only_scans_nc(setup_run):
+    pfqs, run_dir = setup_run
+    run(pfqs, run_dir, ["AAAA"])
+    assert count_records(run_dir / "NC" / "test_S1_L001_R1_001.fastq") == 15
+    assert os.path.isfile(run_dir / BARCODE_SET_FILE)
+    path = glob.glob(str(run_dir / "AAAA" / "test_S1_L001_R1_001.fastq*"))[0]
+    mtime = os.path.getmtime(path)
+    run(pfqs, run_dir, ["AAAA", "CCCC"])
+    # the first run saw every read, the update only the NC/ reads
+    assert get_scanned(run_dir) == [20, 15]
+    assert os.path.getmtime(path) == mtime
+    assert count_records(path) == 5
+    assert count_records(run_dir / "CCCC" / "test_S1_L001_R1_001.fastq") == 5
+    assert count_records(run_dir / "NC" / "test_S1_L001_R1_001.fastq") == 10
+    assert not os.path.exists(run_dir / PREVIOUS_NC)
+    assert not os.path.exists(run_dir / "incremental")
+    os.chdir(run_dir)
+    recorded = load_barcode_set()
+    assert [b[1] for b in recorded["barcodes"]] == ["AAAA", "CCCC"]
+    # nothing new, nothing is demultiplexed
+    run(pfqs, run_dir, ["AAAA", "CCCC"])
+    assert get_scanned(run_dir) == [20, 15]
+
+
+def test_changed_barcode_reruns_everything(setup_run):
+    pfqs, run_dir = setup_run
+    run(pfqs, run_dir, ["AAAA"])
+    df = pd.DataFrame({"barcode": ["renamed"], "barcode_seq": ["AAAA"]})
+    os.chdir(run_dir)
+    recorded = load_barcode_set()
+    assert get_new_barcodes(df, recorded, "PrefixDemultiplexer") is None
+    assert get_new_barcodes(get_df(["AAAA"]), recorded, "other") is None
+    os.remove(run_dir.parent / "scanned.txt")
+    run(pfqs, run_dir, ["GGGG"])
+    assert get_scanned(run_dir) == [20]
+
+
+def test_incremental_read_store(setup_run):
+    pfqs, run_dir = setup_run
+    run(pfqs, run_dir, ["AAAA"], read_store=True)
+    assert not os.path.exists(run_dir / "AAAA")
+    store_path = str(run_dir / READ_STORE_FILE)
+    with ReadStore(store_path) as store:
+        old_info = store.block_info("AAAA", "R1")
+    old_size = os.path.getsize(store_path)
+    run(pfqs, run_dir, ["AAAA", "CCCC"], read_store=True)
+    # new blocks are appended, the old ones are not copied
+    assert os.path.getsize(store_path) > old_size
+    with ReadStore(store_path) as store:
+        assert store.block_info("AAAA", "R1") == old_info
+        assert store.block_info("CCCC", "R1")["offset"] >= old_size
+        assert sorted(store.barcodes()) == ["AAAA", "CCCC"]
+        assert store.num_records("AAAA") == 5
+        assert store.num_records("CCCC") == 5
+        assert store.validate("AAAA", full=True)
+
+
+def test_incremental_stats(setup_run):
+    pfqs, run_dir = setup_run
+    subsample = get_default_params()["demultiplex"]["subsample"]
+    subsample.update(enabled=True, max_depth=100)
+    run(pfqs, run_dir, ["AAAA"], subsample=subsample)
+    run(pfqs, run_dir, ["AAAA", "CCCC"], subsample=subsample)
+    df = pd.read_csv(run_dir / "subsample_stats.csv")
+    assert list(df["barcode_seq"]) == ["AAAA", "CCCC"]
+    assert list(df["pairs_in"]) == [5, 5]
+
+
+def test_recover_nc(tmp_path):
+    os.makedirs(tmp_path / PREVIOUS_NC)
+    recover_nc(str(tmp_path))
+    assert os.path.isdir(tmp_path / "NC")
+    assert not os.path.exists(tmp_path / PREVIOUS_NC)
+    # the update finished but NC.previous was not removed yet
+    os.makedirs(tmp_path / PREVIOUS_NC)
+    write_barcode_set(get_df(["AAAA"]), "x", str(tmp_path / BARCODE_SET_FILE))
+    recover_nc(str(tmp_path))
+    assert not os.path.exists(tmp_path / PREVIOUS_NC)
+    with open(tmp_path / BARCODE_SET_FILE) as f:
+        assert json.load(f)["barcodes"] == [["bc0", "AAAA"]]
+
+
+def test_merge_demultiplex_csv(tmp_path):
+    columns = ["id", "tag", "count"]
+    old = pd.DataFrame([["bc0", "AAAA", 5], ["NC", "NC", 15]], columns=columns)
+    new = pd.DataFrame([["bc1", "CCCC", 5], ["NC", "NC", 10]], columns=columns)
+    old.to_csv(tmp_path / "old.csv", index=False)
+    new.to_csv(tmp_path / "new.csv", index=False)
+    merge_demultiplex_csv(str(tmp_path / "new.csv"), str(tmp_path / "old.csv"))
+    df = pd.read_csv(tmp_path / "old.csv")
+    assert list(df["id"]) == ["bc0", "bc1", "NC"]
+    assert list(df["count"]) == [5, 5, 10]
@@ -0,0 +1,140 @@
+"""
+testing logging setup
+"""
+import json
+import logging
+import multiprocessing
+
+from click.testing import CliRunner
+
+from rna_map_tools.cli import cli
+from rna_map_tools.logger import (
+    APP_LOGGER_NAME,
+    get_log_queue,
+    get_logger,
+    setup_applevel_logger,
+    setup_worker_logger,
+    stop_queue_logging,
+)
+
+
+def log_from_worker(log_queue, i):
+    setup_worker_logger(log_queue)
+    get_logger("WORKER").info(f"hello from worker {i}")
+
+
+def read_json_lines(path):
+    with open(path) as f:
+        return [json.loads(l) for l in f]
+
+
+def test_queue_logging(tmp_path):
+    log_file = str(tmp_path / "test.log")
+    setup_applevel_logger(file_name=log_file, use_queue=True, json_lines=True)
+    procs = [
+        multiprocessing.Process(
+            target=log_from_worker, args=(get_log_queue(), i)
+        )
+        for i in range(3)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    get_logger("MAIN").info("hello from main")
+    stop_queue_logging()
+    messages = sorted(r["message"] for r in read_json_lines(log_file))
+    assert messages == [
+        "hello from main",
+        "hello from worker 0",
+        "hello from worker 1",
+        "hello from worker 2",
+    ]
+    setup_applevel_logger()
+
+
+def test_rate_limit(tmp_path):
+    log_file = str(tmp_path / "test.log")
+    setup_applevel_logger(
+        file_name=log_file, use_queue=True, json_lines=True, rate_limit=2
+    )
+    log = get_logger("TEST")
+    for i in range(10):
+        log.warning(f"{i} is a duplicate", extra={"rate_key": "duplicate"})
+    log.warning("something else")
+    stop_queue_logging()
+    records = read_json_lines(log_file)
+    assert len(records) == 4
+    assert records[1]["message"].endswith("are suppressed)")
+    assert records[2]["message"] == "something else"
+    assert records[3]["message"].startswith("suppressed 8 more messages")
+    setup_applevel_logger()
+
+
+def test_artifacts(tmp_path):
+    log_file = str(tmp_path / "test.log")
+    setup_applevel_logger(
+        file_name=log_file, artifact_dir=str(tmp_path / "artifacts")
+    )
+    log = get_logger("TEST")
+    log.info("output from tool:\n" + "x" * 5000)
+    log.info("table:\nsmall", extra={"artifact": "table"})
+    log.info("short message")
+    for handler in logging.getLogger("RNA-MAP-TOOLS").handlers:
+        handler.flush()
+    with open(log_file) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 3
+    assert "full output in" in lines[0]
+    assert (tmp_path / "artifacts" / "0002_table.log").read_text() == (
+        "table:\nsmall"
+    )
+    setup_applevel_logger()
+
+
+def test_logging_after_queue_stops(tmp_path):
+    log_file = str(tmp_path / "test.log")
+    setup_applevel_logger(file_name=log_file, use_queue=True, json_lines=True)
+    get_logger("TEST").info("through the queue")
+    stop_queue_logging()
+    get_logger("TEST").info("after the queue stopped")
+    for handler in logging.getLogger("RNA-MAP-TOOLS").handlers:
+        handler.flush()
+    messages = [r["message"] for r in read_json_lines(log_file)]
+    assert messages == ["through the queue", "after the queue stopped"]
+    setup_applevel_logger()
+
+
+def test_cli_logging_options(tmp_path):
+    log_file = str(tmp_path / "test.log")
+    result = CliRunner().invoke(
+        cli,
+        [
+            "--log-file",
+            log_file,
+            "--json-log",
+            "--log-queue",
+            "daemon",
+            "status",
+            "--socket",
+            str(tmp_path / "missing.sock"),
+        ],
+    )
+    assert result.exit_code == 0
+    stop_queue_logging()
+    messages = [r["message"] for r in read_json_lines(log_file)]
+    assert messages == ["no daemon is running"]
+    setup_applevel_logger()
+
+
+def test_setup_closes_file_handlers(tmp_path):
+    setup_applevel_logger(file_name=str(tmp_path / "first.log"))
+    logger = logging.getLogger(APP_LOGGER_NAME)
+    file_handlers = [
+        h for h in logger.handlers if isinstance(h, logging.FileHandler)
+    ]
+    assert len(file_handlers) == 1
+    setup_applevel_logger(file_name=str(tmp_path / "second.log"))
+    # the file of the replaced handler is closed, not leaked
+    assert file_handlers[0].stream is None
+    setup_applevel_logger()
@@ -0,0 +1,106 @@
+"""
+testing memory mapped fastq reader
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from rna_map_tools.fastq import validate_fastq_file
+from rna_map_tools.mmap_fastq import MappedFastq
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+FASTQ_PATH = (
+    TEST_DIR + "/resources/demultiplexed/ACAAAATGGTGG/test_S1_L001_R1_001.fastq"
+)
+
+
+def read_records(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return [lines[i : i + 4] for i in range(0, len(lines), 4)]
+
+
+def test_mapped_fastq():
+    records = read_records(FASTQ_PATH)
+    with MappedFastq(FASTQ_PATH) as mfq:
+        assert len(mfq) == len(records) == 58
+        assert mfq.validate()
+        for i, record in enumerate(records):
+            assert bytes(mfq.name(i)).decode() == record[0][1:]
+            assert bytes(mfq.sequence(i)).decode() == record[1]
+            assert bytes(mfq.quality(i)).decode() == record[3]
+        assert list(mfq.sequence_lengths()) == [len(r[1]) for r in records]
+        quals = mfq.mean_qualities()
+        expected = sum(ord(c) - 33 for c in records[0][3]) / len(records[0][3])
+        assert quals[0] == pytest.approx(expected)
+
+
+def test_write_records(tmp_path):
+    out_path = str(tmp_path / "sub.fastq")
+    with MappedFastq(FASTQ_PATH) as mfq:
+        mfq.write_records([0, 5, 57], out_path)
+    records = read_records(FASTQ_PATH)
+    assert read_records(out_path) == [records[0], records[5], records[57]]
+
+
+def test_pickle():
+    mfq = MappedFastq(FASTQ_PATH)
+    mfq_2 = pickle.loads(pickle.dumps(mfq))
+    assert bytes(mfq_2.sequence(3)) == bytes(mfq.sequence(3))
+    mfq_2.close()
+    mfq.close()
+
+
+def test_invalid(tmp_path):
+    path = str(tmp_path / "bad_R1_.fastq")
+    with open(path, "w") as f:
+        f.write("@read1\nACGT\n+\nFFFF\n@read2\nACGT\n+\nFFF\n")
+    with MappedFastq(path) as mfq:
+        assert not mfq.validate()
+    assert validate_fastq_file(path)
+    assert not validate_fastq_file(path, full=True)
+    assert validate_fastq_file(FASTQ_PATH, full=True)
+
+
+def test_small_chunks():
+    records = read_records(FASTQ_PATH)
+    with MappedFastq(FASTQ_PATH, chunk_size=100) as mfq:
+        # one offset per record and the end of the last one
+        assert len(mfq.record_starts) == len(records) + 1
+        assert mfq.record_starts.dtype == np.uint32
+        assert len(mfq) == 58
+        assert mfq.validate()
+        assert bytes(mfq.sequence(57)).decode() == records[57][1]
+        with MappedFastq(FASTQ_PATH) as mfq_full:
+            assert np.array_equal(
+                mfq.mean_qualities(), mfq_full.mean_qualities()
+            )
+            assert np.array_equal(
+                mfq.sequence_lengths(), mfq_full.sequence_lengths()
+            )
+
+
+def test_line_endings(tmp_path):
+    path = str(tmp_path / "crlf_R1_.fastq")
+    with open(path, "wb") as f:
+        f.write(b"@read1\r\nACGT\r\n+\r\nIIII\r\n@read2\nAC\n+\nII")
+    with MappedFastq(path, chunk_size=8) as mfq:
+        assert len(mfq) == 2
+        assert mfq.validate()
+        assert bytes(mfq.quality(0)) == b"IIII"
+        assert bytes(mfq.quality(1)) == b"II"
+        assert mfq.record_bounds(1) == (23, 37)
+        assert list(mfq.mean_qualities()) == [40.0, 40.0]
+
+
+def test_empty_quality(tmp_path):
+    path = str(tmp_path / "empty_R1_.fastq")
+    with open(path, "w") as f:
+        f.write("@read1\n\n+\n\n@read2\nAC\n+\nII\n")
+    with MappedFastq(path) as mfq:
+        quals = mfq.mean_qualities()
+        assert np.isnan(quals[0])
+        assert quals[1] == 40.0
+        assert not mfq.validate()
@@ -0,0 +1,80 @@
+"""
+testing 2-bit packed sequences
+"""
+import random
+
+import numpy as np
+import pandas as pd
+
+from rna_map_tools.packed import (
+    best_matches,
+    decode,
+    encode,
+    hamming_distance,
+    reverse_complement,
+)
+from rna_map_tools.tools.demultiplex import check_barcode_distances
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def random_seqs(num, length, seed=1):
+    rand = random.Random(seed)
+    return ["".join(rand.choice("ACGT") for _ in range(length)) for _ in range(num)]
+
+
+def test_encode_decode():
+    seqs = ["ACGTACGTNN", "TTTTGGGGCC"]
+    packed = encode(seqs)
+    assert packed.words.shape == (2, 1)
+    assert decode(packed) == seqs
+    assert list(packed.has_n()) == [True, False]
+    long_seqs = random_seqs(5, 151)
+    packed = encode(long_seqs)
+    assert packed.words.shape == (5, 5)
+    assert decode(packed) == long_seqs
+
+
+def test_uneven_lengths():
+    packed = encode(["ACG", "ACGTA"])
+    assert decode(packed) == ["ACGNN", "ACGTA"]
+
+
+def test_hamming_distance():
+    seqs_1 = random_seqs(20, 70)
+    seqs_2 = random_seqs(10, 70, seed=2)
+    dist = hamming_distance(encode(seqs_1), encode(seqs_2))
+    for i, s1 in enumerate(seqs_1):
+        for j, s2 in enumerate(seqs_2):
+            assert dist[i, j] == sum(a != b for a, b in zip(s1, s2))
+    # N always counts as a mismatch
+    assert hamming_distance(encode(["ANGT"]), encode(["ANGT"]))[0, 0] == 1
+
+
+def test_reverse_complement():
+    seqs = random_seqs(10, 45) + ["ACGTNACGT"[:9].ljust(45, "A")]
+    rc = decode(reverse_complement(encode(seqs)))
+    assert rc == [s.translate(COMPLEMENT)[::-1] for s in seqs]
+    for length in [1, 31, 32, 33, 64]:
+        seqs = random_seqs(3, length)
+        rc = decode(reverse_complement(encode(seqs)))
+        assert rc == [s.translate(COMPLEMENT)[::-1] for s in seqs]
+
+
+def test_best_matches():
+    barcodes = ["TGCGCCATTGCT", "ACAAAATGGTGG", "CTGCGTGCAAAC"]
+    reads = ["TGCGCCATTGCA", "ACAAAATGGTGG", "GGGGGGGGGGGG", "CTGCGTGCNAAC"]
+    indices, distances = best_matches(
+        encode(reads), encode(barcodes), 2, chunk_size=3
+    )
+    assert list(indices) == [0, 1, -1, 2]
+    assert list(distances[[0, 1, 3]]) == [1, 0, 1]
+    assert np.all(distances >= 0)
+
+
+def test_check_barcode_distances():
+    df = pd.DataFrame(
+        {"barcode": ["A", "B", "C"], "barcode_seq": ["AAAA", "AAAT", "GGCC"]}
+    )
+    assert check_barcode_distances(df, 0) is True
+    assert check_barcode_distances(df, 1) is False
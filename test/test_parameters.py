@@ -0,0 +1,30 @@
+"""
+testing parsing and validation of parameters
+"""
+from rna_map_tools.parameters import (
+    get_default_params,
+    get_schema,
+    validate_parameters,
+)
+
+
+def test_defaults_are_not_shared():
+    params = {}
+    validate_parameters(params)
+    params["demultiplex"]["trim"]["enabled"] = True
+    params["runmulti"]["chunk_records"] = 5
+    params_2 = {}
+    validate_parameters(params_2)
+    assert not params_2["demultiplex"]["trim"]["enabled"]
+    assert params_2["runmulti"]["chunk_records"] == 0
+    assert get_schema()["properties"]["demultiplex"]["default"] == {}
+    params_3 = get_default_params()
+    params_3["demultiplex"]["subsample"]["enabled"] = True
+    assert not get_default_params()["demultiplex"]["subsample"]["enabled"]
+
+
+def test_intermediate_codec_default():
+    """
+    demultiplexed outputs stay uncompressed unless compression is asked for
+    """
+    assert get_default_params()["demultiplex"]["intermediate_codec"] == "none"
@@ -0,0 +1,50 @@
+"""
+testing the run planner
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.fastq import get_paired_fastqs
+from rna_map_tools.tools.plan import plan_run, sample_fastq
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def test_sample_fastq():
+    path = TEST_DIR + "/resources/test_fastqs_gziped/C0098_S1_L001_R1_001.fastq.gz"
+    sample = sample_fastq(path, 10)
+    assert len(sample.sequences) == 10
+    assert not sample.reached_end
+    sample = sample_fastq(path, 1000)
+    assert sample.reached_end
+    assert sample.estimate_num_reads() == 250
+
+
+def test_plan_run(tmp_path):
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    pfqs = get_paired_fastqs(TEST_DIR + "/resources/test_fastqs_gziped")
+    plan = plan_run(df, pfqs, num_reads=100, scratch_dir=str(tmp_path))
+    assert plan.num_reads > 0
+    assert list(plan.stages["stage"]) == ["staging", "demultiplex", "rna_map"]
+    assert len(plan.barcodes) == len(df)
+    assert 1 <= plan.suggested_workers <= len(df)
+    plan.log()
+
+
+def test_plan_intermediate_codec():
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    pfqs = get_paired_fastqs(TEST_DIR + "/resources/test_fastqs_gziped")
+    plan_none = plan_run(df, pfqs, num_reads=100, intermediate_codec="none")
+    plan_gzip = plan_run(df, pfqs, num_reads=100, intermediate_codec="gzip")
+    scratch_none = plan_none.stages.iloc[1]["scratch_gb"]
+    scratch_gzip = plan_gzip.stages.iloc[1]["scratch_gb"]
+    assert scratch_gzip == pytest.approx(scratch_none * 0.25)
+
+
+def test_plan_empty_sheet():
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv").iloc[:0]
+    pfqs = get_paired_fastqs(TEST_DIR + "/resources/test_fastqs_gziped")
+    with pytest.raises(ValueError):
+        plan_run(df, pfqs, num_reads=100)
@@ -0,0 +1,195 @@
+"""
+testing the single file read store of a demultiplexed run
+"""
+import os
+import sys
+import shutil
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.compression import compress_file, open_file
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.read_store import (
+    READ_STORE_FILE,
+    ReadStore,
+    ReadStoreWriter,
+    is_read_store,
+    pack_barcode_dirs,
+)
+from rna_map_tools.tools.demultiplex import SabreDemultiplexer
+from rna_map_tools.tools.runmulti import valid_fastq_files
+
+TEST_DIR = Path(__file__).parent
+BARCODES = ["ACAAAATGGTGG", "CTGCGTGCAAAC", "TGCGCCATTGCT"]
+
+
+def read_text(path):
+    with open_file(path, "rt") as f:
+        return f.read()
+
+
+@pytest.fixture
+def demultiplexed(tmp_path):
+    path = tmp_path / "demultiplexed"
+    shutil.copytree(TEST_DIR / "resources/demultiplexed", path)
+    return path
+
+
+def test_pack_and_export(demultiplexed, tmp_path):
+    expected = {
+        b: read_text(demultiplexed / b / "test_S1_L001_R1_001.fastq")
+        for b in BARCODES
+    }
+    # a mix of compressed and uncompressed inputs
+    r2 = demultiplexed / BARCODES[0] / "test_S1_L001_R2_001.fastq"
+    compress_file(str(r2), "gzip")
+    store_path = pack_barcode_dirs(str(demultiplexed), BARCODES, "gzip-fast")
+    assert is_read_store(store_path)
+    assert not is_read_store(str(r2) + ".gz")
+    with ReadStore(store_path) as store:
+        assert store.barcodes() == BARCODES
+        for b in BARCODES:
+            with store.open(b, "R1") as f:
+                assert f.read().decode() == expected[b]
+            assert store.validate(b, full=True)
+            assert store.num_records(b) == expected[b].count("\n") // 4
+        store.export_all(str(tmp_path / "exported"))
+    for b in BARCODES:
+        exported = tmp_path / "exported" / b / "test_S1_L001_R1_001.fastq.gz"
+        assert read_text(exported) == expected[b]
+
+
+def test_uncompressed_store(demultiplexed, tmp_path):
+    directory = demultiplexed / BARCODES[1]
+    path = pack_barcode_dirs(
+        str(demultiplexed), BARCODES[1:2], "none", remove=True
+    )
+    assert not os.path.exists(directory)
+    with ReadStore(path) as store:
+        assert store.block_info(BARCODES[1], "R1")["codec"] == "none"
+        assert store.validate(BARCODES[1], full=True)
+        store.export(BARCODES[1], str(tmp_path / "out"))
+    assert sorted(os.listdir(tmp_path / "out")) == [
+        "test_S1_L001_R1_001.fastq",
+        "test_S1_L001_R2_001.fastq",
+    ]
+
+
+def test_valid_fastq_files_from_store(demultiplexed):
+    df = pd.read_csv(TEST_DIR / "resources/test_fastqs/data.csv")
+    path = pack_barcode_dirs(str(demultiplexed), BARCODES[:2])
+    assert not valid_fastq_files(df, path)
+    path = pack_barcode_dirs(str(demultiplexed), BARCODES)
+    assert valid_fastq_files(df, path)
+
+
+def test_finalize_outputs_to_store(demultiplexed):
+    cwd = os.getcwd()
+    os.chdir(demultiplexed)
+    try:
+        demultiplexer = SabreDemultiplexer()
+        params = get_default_params()["demultiplex"]
+        params["read_store"] = True
+        demultiplexer.setup(params)
+        df = pd.DataFrame({"barcode_seq": BARCODES})
+        demultiplexer._finalize_outputs(df, "gzip-fast")
+        assert os.listdir(".") == [READ_STORE_FILE]
+        with ReadStore(READ_STORE_FILE) as store:
+            assert store.barcodes() == BARCODES
+    finally:
+        os.chdir(cwd)
+
+
+def test_finalize_outputs_store_codec(demultiplexed):
+    cwd = os.getcwd()
+    os.chdir(demultiplexed)
+    try:
+        demultiplexer = SabreDemultiplexer()
+        params = get_default_params()["demultiplex"]
+        params.update(read_store=True, intermediate_codec="gzip")
+        demultiplexer.setup(params)
+        df = pd.DataFrame({"barcode_seq": BARCODES})
+        # the store is compressed with intermediate_codec, not the codec of
+        # the barcode directories
+        demultiplexer._finalize_outputs(df, "none")
+        with ReadStore(READ_STORE_FILE) as store:
+            for barcode_seq in BARCODES:
+                info = store.block_info(barcode_seq, "R1")
+                assert info["codec"] == "gzip"
+    finally:
+        os.chdir(cwd)
+
+
+def test_runmulti_from_store(tmp_path, monkeypatch):
+    from rna_map_tools.tools import runmulti
+    from rna_map_tools.tools.benchmark import TimedStub, make_synthetic_run
+
+    df = make_synthetic_run(str(tmp_path), 4)
+    store_path = pack_barcode_dirs(
+        str(tmp_path / "demultiplexed"), list(df["barcode_seq"]), remove=True
+    )
+    stub = TimedStub()
+    # the references are validated once so rna_map does not validate them
+    monkeypatch.setattr(runmulti, "run_rna_map_validated", stub)
+    params = get_default_params()["runmulti"]
+    params["rna_map_params_file"] = str(tmp_path / "rna_map_params.yml")
+    cwd = os.getcwd()
+    try:
+        runmulti.runmulti(
+            df, str(tmp_path / "run"), store_path, str(tmp_path / "seq"), params
+        )
+    finally:
+        os.chdir(cwd)
+    assert stub.num_calls == 4
+    construct_dir = tmp_path / "run" / "processed" / "construct_0_C0000_DMS"
+    assert not os.path.exists(construct_dir / "reads")
+
+
+def test_append_in_place(demultiplexed):
+    path = pack_barcode_dirs(str(demultiplexed), BARCODES[:1])
+    with ReadStore(path) as store:
+        old_info = store.block_info(BARCODES[0], "R1")
+    old_size = os.path.getsize(path)
+    pack_barcode_dirs(str(demultiplexed), BARCODES[1:], append=True)
+    with ReadStore(path) as store:
+        assert store.barcodes() == BARCODES
+        assert store.block_info(BARCODES[0], "R1") == old_info
+        assert store.validate(BARCODES[0], full=True)
+        assert store.validate(BARCODES[2], full=True)
+    # a failed append leaves the store as it was
+    new_size = os.path.getsize(path)
+    fastq = str(demultiplexed / BARCODES[0] / "test_S1_L001_R1_001.fastq")
+    with pytest.raises(ValueError):
+        with ReadStoreWriter(path, append=True) as writer:
+            writer.add_fastq(BARCODES[0], "R1", fastq)
+            writer.add_fastq(BARCODES[0], "R3", fastq)
+    assert os.path.getsize(path) == new_size
+    with ReadStore(path) as store:
+        assert store.barcodes() == BARCODES
+    assert new_size > old_size
+
+
+def test_killed_append(demultiplexed):
+    path = pack_barcode_dirs(str(demultiplexed), BARCODES[:1])
+    code = (
+        "import os\n"
+        "from rna_map_tools.read_store import ReadStoreWriter\n"
+        f"writer = ReadStoreWriter({path!r}, append=True)\n"
+        f"writer.add_barcode_dir({BARCODES[1]!r}, "
+        f"{str(demultiplexed / BARCODES[1])!r})\n"
+        "os._exit(1)\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=False)
+    # partial blocks without a footer are at the end of the store
+    with ReadStore(path) as store:
+        assert store.barcodes() == BARCODES[:1]
+        assert store.validate(BARCODES[0], full=True)
+    pack_barcode_dirs(str(demultiplexed), BARCODES[1:], append=True)
+    assert not os.path.exists(path + ".append")
+    with ReadStore(path) as store:
+        assert store.barcodes() == BARCODES
+        for barcode_seq in BARCODES:
+            assert store.validate(barcode_seq, full=True)
@@ -0,0 +1,128 @@
+"""
+testing the reference cache
+"""
+import os
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.tools import references
+from rna_map_tools.tools.references import (
+    ReferenceCache,
+    run_rna_map,
+    run_rna_map_validated,
+)
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def setup_seq_data(path):
+    os.makedirs(path / "fasta")
+    os.makedirs(path / "rna")
+    shutil.copy(TEST_DIR + "/resources/test_fastas/C0098.fasta", path / "fasta")
+    shutil.copy(TEST_DIR + "/resources/test_csvs/C0098.csv", path / "rna")
+
+
+def test_reference_cache(tmp_path):
+    setup_seq_data(tmp_path)
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    refs = ReferenceCache()
+    assert refs.load(df, tmp_path)
+    assert len(refs) == 1
+    ref = refs.get("C0098")
+    df_csv = pd.read_csv(TEST_DIR + "/resources/test_csvs/C0098.csv")
+    assert len(ref) == len(df_csv) == 24
+    assert ref.names[0] == df_csv["name"][0]
+    assert ref.fasta_path == str(tmp_path / "fasta" / "C0098.fasta")
+    # loading again does not touch the files
+    shutil.rmtree(tmp_path / "fasta")
+    assert refs.load(df, tmp_path)
+
+
+def test_snapshot(tmp_path):
+    setup_seq_data(tmp_path)
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    refs = ReferenceCache()
+    refs.load(df, tmp_path)
+    refs.save(str(tmp_path / "references.p"))
+    refs_2 = ReferenceCache.from_snapshot(str(tmp_path / "references.p"))
+    assert "C0098" in refs_2
+    assert refs_2.get("C0098") == refs.get("C0098")
+    assert refs_2.drop_stale() == 0
+    # the snapshot is invalidated once the files change
+    with open(tmp_path / "fasta" / "C0098.fasta", "a") as f:
+        f.write(">extra\nACGT\n")
+    refs_3 = ReferenceCache.from_snapshot(str(tmp_path / "references.p"))
+    assert refs_3.drop_stale() == 1
+    assert "C0098" not in refs_3
+
+
+def test_missing_reference(tmp_path):
+    setup_seq_data(tmp_path)
+    df = pd.DataFrame({"code": ["C0098", "C0099"]})
+    assert not ReferenceCache().load(df, tmp_path)
+
+
+def test_drop_stale(tmp_path):
+    setup_seq_data(tmp_path)
+    df = pd.read_csv(TEST_DIR + "/resources/test_fastqs/data.csv")
+    refs = ReferenceCache()
+    assert refs.load(df, tmp_path)
+    assert refs.drop_stale() == 0
+    with open(tmp_path / "rna" / "C0098.csv", "a") as f:
+        f.write("\n")
+    assert refs.drop_stale() == 1
+    assert "C0098" not in refs
+
+
+def run_in_dir(path, func, *args):
+    cwd = os.getcwd()
+    os.makedirs(path)
+    os.chdir(path)
+    try:
+        func(*args)
+    finally:
+        os.chdir(cwd)
+    with open(path / "output" / "BitVector_Files" / "mutation_histos.json") as f:
+        return json.load(f)
+
+
+@pytest.mark.skipif(
+    any(
+        shutil.which(p) is None
+        for p in ["bowtie2", "fastqc", "trim_galore", "cutadapt"]
+    ),
+    reason="rna_map requires bowtie2, fastqc, trim_galore and cutadapt",
+)
+def test_run_rna_map_validated_matches(tmp_path):
+    """
+    skipping validation does not change what rna_map produces
+    """
+    args = [
+        TEST_DIR + "/resources/test_fastas/C0098.fasta",
+        TEST_DIR + "/resources/test_fastqs/C0098_S1_L001_R2_001.fastq",
+        TEST_DIR + "/resources/test_fastqs/C0098_S1_L001_R1_001.fastq",
+        TEST_DIR + "/resources/test_csvs/C0098.csv",
+    ]
+    expected = run_in_dir(tmp_path / "run", run_rna_map, *args)
+    result = run_in_dir(tmp_path / "validated", run_rna_map_validated, *args)
+    assert result == expected
+
+
+def test_run_rna_map_validated_other_version(monkeypatch):
+    """
+    an rna_map version the copy is not known to match runs rna_map.run.run
+    """
+    calls = []
+    monkeypatch.setattr(references, "RNA_MAP_VERSION", "0.0.0")
+    monkeypatch.setattr(
+        references, "run_rna_map", lambda *args: calls.append(args)
+    )
+    references.rna_map_version_matches.cache_clear()
+    try:
+        run_rna_map_validated("a.fasta", "r2.fastq", "r1.fastq", "a.csv")
+    finally:
+        references.rna_map_version_matches.cache_clear()
+    assert calls == [("a.fasta", "r2.fastq", "r1.fastq", "a.csv", None)]
@@ -12,6 +12,7 @@ from rna_map_tools.logger import setup_applevel_logger
 from rna_map_tools.exceptions import RNAMapToolsInputException
 
 from rna_map_tools.tools.runmulti import (
+    check_runmulti_inputs,
     runmulti,
     valid_fastq_files,
     valid_fasta_files,
@@ -63,3 +64,25 @@ def test_valid_fasta_files():
     # print(exec_info)
 
     # setup_test_dir()
+
+
+def test_check_runmulti_inputs_full(tmp_path):
+    """
+    full validation finds a broken record after the first
+    """
+    data_path = tmp_path / "demultiplexed"
+    shutil.copytree(TEST_DIR / "resources/demultiplexed", data_path)
+    seq_path = tmp_path / "seq"
+    os.makedirs(seq_path / "fasta")
+    os.makedirs(seq_path / "rna")
+    shutil.copy(TEST_DIR / "resources/test_fastas/C0098.fasta", seq_path / "fasta")
+    shutil.copy(TEST_DIR / "resources/test_csvs/C0098.csv", seq_path / "rna")
+    df = pd.read_csv(TEST_DIR / "resources/test_fastqs/data.csv")
+    fastq = data_path / df["barcode_seq"][0] / "test_S1_L001_R1_001.fastq"
+    lines = fastq.read_text().splitlines()
+    lines[7] = lines[7][:-1]
+    fastq.write_text("\n".join(lines) + "\n")
+    references = check_runmulti_inputs(df, tmp_path, data_path, seq_path)
+    assert "C0098" in references
+    with pytest.raises(SystemExit):
+        check_runmulti_inputs(df, tmp_path, data_path, seq_path, full=True)
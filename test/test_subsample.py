@@ -0,0 +1,97 @@
+"""
+testing subsampling of demultiplexed reads
+"""
+import os
+
+import pandas as pd
+
+from rna_map_tools.fastq import read_fastq_pairs
+from rna_map_tools.parameters import get_default_params
+from rna_map_tools.tools.demultiplex import SabreDemultiplexer
+from rna_map_tools.tools.subsample import (
+    SubsampleStats,
+    get_rng,
+    subsample_pairs,
+)
+
+
+def get_subsample_params(**kwargs):
+    params = get_default_params()["demultiplex"]["subsample"]
+    params.update(enabled=True, **kwargs)
+    return params
+
+
+def make_pairs(n):
+    return [
+        ((f"@r{i}".encode(), b"ACGT", b"+", b"IIII"),) * 2 for i in range(n)
+    ]
+
+
+def names(pairs):
+    return [p[0][0] for p in pairs]
+
+
+def test_max_depth():
+    pairs = make_pairs(1000)
+    params = get_subsample_params(max_depth=100)
+    stats = SubsampleStats()
+    kept = list(subsample_pairs(pairs, params, get_rng(0, "AAAA"), stats))
+    assert len(kept) == 100
+    assert stats.pairs_in == 1000 and stats.pairs_out == 100
+    # kept in original order and the same with the same seed
+    order = [int(n[2:]) for n in names(kept)]
+    assert order == sorted(order)
+    again = subsample_pairs(pairs, params, get_rng(0, "AAAA"), SubsampleStats())
+    assert names(again) == names(kept)
+    other = subsample_pairs(pairs, params, get_rng(1, "AAAA"), SubsampleStats())
+    assert names(other) != names(kept)
+    # barcodes below the cap are untouched
+    kept = list(
+        subsample_pairs(pairs[:50], params, get_rng(0, "A"), SubsampleStats())
+    )
+    assert kept == pairs[:50]
+
+
+def test_fraction():
+    pairs = make_pairs(10000)
+    params = get_subsample_params(fraction=0.1)
+    kept = list(
+        subsample_pairs(pairs, params, get_rng(0, "AAAA"), SubsampleStats())
+    )
+    assert 800 < len(kept) < 1200
+    params = get_subsample_params(fraction=0.1, max_depth=500)
+    kept = list(
+        subsample_pairs(pairs, params, get_rng(0, "AAAA"), SubsampleStats())
+    )
+    assert len(kept) == 500
+
+
+def test_finalize_outputs(tmp_path):
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        for barcode_seq, n in [("AAAA", 30), ("CCCC", 5)]:
+            os.makedirs(barcode_seq)
+            for read in ["R1", "R2"]:
+                with open(f"{barcode_seq}/test_S1_L001_{read}_001.fastq", "w") as f:
+                    for i in range(n):
+                        f.write(f"@r{i}\nACGTACGT\n+\nIIIIIIII\n")
+        demultiplexer = SabreDemultiplexer()
+        params = get_default_params()["demultiplex"]
+        params["subsample"].update(enabled=True, max_depth=10)
+        demultiplexer.setup(params)
+        df = pd.DataFrame({"barcode_seq": ["AAAA", "CCCC"]})
+        demultiplexer._finalize_outputs(df, "gzip-fast")
+        df_stats = pd.read_csv("subsample_stats.csv")
+        assert list(df_stats["pairs_out"]) == [10, 5]
+        pairs = list(
+            read_fastq_pairs(
+                "AAAA/test_S1_L001_R1_001.fastq.gz",
+                "AAAA/test_S1_L001_R2_001.fastq.gz",
+            )
+        )
+        assert len(pairs) == 10
+        assert all(r1[0] == r2[0] for r1, r2 in pairs)
+        assert not os.path.exists("trim_stats.csv")
+    finally:
+        os.chdir(cwd)
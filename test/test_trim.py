@@ -0,0 +1,122 @@
+"""
+testing trimming of demultiplexed reads
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from rna_map_tools.compression import open_file
+from rna_map_tools.parameters import get_default_params, validate_parameters
+from rna_map_tools.tools.demultiplex import SabreDemultiplexer
+from rna_map_tools.tools.trim import ReadTrimmer, TrimStats, trim_pairs
+
+PRIMER = "GGAAGATCGAGTAGATC"
+ADAPTER = "AGATCGGAAGAGC"
+
+
+def get_trim_params(**kwargs):
+    params = get_default_params()["demultiplex"]["trim"]
+    params.update(kwargs)
+    return params
+
+
+def write_pair(directory, pairs):
+    os.makedirs(directory, exist_ok=True)
+    for i, read in enumerate(["R1", "R2"]):
+        with open(f"{directory}/test_S1_L001_{read}_001.fastq", "w") as f:
+            for j, pair in enumerate(pairs):
+                seq, qual = pair[i]
+                f.write(f"@read{j}\n{seq}\n+\n{qual}\n")
+
+
+def read_fastq(path):
+    with open_file(path, "rt") as f:
+        lines = [l.rstrip("\n") for l in f]
+    return list(zip(lines[1::4], lines[3::4]))
+
+
+def test_default_params_validate():
+    params = get_default_params()
+    assert params["demultiplex"]["trim"]["enabled"] is False
+    # missing sections are filled in from the schema
+    params = {}
+    validate_parameters(params)
+    assert params["demultiplex"]["trim"]["min_length"] == 20
+    with pytest.raises(ValueError):
+        validate_parameters({"demultiplex": {"trim": {"read_1_five_prime": "NX"}}})
+
+
+def test_read_trimmer():
+    stats = TrimStats()
+    trimmer = ReadTrimmer(PRIMER.encode(), ADAPTER.encode())
+    seq = PRIMER + "ACGTACGTAC" + ADAPTER + "TTTT"
+    out, qual = trimmer.trim(seq.encode(), b"I" * len(seq), stats)
+    assert out == b"ACGTACGTAC"
+    assert len(qual) == len(out)
+    # partial adapter at the end of the read
+    out, _ = trimmer.trim(b"ACGTACGTACAGATC", b"I" * 15, stats)
+    assert out == b"ACGTACGTAC"
+    assert stats.five_prime_trimmed == 1
+    assert stats.three_prime_trimmed == 2
+
+
+def test_quality_trim():
+    trimmer = ReadTrimmer(quality_cutoff=20)
+    stats = TrimStats()
+    # phred 40 followed by a tail of phred 2
+    out, qual = trimmer.trim(b"A" * 12, b"I" * 8 + b"#" * 4, stats)
+    assert out == b"A" * 8
+    assert qual == b"I" * 8
+    assert stats.quality_trimmed == 1
+
+
+def test_trim_pairs():
+    keep = PRIMER + "C" * 30 + ADAPTER
+    short = PRIMER + "C" * 5 + ADAPTER
+    pairs = [
+        [(keep, "I" * len(keep)), ("G" * 40, "I" * 40)],
+        [(short, "I" * len(short)), ("G" * 40, "I" * 40)],
+    ]
+    # records are bytes as they come from read_fastq_pairs
+    records = [
+        tuple(
+            (f"@read{j}".encode(), seq.encode(), b"+", qual.encode())
+            for seq, qual in pair
+        )
+        for j, pair in enumerate(pairs)
+    ]
+    params = get_trim_params(
+        enabled=True, read_1_five_prime=PRIMER, read_1_three_prime=ADAPTER
+    )
+    stats = TrimStats()
+    trimmed = list(trim_pairs(records, params, stats))
+    assert len(trimmed) == 1
+    assert trimmed[0][0] == (b"@read0", b"C" * 30, b"+", b"I" * 30)
+    assert trimmed[0][1] == (b"@read0", b"G" * 40, b"+", b"I" * 40)
+    assert stats.pairs == 2
+    assert stats.pairs_written == 1
+    assert stats.too_short == 1
+
+
+def test_finalize_outputs(tmp_path):
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        seq = "A" * 30 + ADAPTER
+        for barcode_seq in ["AAAA", "CCCC"]:
+            write_pair(barcode_seq, [[(seq, "I" * len(seq))] * 2])
+        df = pd.DataFrame({"barcode_seq": ["AAAA", "CCCC"]})
+        demultiplexer = SabreDemultiplexer()
+        params = get_default_params()["demultiplex"]
+        params["trim"].update(enabled=True, read_1_three_prime=ADAPTER)
+        demultiplexer.setup(params)
+        demultiplexer._finalize_outputs(df, "none")
+        df_stats = pd.read_csv("trim_stats.csv")
+        assert list(df_stats["barcode_seq"]) == ["AAAA", "CCCC"]
+        assert list(df_stats["three_prime_trimmed"]) == [1, 1]
+        assert read_fastq("AAAA/test_S1_L001_R1_001.fastq") == [
+            ("A" * 30, "I" * 30)
+        ]
+    finally:
+        os.chdir(cwd)
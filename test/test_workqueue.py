@@ -0,0 +1,169 @@
+"""
+testing shared filesystem work queue
+"""
+import os
+import time
+import json
+import multiprocessing
+
+from rna_map_tools.tools.workqueue import WorkQueue, check_claim, run_worker
+
+
+def process_item(item_id, payload):
+    """
+    records which worker processed an item
+    """
+    path = os.path.join(payload["out_dir"], f"{item_id}.{os.getpid()}")
+    with open(path, "w") as f:
+        f.write(item_id)
+    time.sleep(0.01)
+    return {"value": payload["value"] * 2}
+
+
+def start_worker(queue_path, items, worker_id):
+    queue = WorkQueue(queue_path)
+    queue.populate(items)
+    run_worker(
+        queue,
+        process_item,
+        worker_id=worker_id,
+        heartbeat_interval=0.1,
+        stale_timeout=5,
+        poll_interval=0.1,
+    )
+
+
+def test_multiple_workers(tmp_path):
+    """
+    several worker processes against one directory process each item once
+    """
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    items = {
+        f"{i:06d}": {"value": i, "out_dir": str(out_dir)} for i in range(40)
+    }
+    queue_path = str(tmp_path / "queue")
+    procs = [
+        multiprocessing.Process(
+            target=start_worker, args=(queue_path, items, f"worker-{i}")
+        )
+        for i in range(4)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    queue = WorkQueue(queue_path)
+    assert queue.is_finished()
+    assert queue.num_items("done") == 40
+    processed = [f.split(".")[0] for f in os.listdir(out_dir)]
+    assert sorted(processed) == sorted(items.keys())
+    results = queue.gather_results()
+    assert results["000003"]["result"]["value"] == 6
+    with open(os.path.join(queue_path, "results.json")) as f:
+        assert len(json.load(f)) == 40
+
+
+def test_reclaim_stale(tmp_path):
+    """
+    a claim without a heartbeat is moved back to todo
+    """
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.populate({"a": {}, "b": {}})
+    claim = queue.claim("dead-worker")
+    assert claim.item_id == "a"
+    assert queue.reclaim_stale(60) == 0
+    old = time.time() - 120
+    os.utime(claim.path, (old, old))
+    assert queue.reclaim_stale(60) == 1
+    assert queue.heartbeat(claim) is False
+    assert queue.num_items("todo") == 2
+    # populating again does not requeue items
+    assert queue.populate({"a": {}, "b": {}}) == 0
+
+
+def test_failed_item(tmp_path):
+    """
+    exceptions are recorded and do not stop the worker
+    """
+
+    def func(item_id, payload):
+        if item_id == "bad":
+            raise ValueError("bad item")
+        return {}
+
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.populate({"bad": {}, "good": {}})
+    assert run_worker(queue, func, poll_interval=0.01) == 2
+    results = queue.gather_results()
+    assert results["bad"]["status"] == "failed"
+    assert "bad item" in results["bad"]["error"]
+    assert results["good"]["status"] == "done"
+
+
+def test_claim_is_fresh(tmp_path):
+    """
+    a claimed item never carries the mtime it was queued with
+    """
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.populate({"a": {"value": 1}})
+    os.utime(tmp_path / "queue" / "todo" / "a.json", (0, 0))
+    claim = queue.claim("w1")
+    assert queue.reclaim_stale(100) == 0
+    assert os.path.exists(claim.path)
+
+
+def test_lost_claim_aborts(tmp_path):
+    """
+    an item whose claim is taken over is aborted and not recorded
+    """
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.populate({"a": {"value": 1}})
+    calls = []
+
+    def slow_item(item_id, payload):
+        calls.append(item_id)
+        if len(calls) == 1:
+            # another worker requeues the item while it is being worked on
+            claimed = tmp_path / "queue" / "claimed" / "a@w1.json"
+            os.rename(claimed, tmp_path / "queue" / "todo" / "a.json")
+            for _ in range(500):
+                time.sleep(0.01)
+                check_claim()
+            calls.append("not aborted")
+        return {"value": 2}
+
+    run_worker(
+        queue,
+        slow_item,
+        worker_id="w1",
+        heartbeat_interval=0.05,
+        stale_timeout=100,
+        poll_interval=0.05,
+    )
+    assert calls == ["a", "a"]
+    assert queue.num_items("done") == 1
+    assert queue.num_items("failed") == 0
+    with open(tmp_path / "queue" / "results" / "a.json") as f:
+        assert json.load(f)["status"] == "done"
+
+
+def test_lost_claim_not_recorded(tmp_path):
+    """
+    a worker that lost its claim does not record a result or take the item
+    back from todo
+    """
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.populate({"a": {"value": 1}})
+    claim = queue.claim("w1")
+    os.rename(claim.path, tmp_path / "queue" / "todo" / "a.json")
+    assert queue.complete(claim, {"value": 2}) is False
+    assert queue.fail(claim, "error") is False
+    assert queue.num_items("todo") == 1
+    assert queue.num_items("done") == 0
+    assert os.listdir(tmp_path / "queue" / "results") == []
+    # the worker that claims it next records its result
+    claim = queue.claim("w2")
+    assert queue.complete(claim, {"value": 3}) is True
+    assert queue.gather_results()["a"]["result"]["value"] == 3